@@ -25,13 +25,17 @@ import logging
 log = logging.getLogger(__name__)
 
 from pyramid.config import Configurator
+from pyramid.tweens import INGRESS
+from pyramid.events import NewResponse
+from pyramid.settings import asbool
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
-from pyramid_beaker import session_factory_from_settings
 from pyramid_mailer import mailer_factory_from_settings
 from sqlalchemy import engine_from_config
 
+from .admission import build_budget_from_settings
 from .licenses import licenses_factory_from_settings
+from .sessions import session_factory_from_settings
 
 
 def check_path(path):
@@ -82,16 +86,43 @@ def main(global_config, **settings):
     check_path(settings['site.files'])
     check_path(settings['licenses.cache_dir'])
 
+    # Fork-based servers which load the application before forking can have
+    # the rendering libraries imported once, and shared by all workers
+    if asbool(settings.get('site.preload', False)):
+        from . import markup, models
+        markup.preload()
+        models.preload()
+
+    # Read-only requests bypass the transaction manager entirely (see
+    # ratbot.tweens.database_tween_factory)
+    settings.setdefault('tm.activate_hook', 'ratbot.tweens.tm_activate_hook')
+
     session_factory = session_factory_from_settings(settings)
     mailer_factory = mailer_factory_from_settings(settings)
     licenses_factory = licenses_factory_from_settings(settings)
+    build_budget = build_budget_from_settings(settings)
     engine = engine_from_config(settings, 'sqlalchemy.')
-
-    # Configure the database session; the session is deliberately separated
-    # from the model to enable us to bind it to an engine before importing
-    # the model which will then use the bound engine to reflect the database
-    from .db_session import DBSession
-    DBSession.configure(bind=engine, info={'site.files': files_dir})
+    replicas = [
+        engine_from_config(dict(settings, **{'sqlalchemy.url': url}), 'sqlalchemy.')
+        for url in settings.get('replica.urls', '').split()
+        ]
+
+    # Configure the database session; the schema is checked against the
+    # models when the engine first connects rather than here so that start-up
+    # doesn't wait on the database
+    from .models import DBSession, verify_schema_on_connect
+    from .cache import response_cache_from_settings
+    response_cache = (
+        response_cache_from_settings(settings)
+        if asbool(settings.get('cache.enabled', False)) else None)
+    render_queue = asbool(settings.get('render.queue', False))
+    DBSession.configure(bind=engine, info={
+        'site.files': files_dir,
+        'replicas': replicas,
+        'response_cache': response_cache,
+        'render.queue': render_queue,
+        })
+    verify_schema_on_connect(engine)
 
     from .security import RequestWithUser, group_finder
     config = Configurator(
@@ -120,7 +151,29 @@ def main(global_config, **settings):
     config.set_authorization_policy(authz_policy)
     config.registry['mailer'] = mailer_factory
     config.registry['licenses'] = licenses_factory
-    config.add_static_view('static', 'static', cache_max_age=3600)
+    config.registry['build_budget'] = build_budget
+    config.include('.assets')
+    config.include('.metrics')
+    config.add_tween('ratbot.tweens.database_tween_factory', under=INGRESS)
+    config.add_tween(
+        'ratbot.sqlstats.sqlstats_tween_factory',
+        over='ratbot.tweens.database_tween_factory')
+    if settings.get('profile.dir'):
+        config.add_tween(
+            'ratbot.profiler.profiler_tween_factory',
+            over='ratbot.sqlstats.sqlstats_tween_factory')
+    slowlog = settings.get('slowlog.threshold')
+    if slowlog:
+        config.add_tween(
+            'ratbot.slowlog.slowlog_tween_factory',
+            over='ratbot.sqlstats.sqlstats_tween_factory')
+        config.add_renderer('.pt', 'ratbot.slowlog.template_renderer_factory')
+        config.add_subscriber('ratbot.slowlog.record_user', NewResponse)
+    if response_cache is not None:
+        config.registry['response_cache'] = response_cache
+        config.add_tween(
+            'ratbot.cache.response_cache_tween_factory',
+            under='ratbot.tweens.database_tween_factory')
 
     from .views.comics import routes as comic_routes
     from .views.admin import routes as admin_routes
@@ -130,6 +183,7 @@ def main(global_config, **settings):
         IssueContextFactory,
         PageContextFactory,
         )
+    from .slowlog import timed_factory
     for name, pattern in comic_routes() + admin_routes():
         if '{page' in pattern:
             factory = PageContextFactory
@@ -139,6 +193,8 @@ def main(global_config, **settings):
             factory = ComicContextFactory
         else:
             factory = RootContextFactory
+        if slowlog:
+            factory = timed_factory(factory)
         config.add_route(name, pattern, factory=factory)
     config.scan()
 
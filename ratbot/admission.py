@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Admission control for the expensive derivative files (issue archives and
+PDFs).
+
+Building an issue's archive or PDF renders every page of the issue, which can
+take seconds. Without a limit, a burst of downloads of a newly published
+issue would occupy every server thread with building the same file, leaving
+none to serve cheap pages. Instead, each process builds at most
+``render.builds`` of these files at once, and builds each file only once; a
+request for a file which can't be built straight away is answered with 202
+Accepted and a Retry-After of ``render.retry_after`` seconds. Files which
+are already up to date are always served. A build counts against the budget
+until the transaction recording the new file has ended.
+"""
+
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = [
+    'BuildBudget',
+    'build_budget_from_settings',
+    ]
+
+
+class BuildBudget():
+    """
+    Limits the builds in progress to *size* at once, and each distinct key
+    to one at a time. Clients refused a build are asked to retry after
+    *retry_after* seconds.
+    """
+
+    def __init__(self, size=2, retry_after=10):
+        self.size = size
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._building = set()
+
+    @property
+    def building(self):
+        "The keys of the builds in progress"
+        with self._lock:
+            return set(self._building)
+
+    def admit(self, key):
+        """
+        Returns True, and starts a build of *key*, if the budget allows it.
+        Returns False if *key* is already being built or the budget is
+        exhausted. Every admitted build must be ended by :meth:`release`.
+        """
+        with self._lock:
+            if key in self._building or len(self._building) >= self.size:
+                return False
+            self._building.add(key)
+            return True
+
+    def release(self, key):
+        "Ends the build of *key*"
+        with self._lock:
+            self._building.discard(key)
+
+    def release_after(self, key, txn):
+        """
+        Ends the build of *key* when the transaction *txn* (which records the
+        built file) commits or aborts. Ending it any earlier would admit
+        requests that can't yet see the file, to build it again.
+        """
+        def release(*args):
+            self.release(key)
+        txn.addAfterCommitHook(release)
+        txn.addAfterAbortHook(release)
+
+
+def build_budget_from_settings(settings):
+    return BuildBudget(
+        size=int(settings.get('render.builds', 2)),
+        retry_after=int(settings.get('render.retry_after', 10)))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serves the static assets under fingerprinted URLs.
+
+Every URL generated by ``request.static_url`` carries a hash of the asset's
+content in its query string, so the URL changes whenever the asset does.
+Responses for such URLs can therefore be cached by clients "forever" (a year,
+marked immutable). Plain URLs without the fingerprint are still served, but
+with the usual short lifetime.
+
+If a gzip (``.gz``) or brotli (``.br``) compressed sibling of an asset exists
+(see :mod:`ratbot.scripts.buildassets`) and the client accepts that encoding,
+the sibling is served in place of the original.
+"""
+
+import io
+import os
+import hashlib
+import threading
+
+from pkg_resources import resource_filename
+from pyramid.events import NewResponse, subscriber
+from pyramid.response import FileIter
+from pyramid.static import QueryStringCacheBuster
+from pyramid.settings import asbool
+
+
+__all__ = [
+    'STATIC_DIR',
+    'STATIC_MAX_AGE',
+    'FINGERPRINT_MAX_AGE',
+    'FINGERPRINT_PARAM',
+    'ContentHashCacheBuster',
+    'includeme',
+    ]
+
+
+STATIC_DIR = resource_filename(__name__, 'static')
+
+# Lifetime of assets requested without a fingerprint
+STATIC_MAX_AGE = 3600
+
+# Lifetime of assets requested with a fingerprint
+FINGERPRINT_MAX_AGE = 365 * 24 * 60 * 60
+
+# Query parameter holding the fingerprint
+FINGERPRINT_PARAM = 'v'
+
+# Preferred order of the precompressed siblings
+ENCODINGS = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+    )
+
+
+class ContentHashCacheBuster(QueryStringCacheBuster):
+    """
+    Adds a hash of each asset's content to its URL. Hashes are calculated
+    once per asset per process; if *reload* is True (as in development), they
+    are re-calculated whenever an asset's modification time changes.
+    """
+
+    def __init__(self, reload=False):
+        super().__init__(param=FINGERPRINT_PARAM)
+        self.reload = reload
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def tokenize(self, request, subpath, kw):
+        filename = os.path.join(STATIC_DIR, subpath)
+        try:
+            mtime = os.stat(filename).st_mtime if self.reload else None
+        except OSError:
+            return ''
+        with self._lock:
+            try:
+                token, token_mtime = self._tokens[subpath]
+            except KeyError:
+                pass
+            else:
+                if token_mtime == mtime:
+                    return token
+        token = fingerprint(filename)
+        with self._lock:
+            self._tokens[subpath] = (token, mtime)
+        return token
+
+
+def fingerprint(filename):
+    "Returns a short hash of the content of *filename*"
+    h = hashlib.sha1()
+    with io.open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            h.update(block)
+    return h.hexdigest()[:12]
+
+
+def file_etag(stat, encoding=None):
+    "Returns an ETag for the file *stat* describes, served with *encoding*"
+    etag = '%x-%x' % (stat.st_mtime_ns, stat.st_size)
+    if encoding is not None:
+        etag += '-' + encoding
+    return etag
+
+
+@subscriber(NewResponse)
+def static_response(event):
+    request = event.request
+    response = event.response
+    route = request.matched_route
+    if route is None or route.name != '__static/' or response.status_int != 200:
+        return
+    if FINGERPRINT_PARAM in request.GET:
+        response.headers['Cache-Control'] = (
+            'public, max-age=%d, immutable' % FINGERPRINT_MAX_AGE)
+        response.expires = None
+    response.vary = tuple(set(response.vary or ()) | {'Accept-Encoding'})
+    if response.content_encoding is None:
+        filename = os.path.join(STATIC_DIR, *request.subpath)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return
+        for encoding, ext in ENCODINGS:
+            if encoding in request.accept_encoding:
+                try:
+                    f = io.open(filename + ext, 'rb')
+                except OSError:
+                    continue
+                if hasattr(response.app_iter, 'close'):
+                    response.app_iter.close()
+                response.app_iter = FileIter(f)
+                stat = os.fstat(f.fileno())
+                response.content_length = stat.st_size
+                response.content_encoding = encoding
+                break
+        # Each encoding is a different representation, so each gets its own
+        # ETag for caches and conditional requests to tell them apart
+        response.etag = file_etag(stat, response.content_encoding)
+
+
+def includeme(config):
+    """
+    Adds the static view, with fingerprinted URLs, to *config*.
+    """
+    # Assets are edited alongside the templates in development, so re-hash
+    # them whenever the templates are reloaded
+    reload = asbool(config.registry.settings.get('pyramid.reload_templates', False))
+    config.add_static_view('static', 'ratbot:static', cache_max_age=STATIC_MAX_AGE)
+    config.add_cache_buster('ratbot:static/', ContentHashCacheBuster(reload=reload))
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Provides a cache of the rendered reader pages served to anonymous users.
+
+The reader pages only change when an administrator edits something, or when a
+scheduled page is published. The cache is therefore invalidated wholesale
+whenever a transaction that changed a user, comic, issue or page commits, and
+each entry expires no later than the next scheduled publication.
+
+Entries are keyed by host, route, matchdict and the paging parameters, so
+arbitrary query strings can't flood the cache; requests carrying any other
+query parameters bypass it. Entries are held in a per-process memory tier
+and, if ``cache.dir`` is set, a shared on-disk tier (limited to
+``cache.disk_size`` entries) so that all worker processes benefit from each
+other's renders. The disk tier also carries the cache's "generation" between
+processes: invalidating the cache replaces the generation file, which every
+process checks before using an entry. Without ``cache.dir``, invalidations
+only reach the process that made the change and other processes rely on
+``cache.max_age`` to expire their entries.
+"""
+
+import os
+import io
+import json
+import time
+import errno
+import base64
+import hashlib
+import calendar
+import threading
+import logging
+log = logging.getLogger(__name__)
+from collections import OrderedDict, namedtuple
+
+from pyramid.response import Response
+from pyramid.interfaces import IRoutesMapper
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import object_session
+
+from .db_session import DBSession
+from .models import User, Comic, Issue, Page
+from .tweens import route_name
+from .sessions import session_cookie_name
+
+
+__all__ = [
+    'CACHED_ROUTES',
+    'CACHED_PARAMS',
+    'CachedResponse',
+    'ResponseCache',
+    'response_cache_from_settings',
+    'response_cache_tween_factory',
+    ]
+
+
+# The reader routes whose output is cached for anonymous users
+CACHED_ROUTES = {
+    'index',
+    'bio',
+    'comics',
+    'issues',
+    'page',
+    'blog_issue',
+    }
+
+# The query parameters which may vary the output of the cached routes (see
+# KeysetPager); requests with any other parameters aren't cached
+CACHED_PARAMS = {
+    'after',
+    'before',
+    }
+
+# The columns the derivative routes write as they generate files; the cached
+# pages don't depend on them, so changes to them alone don't invalidate the
+# cache
+DERIVATIVE_COLUMNS = {
+    Page:  {'_thumbnail', '_bitmap'},
+    Issue: {'_archive', '_pdf'},
+    }
+
+
+CachedResponse = namedtuple('CachedResponse', (
+    'generation', 'expires', 'status', 'headerlist', 'body'))
+
+
+def encode_entry(entry):
+    """
+    Returns *entry*, a :class:`CachedResponse`, encoded as JSON for the disk
+    tier. Entries are never pickled as anyone able to write to ``cache.dir``
+    could then run code in every worker.
+    """
+    return json.dumps({
+        'generation': entry.generation,
+        'expires':    entry.expires,
+        'status':     entry.status,
+        'headerlist': entry.headerlist,
+        'body':       base64.b64encode(entry.body).decode('ascii'),
+        }).encode('utf-8')
+
+
+def decode_entry(data):
+    """
+    Returns the :class:`CachedResponse` encoded in *data* by
+    :func:`encode_entry`, raising :exc:`ValueError` if it's malformed.
+    """
+    entry = json.loads(data.decode('utf-8'))
+    if not isinstance(entry, dict):
+        raise ValueError('cache entry is not an object')
+    generation = entry.get('generation')
+    if generation is not None:
+        if not (
+                isinstance(generation, list) and len(generation) == 2 and
+                all(isinstance(i, int) for i in generation)):
+            raise ValueError('invalid generation')
+        generation = tuple(generation)
+    expires = entry.get('expires')
+    if not isinstance(expires, (int, float)) or isinstance(expires, bool):
+        raise ValueError('invalid expiry')
+    status = entry.get('status')
+    if not isinstance(status, str):
+        raise ValueError('invalid status')
+    headerlist = entry.get('headerlist')
+    if not (
+            isinstance(headerlist, list) and
+            all(
+                isinstance(header, list) and len(header) == 2 and
+                all(isinstance(s, str) for s in header)
+                for header in headerlist)):
+        raise ValueError('invalid headers')
+    body = entry.get('body')
+    if not isinstance(body, str):
+        raise ValueError('invalid body')
+    return CachedResponse(
+        generation=generation,
+        expires=expires,
+        status=status,
+        headerlist=[tuple(header) for header in headerlist],
+        body=base64.b64decode(body.encode('ascii'), validate=True))
+
+
+class ResponseCache():
+    """
+    A two-tier cache of :class:`CachedResponse` tuples. The memory tier holds
+    up to *size* entries (evicting the least recently used), while the
+    optional disk tier under *path* holds up to *disk_size* entries (evicting
+    the least recently written) and is emptied on each invalidation. No entry
+    lives longer than *max_age* seconds.
+    """
+
+    def __init__(self, size=1000, max_age=300, path=None, disk_size=10000):
+        self.size = size
+        self.max_age = max_age
+        self.path = path
+        self.disk_size = disk_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._entries_generation = None
+        self._local_generation = 0
+        if path is not None:
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if not os.path.exists(self._generation_file):
+                self._write_generation()
+
+    @property
+    def _generation_file(self):
+        return os.path.join(self.path, 'generation')
+
+    def _entry_file(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache')
+
+    def _write_generation(self):
+        # Renaming a new file over the old one guarantees a new inode, which
+        # is what other processes notice in generation()
+        temp_file = self._generation_file + '.%d' % os.getpid()
+        with io.open(temp_file, 'w') as f:
+            f.write('%f\n' % time.time())
+        os.rename(temp_file, self._generation_file)
+
+    def generation(self):
+        """
+        Returns an opaque value which changes whenever the cache is
+        invalidated. Callers should obtain this before rendering a response,
+        and pass it to :meth:`set` to guarantee that a response rendered from
+        data that changed during the render is never stored.
+        """
+        if self.path is None:
+            return self._local_generation
+        try:
+            stat = os.stat(self._generation_file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def get(self, key, generation):
+        """
+        Returns the unexpired :class:`CachedResponse` for *key* from
+        *generation*, or None.
+        """
+        now = time.time()
+        with self._lock:
+            if generation != self._entries_generation:
+                self._entries.clear()
+                self._entries_generation = generation
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.path is not None:
+            try:
+                with io.open(self._entry_file(key), 'rb') as f:
+                    entry = decode_entry(f.read())
+            except FileNotFoundError:
+                pass
+            except Exception:
+                log.warning('Ignoring unreadable cache entry for %s', key)
+            else:
+                if entry.generation == generation and entry.expires > now:
+                    self._remember(key, entry)
+                else:
+                    entry = None
+        if entry is not None and entry.expires > now:
+            return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            if entry.generation != self._entries_generation:
+                self._entries.clear()
+                self._entries_generation = entry.generation
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def set(self, key, entry):
+        """
+        Stores *entry* under *key*, provided the cache hasn't been invalidated
+        since the entry's generation was obtained.
+        """
+        if entry.generation != self.generation():
+            return
+        self._remember(key, entry)
+        if self.path is not None:
+            entry_file = self._entry_file(key)
+            temp_file = entry_file + '.%d.%d' % (os.getpid(), threading.get_ident())
+            with io.open(temp_file, 'wb') as f:
+                f.write(encode_entry(entry))
+            os.rename(temp_file, entry_file)
+            self._evict()
+
+    def _evict(self):
+        # Entries are only written on a miss, so the cost of scanning the
+        # directory is small next to the render that preceded it
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.cache'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        if len(entries) > self.disk_size:
+            entries.sort()
+            for mtime, path in entries[:len(entries) - self.disk_size]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def invalidate(self):
+        """Discards every entry in the cache (in all processes)"""
+        with self._lock:
+            self._local_generation += 1
+            self._entries.clear()
+        if self.path is not None:
+            self._write_generation()
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.cache'):
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+
+def response_cache_from_settings(settings):
+    path = settings.get('cache.dir')
+    if path:
+        path = os.path.normpath(os.path.expanduser(path))
+    return ResponseCache(
+        size=int(settings.get('cache.size', 1000)),
+        max_age=int(settings.get('cache.max_age', 300)),
+        path=path or None,
+        disk_size=int(settings.get('cache.disk_size', 10000)))
+
+
+def cache_key(request):
+    """
+    Returns the cache key of *request*, or None if the request has query
+    parameters other than the :data:`CACHED_PARAMS` (and so mustn't be
+    cached). The key is built from the route the request matches rather than
+    its URL, so equivalent URLs share an entry.
+    """
+    if set(request.GET) - CACHED_PARAMS:
+        return None
+    info = request.registry.queryUtility(IRoutesMapper)(request)
+    return repr((
+        request.host_url,
+        info['route'].name,
+        sorted(info['match'].items()),
+        sorted(request.GET.items()),
+        ))
+
+
+def next_publication():
+    """
+    Returns the time (in seconds since the epoch) at which the next scheduled
+    page will be published, or None if nothing is scheduled.
+    """
+    published = DBSession.query(func.min(Page._published)).filter(
+        Page._published > func.current_timestamp()).scalar()
+    if published is not None:
+        # Timestamps are stored as naive UTC
+        return calendar.timegm(published.utctimetuple())
+
+
+def response_cache_tween_factory(handler, registry):
+    """
+    Serves GET and HEAD requests for the :data:`CACHED_ROUTES` from the
+    response cache in the registry, provided the request carries neither an
+    authentication nor a session cookie (sessions can hold flash messages,
+    which are rendered into every page).
+
+    This sits beneath the database tween so that entries can be stamped with
+    the next publication time within the request's transaction. Misses are
+    rendered from the primary rather than a replica: an entry stored under
+    the current generation must not be rendered from data that predates it,
+    which a lagging replica could otherwise provide.
+    """
+    cache = registry['response_cache']
+    private_cookies = {
+        session_cookie_name(registry.settings),
+        'auth_tkt',
+        }
+
+    def response_cache_tween(request):
+        if (
+                request.method not in ('GET', 'HEAD') or
+                private_cookies & set(request.cookies) or
+                route_name(request) not in CACHED_ROUTES):
+            return handler(request)
+        key = cache_key(request)
+        if key is None:
+            return handler(request)
+        generation = cache.generation()
+        entry = cache.get(key, generation)
+        if entry is not None:
+            return Response(
+                status=entry.status,
+                headerlist=list(entry.headerlist),
+                body=entry.body)
+        DBSession().info['replica'] = None
+        response = handler(request)
+        if (
+                request.method == 'GET' and
+                response.status_int == 200 and
+                response.content_type == 'text/html' and
+                'Set-Cookie' not in response.headers):
+            expires = time.time() + cache.max_age
+            published = next_publication()
+            if published is not None:
+                expires = min(expires, published)
+            cache.set(key, CachedResponse(
+                generation=generation,
+                expires=expires,
+                status=response.status,
+                headerlist=list(response.headerlist),
+                body=response.body))
+        return response
+
+    return response_cache_tween
+
+
+# Any change to the content of the site invalidates the cache when (and only
+# when) the transaction that made it commits
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+@event.listens_for(Comic, 'after_insert')
+@event.listens_for(Comic, 'after_update')
+@event.listens_for(Comic, 'after_delete')
+@event.listens_for(Issue, 'after_insert')
+@event.listens_for(Issue, 'after_delete')
+@event.listens_for(Page, 'after_insert')
+@event.listens_for(Page, 'after_delete')
+def changed_after_write(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['cache.changed'] = True
+
+@event.listens_for(Issue, 'after_update')
+@event.listens_for(Page, 'after_update')
+def changed_after_update(mapper, connection, target):
+    # The file routes update pages and issues as they generate derivatives,
+    # which mustn't wipe the cache at the busiest moment (just after a
+    # publication)
+    ignored = DERIVATIVE_COLUMNS[mapper.class_]
+    state = inspect(target)
+    if any(
+            state.attrs[attr.key].history.has_changes()
+            for attr in mapper.column_attrs
+            if attr.key not in ignored):
+        changed_after_write(mapper, connection, target)
+
+@event.listens_for(DBSession, 'after_rollback')
+def forget_after_rollback(session):
+    session.info.pop('cache.changed', None)
+
+@event.listens_for(DBSession, 'after_commit')
+def invalidate_after_commit(session):
+    if session.info.pop('cache.changed', False):
+        cache = session.info.get('response_cache')
+        if cache is not None:
+            cache.invalidate()
@@ -18,7 +18,9 @@
 # You should have received a copy of the GNU General Public License along with
 # ratbot comics. If not, see <http://www.gnu.org/licenses/>.
 
+from sqlalchemy import event
 from sqlalchemy.orm import (
+    Session,
     scoped_session,
     sessionmaker,
     relationship,
@@ -27,10 +29,36 @@ from sqlalchemy.orm import (
 from zope.sqlalchemy import register
 
 
-__all__ = ['DBSession']
+__all__ = ['DBSession', 'RoutingSession']
+
+
+class RoutingSession(Session):
+    """
+    A session which reads from the replica engine stored under the "replica"
+    key of its :attr:`info` (if any). Flushes, and everything else, go to the
+    primary engine the session is bound to. Once the session has flushed
+    anything the replica is dropped so that the remainder of the request
+    reads its own writes.
+    """
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, clause, **kw)
 
 
 # Global database session factory
-DBSession = scoped_session(sessionmaker())
+DBSession = scoped_session(sessionmaker(class_=RoutingSession))
 register(DBSession)
 
+
+@event.listens_for(DBSession, 'after_flush')
+def primary_after_flush(session, flush_context):
+    session.info['replica'] = None
+    session.info['wrote'] = True
+
+
+@event.listens_for(DBSession, 'after_begin')
+def read_only_after_begin(session, transaction, connection):
+    if session.info.get('read_only') and connection.dialect.name == 'postgresql':
+        connection.execute('SET TRANSACTION READ ONLY')
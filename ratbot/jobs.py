@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A durable queue of derivative files to be generated by separate render worker
+processes (see :mod:`ratbot.scripts.renderworkers`).
+
+When ``render.queue`` is enabled, saving a page queues jobs in the
+render_jobs table: a new vector queues its bitmap and thumbnail, a new bitmap
+(of a page without a vector) queues its thumbnail, and a page's publication
+date (or new source file) queues its issue's archive and PDF to run at the
+moment of publication. The views still render anything that isn't ready when
+it's requested; the queue simply means it usually is. The listeners which
+queue these jobs are registered whenever this module is imported (as the
+views do), but do nothing unless the session's info has ``render.queue`` set.
+
+Jobs are unique by their target, derivative and the version of the source
+they were queued for, so re-saving a page doesn't queue the same work twice.
+An issue's jobs are versioned by the publication they build for (see
+:func:`issue_version`), so publishing several pages together builds the issue
+once; issue files left stale by a later change of source are rebuilt by the
+views when next requested.
+Inserting jobs notifies the render_jobs channel, which wakes the workers
+LISTENing on it. Workers claim jobs with SELECT .. FOR UPDATE SKIP LOCKED,
+so any number of workers, on any number of machines, can share the queue.
+Failed jobs are retried with exponential back-off; jobs claimed by a worker
+that died are reclaimed once their lease expires (counting as an attempt, so
+a job which keeps killing its worker eventually fails).
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+from datetime import timedelta
+import logging
+log = logging.getLogger(__name__)
+
+import transaction
+from sqlalchemy import event, func, extract, select as sql_select, text, inspect
+from sqlalchemy.orm import object_session
+from zope.sqlalchemy import mark_changed
+
+from .models import DBSession, Page, Issue, RenderJob
+
+
+__all__ = [
+    'DERIVATIVES',
+    'CHANNEL',
+    'enqueue',
+    'issue_version',
+    'Worker',
+    ]
+
+
+# The derivatives which can be queued, and whether each belongs to a page
+DERIVATIVES = {
+    'bitmap':    True,
+    'thumbnail': True,
+    'archive':   False,
+    'pdf':       False,
+    }
+
+# The channel notified when jobs are queued
+CHANNEL = 'render_jobs'
+
+# The page_number of jobs for issues
+ISSUE_JOB = 0
+
+CLAIM_SQL = """
+UPDATE render_jobs SET
+    state = 'running',
+    attempts = attempts + 1,
+    started = current_timestamp,
+    worker = :worker
+WHERE job_id = (
+    SELECT job_id
+    FROM render_jobs
+    WHERE
+        (state = 'pending' AND run_after <= current_timestamp)
+        OR (
+            state = 'running'
+            AND started < current_timestamp - :lease * interval '1 second'
+            AND attempts < :max_attempts
+        )
+    ORDER BY run_after, job_id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING job_id, comic_id, issue_number, page_number, derivative, attempts
+"""
+
+# Jobs whose every attempt was abandoned (e.g. because rendering them killed
+# the worker) are failed rather than reclaimed forever
+ABANDON_SQL = """
+UPDATE render_jobs SET
+    state = 'failed',
+    finished = current_timestamp,
+    error = 'Abandoned by worker ' || coalesce(worker, '(unknown)')
+WHERE
+    state = 'running'
+    AND started < current_timestamp - :lease * interval '1 second'
+    AND attempts >= :max_attempts
+"""
+
+
+def enqueue(connection, comic_id, issue_number, page_number, derivative,
+        source_version, run_after=None):
+    """
+    Queues a job generating *derivative* of the specified page (or issue, if
+    *page_number* is 0) via *connection*, unless the same job has already been
+    queued for *source_version*. The job won't run before *run_after*.
+    """
+    assert derivative in DERIVATIVES
+    connection.execute(sql_select([func.enqueue_render_job(
+        comic_id, issue_number, page_number, derivative, source_version,
+        run_after)]))
+
+
+def issue_version(published):
+    """
+    Returns the source version of the jobs building an issue's files for the
+    publication at *published* (a naive UTC timestamp). Pages published
+    together share a version, so their issue is only built once.
+    """
+    return 'published %s' % published.isoformat()
+
+
+@event.listens_for(Page, 'after_insert')
+@event.listens_for(Page, 'after_update')
+def queue_page_jobs(mapper, connection, target):
+    session = object_session(target)
+    if session is None or not session.info.get('render.queue'):
+        return
+    state = inspect(target)
+    vector_changed = state.attrs._vector.history.has_changes()
+    bitmap_changed = state.attrs._bitmap.history.has_changes()
+    published_changed = state.attrs._published.history.has_changes()
+    if target.vector_filename and vector_changed:
+        source = os.path.basename(target.vector_filename)
+        enqueue(connection, target.comic_id, target.issue_number,
+            target.page_number, 'bitmap', source)
+        enqueue(connection, target.comic_id, target.issue_number,
+            target.page_number, 'thumbnail', source)
+    elif not target.vector_filename and target.bitmap_filename and bitmap_changed:
+        source = os.path.basename(target.bitmap_filename)
+        enqueue(connection, target.comic_id, target.issue_number,
+            target.page_number, 'thumbnail', source)
+    else:
+        source = None
+    if target._published is not None and (published_changed or source):
+        # The issue's files are rebuilt at the moment the page is published
+        version = issue_version(target._published)
+        for derivative in ('archive', 'pdf'):
+            enqueue(connection, target.comic_id, target.issue_number,
+                ISSUE_JOB, derivative, version, run_after=target._published)
+
+
+class Worker():
+    """
+    Runs the jobs in the queue until :attr:`terminated` is set. *engine* must
+    be a PostgreSQL engine, which DBSession is configured to use.
+
+    Jobs are attempted at most *max_attempts* times, waiting *backoff*
+    seconds after the first failure and twice as long after each subsequent
+    one. Jobs which have been running for more than *lease* seconds are
+    presumed abandoned and reclaimed, or failed if that was their last
+    attempt. Idle workers check the queue at least
+    every *poll* seconds, regardless of notifications.
+    """
+
+    def __init__(self, engine, name=None, max_attempts=5, backoff=30,
+            lease=600, poll=10, keep=timedelta(days=7)):
+        self.engine = engine
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll = poll
+        self.keep = keep
+        self.terminated = False
+        self._connection = None
+        self._listener = None
+        self._pruned = None
+
+    def listen(self):
+        # The listening connection is checked out of the pool for the life of
+        # the worker, in autocommit mode as notifications are only delivered
+        # between transactions
+        self._connection = self.engine.raw_connection()
+        self._listener = self._connection.connection
+        self._listener.autocommit = True
+        with self._listener.cursor() as cursor:
+            cursor.execute('LISTEN %s' % CHANNEL)
+
+    def claim(self):
+        "Claims the next due job, returning it or None if none are due"
+        params = {
+            'worker': self.name,
+            'lease': self.lease,
+            'max_attempts': self.max_attempts,
+            }
+        with transaction.manager:
+            DBSession.execute(text(ABANDON_SQL), params)
+            job = DBSession.execute(text(CLAIM_SQL), params).first()
+            mark_changed(DBSession())
+        return job
+
+    def run_job(self, job):
+        log.info(
+            'Worker %s rendering %s of %s/%d/%d (attempt %d)', self.name,
+            job.derivative, job.comic_id, job.issue_number, job.page_number,
+            job.attempts)
+        try:
+            with transaction.manager:
+                if DERIVATIVES[job.derivative]:
+                    target = DBSession.query(Page).get(
+                        (job.comic_id, job.issue_number, job.page_number))
+                else:
+                    target = DBSession.query(Issue).get(
+                        (job.comic_id, job.issue_number))
+                # The target may have been deleted since the job was queued,
+                # in which case there's nothing to do
+                if target is not None:
+                    getattr(target, 'create_' + job.derivative)()
+                self._finish(job, state='done')
+        except Exception as e:
+            log.exception('Worker %s failed job %d', self.name, job.job_id)
+            with transaction.manager:
+                if job.attempts >= self.max_attempts:
+                    self._finish(job, state='failed', error=str(e))
+                else:
+                    self._finish(
+                        job, state='pending', error=str(e),
+                        delay=self.retry_delay(job.attempts))
+
+    def retry_delay(self, attempts):
+        "Returns the seconds to wait before retrying a job after *attempts*"
+        return self.backoff * 2 ** (attempts - 1)
+
+    def _finish(self, job, state, error=None, delay=None):
+        values = {'state': state, 'error': error}
+        if state == 'pending':
+            values['run_after'] = func.current_timestamp() + timedelta(seconds=delay)
+            values['started'] = None
+        else:
+            values['finished'] = func.current_timestamp()
+        DBSession.execute(
+            RenderJob.__table__.update().
+            where(RenderJob.__table__.c.job_id == job.job_id).
+            values(**values))
+        mark_changed(DBSession())
+
+    def prune(self):
+        "Removes finished jobs older than *keep*, at most once an hour"
+        if self._pruned is None or time.monotonic() - self._pruned > 3600:
+            self._pruned = time.monotonic()
+            with transaction.manager:
+                DBSession.execute(
+                    RenderJob.__table__.delete().
+                    where(RenderJob.__table__.c.state == 'done').
+                    where(RenderJob.__table__.c.finished <
+                        func.current_timestamp() - self.keep))
+                mark_changed(DBSession())
+
+    def wait(self):
+        "Waits for a notification, or until the next scheduled job is due"
+        with transaction.manager:
+            due = DBSession.query(
+                extract('epoch', func.min(RenderJob.run_after) - func.current_timestamp())
+                ).filter(RenderJob.state == 'pending').scalar()
+        timeout = self.poll if due is None else max(0, min(self.poll, float(due)))
+        try:
+            select.select([self._listener], [], [], timeout)
+        except OSError as e:
+            # A signal (e.g. to terminate) interrupted the wait
+            if e.errno != errno.EINTR:
+                raise
+        self._listener.poll()
+        del self._listener.notifies[:]
+
+    def run(self):
+        self.listen()
+        log.info('Worker %s started', self.name)
+        while not self.terminated:
+            self.prune()
+            job = self.claim()
+            if job is None:
+                self.wait()
+            else:
+                self.run_job(job)
+        log.info('Worker %s stopped', self.name)
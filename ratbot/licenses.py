@@ -24,7 +24,10 @@ Provides a refreshable license repository.
 License information is sourced from opendefinition.org in JSON format. A
 routine is provided for construction a license factory from Paste style
 settings, and the resulting object can be refreshed from opendefinition.org at
-any time.  The license data is cached and only re-read weekly.
+any time.  The license data is cached and only re-read weekly. Refreshes
+happen in a background thread; until the first download completes a small
+bundled set of licenses is served instead so that no request ever waits on
+the network.
 """
 
 import os
@@ -32,11 +35,18 @@ import io
 import json
 import time
 import errno
+import threading
+import logging
+log = logging.getLogger(__name__)
+from types import MappingProxyType
 from datetime import datetime, timedelta
 from contextlib import closing
 from urllib.request import urlopen
 
+from pkg_resources import resource_filename
+
 from .locking import DirLock
+from .metrics import LICENSE_LOADS, LICENSE_DOWNLOADS
 
 
 __all__ = [
@@ -51,6 +61,10 @@ __all__ = [
 # links to a JSON database of all licenses with various attributes
 LICENSES_API_ALL = 'http://licenses.opendefinition.org/licenses/groups/all.json'
 
+# The bundled set of licenses served until a copy of the above has been
+# downloaded. This must include "notspecified", the default license of comics
+LICENSES_FALLBACK = resource_filename(__name__, 'licenses.json')
+
 
 class License():
     def __init__(self, **attr):
@@ -75,6 +89,14 @@ class License():
     def is_open(self):
         return self.is_od_compliant or self.is_osd_compliant
 
+    @classmethod
+    def unknown(cls, license_id):
+        """
+        Returns a stand-in for *license_id*, for when it isn't in the licenses
+        currently available (e.g. while the bundled fallback is served)
+        """
+        return cls(id=license_id, status='active', title=license_id)
+
 
 class DummyLicensesFactory():
     def __call__(self):
@@ -88,14 +110,30 @@ class DummyLicensesFactory():
 class LicensesFactory():
     """Factory class which returns a dictionary of licenses when called"""
 
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, url=LICENSES_API_ALL,
+            max_age=timedelta(days=7), retry=timedelta(minutes=10)):
         try:
             os.makedirs(cache_dir)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
+        self._url = url
+        self._max_age = max_age
+        self._retry = retry
         self._cache_file = os.path.join(cache_dir, 'all.json')
         self._cache_lock = DirLock(cache_dir)
+        # The parsed licenses are shared by all threads, and only re-parsed
+        # when the cache file is replaced (which _update_cache always does by
+        # renaming a new file over the old one, so the inode changes)
+        self._parsed_lock = threading.Lock()
+        self._parsed_key = None
+        self._parsed = None
+        # Only one background refresh runs at a time (per process; the
+        # DirLock above handles other processes), and failed refreshes aren't
+        # retried until the retry interval has passed
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_attempted = None
 
     def update_mandatory(self):
         """Guarantees to update the cache"""
@@ -110,41 +148,115 @@ class LicensesFactory():
             finally:
                 self._cache_lock.release()
 
+    def refresh(self):
+        """
+        Starts a background update of the cache, unless one is already
+        running or the last attempt was too recent. Never blocks.
+        """
+        with self._refresh_lock:
+            now = datetime.utcnow()
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            if (
+                    self._refresh_attempted is not None and
+                    self._refresh_attempted > now - self._retry):
+                return
+            self._refresh_attempted = now
+            self._refresh_thread = threading.Thread(
+                target=self._refresh, name='licenses-refresh')
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def _refresh(self):
+        try:
+            self.update_optional()
+        except Exception:
+            log.exception('Failed to refresh licenses from %s', self._url)
+
     def _update_cache(self):
         """Attempts to update the cache - should not be called directly"""
         # Download the new defs to a temoprary file
-        with io.open(self._cache_file + '.new', 'wb') as target:
-            with closing(urlopen(LICENSES_API_ALL, timeout=10)) as source:
-                while True:
-                    data = source.read(1024**2)
-                    if not data:
-                        break
-                    target.write(data)
-
-        # XXX Should validate the new cache file here
+        new_file = self._cache_file + '.new'
+        try:
+            with io.open(new_file, 'wb') as target:
+                with closing(urlopen(self._url, timeout=10)) as source:
+                    while True:
+                        data = source.read(1024**2)
+                        if not data:
+                            break
+                        target.write(data)
+            self._validate(new_file)
+        except Exception:
+            LICENSE_DOWNLOADS.inc('failed')
+            try:
+                os.unlink(new_file)
+            except FileNotFoundError:
+                # The failure happened before the file was created
+                pass
+            raise
+        LICENSE_DOWNLOADS.inc('succeeded')
         # Renames within the same file-system are atomic, i.e. everything that
         # attempts to read the cache before this gets the old file and
         # everything afterwards gets the new cache - no process gets a
         # partially written cache file
-        os.rename(self._cache_file + '.new', self._cache_file)
+        os.rename(new_file, self._cache_file)
+
+    def _validate(self, filename):
+        """
+        Raises ValueError if *filename* doesn't contain a license database that
+        __call__ can use
+        """
+        with io.open(filename, 'r') as source:
+            licenses = json.load(source)
+        if not isinstance(licenses, dict):
+            raise ValueError('licenses must be a JSON object')
+        if 'notspecified' not in licenses:
+            raise ValueError('licenses must include "notspecified"')
+        for license_id, value in licenses.items():
+            try:
+                license = License(**value)
+            except (TypeError, KeyError) as e:
+                raise ValueError('invalid license %s: %s' % (license_id, e))
+            if license.id != license_id:
+                raise ValueError(
+                    'license %s has mismatched id %s' % (license_id, license.id))
+
+    def _load(self, filename):
+        """Returns the parsed *filename*, re-parsing it only if it has changed"""
+        with io.open(filename, 'r') as source:
+            stat = os.fstat(source.fileno())
+            key = (filename, stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+            with self._parsed_lock:
+                if key != self._parsed_key:
+                    LICENSE_LOADS.inc()
+                    self._parsed = MappingProxyType({
+                        license_id: License(**value)
+                        for (license_id, value) in json.load(source).items()
+                        })
+                    self._parsed_key = key
+                return self._parsed
 
     def __call__(self):
-        """Return a dictionary of License instances keyed by id"""
-        if not os.path.exists(self._cache_file):
-            # If the cache file doesn't exist we must create it in order to
-            # return any results
-            self.update_mandatory()
-        elif (datetime.utcfromtimestamp(os.stat(self._cache_file).st_mtime) <
-                (datetime.now() - timedelta(days=7))):
-            # If the cache file is merely stale we'll attempt to get a lock and
-            # update it, but if we can't get a lock just use the stale file
-            self.update_optional()
-        return {
-            key: License(**value)
-            for (key, value) in json.load(io.open(self._cache_file, 'r')).items()
-            }
+        """
+        Return a read-only mapping of License instances keyed by id. The
+        mapping is shared between threads and calls until the cache file
+        changes.
+        """
+        try:
+            stat = os.stat(self._cache_file)
+        except FileNotFoundError:
+            # Until the cache has been downloaded, serve the bundled licenses
+            self.refresh()
+            return self._load(LICENSES_FALLBACK)
+        if datetime.utcfromtimestamp(stat.st_mtime) < datetime.utcnow() - self._max_age:
+            # If the cache file is merely stale, refresh it in the background
+            # and use the stale file in the meantime
+            self.refresh()
+        return self._load(self._cache_file)
 
 
 def licenses_factory_from_settings(settings):
-    return LicensesFactory(settings['licenses.cache_dir'])
-
+    return LicensesFactory(
+        settings['licenses.cache_dir'],
+        url=settings.get('licenses.url', LICENSES_API_ALL),
+        max_age=timedelta(days=int(settings.get('licenses.max_age', 7))))
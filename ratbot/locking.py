@@ -23,9 +23,33 @@
 # SOFTWARE.
 
 import os
+import sys
 import errno
 import time
 import threading
+import weakref
+import traceback
+import logging
+log = logging.getLogger(__name__)
+
+from .metrics import (
+    LOCK_WAIT_SECONDS,
+    LOCK_HOLD_SECONDS,
+    LOCK_HOLDERS,
+    LOCK_WAITERS,
+    )
+
+
+class LockTimeout(RuntimeError):
+    "Raised when a lock with a timeout can't be acquired by a with statement"
+
+
+def _remaining(deadline):
+    # Converts an absolute *deadline* to the timeout argument of
+    # Lock.acquire; None means no deadline
+    if deadline is None:
+        return -1
+    return max(0, deadline - time.monotonic())
 
 
 class Switch():
@@ -49,11 +73,28 @@ class Switch():
         self._lock = lock
         self._mutex = threading.Lock()
 
-    def acquire(self):
-        with self._mutex:
+    @property
+    def count(self):
+        "The number of threads which have acquired the switch"
+        return self._counter
+
+    def acquire(self, timeout=-1):
+        """
+        Acquire the switch, waiting at most *timeout* seconds (forever if
+        negative). Returns True if the switch was acquired.
+        """
+        deadline = None if timeout < 0 else time.monotonic() + timeout
+        if not self._mutex.acquire(timeout=_remaining(deadline)):
+            return False
+        try:
             self._counter += 1
             if self._counter == 1:
-                self._lock.acquire()
+                if not self._lock.acquire(timeout=_remaining(deadline)):
+                    self._counter -= 1
+                    return False
+            return True
+        finally:
+            self._mutex.release()
 
     def release(self):
         with self._mutex:
@@ -90,7 +131,18 @@ class SELock():
     modification: adding an additional lock (readers_queue), in accordance with
     [2]_. The implementation provides two objects, ``shared`` and ``exclusive``
     which each support the context manager protocol along with the usual
-    acquire and release methods.
+    acquire and release methods. Their acquire methods accept a *timeout*
+    and return False if it expires. If *timeout* is specified here, the with
+    statement waits at most that long and raises :exc:`LockTimeout` if it
+    expires.
+
+    If *name* is specified, the time spent waiting for, and holding, each
+    side of the lock, and the number of threads currently waiting for and
+    holding each side, are recorded in the lock metrics under that name.
+    Waits longer than *warn_after* seconds (if specified) are logged along
+    with :meth:`dump`. The threads currently holding and waiting for the lock
+    are tracked regardless, in :attr:`readers`, :attr:`writers` and
+    :meth:`dump`; the dumps of all locks are served from ``/metrics/locks``.
 
     .. [1] A.B. Downey: "The little book of semaphores", Version 2.1.5, 2008
     .. [2] P.J. Courtois, F. Heymans, D.L. Parnas:
@@ -99,31 +151,163 @@ class SELock():
     .. [3] http://en.wikipedia.org/wiki/Readers-writers_problem
     """
 
-    def __init__(self):
+    _instances = weakref.WeakSet()
+
+    def __init__(self, name=None, timeout=None, warn_after=None):
         no_readers = threading.Lock()
         no_writers = threading.Lock()
         read_switch = Switch(no_writers)
         write_switch = Switch(no_readers)
-        self.shared = _SharedLock(no_readers, read_switch)
-        self.exclusive = _ExclusiveLock(no_writers, write_switch)
+        self.name = name
+        self.timeout = timeout
+        self.warn_after = warn_after
+        self._state_lock = threading.Lock()
+        # Maps (thread ident, mode) to a list of the monotonic times at which
+        # that thread started waiting for, or acquired, that side of the lock
+        self._waiting = {}
+        self._holding = {}
+        self.shared = _SharedLock(self, no_readers, read_switch)
+        self.exclusive = _ExclusiveLock(self, no_writers, write_switch)
+        SELock._instances.add(self)
+
+    @classmethod
+    def instances(cls):
+        "Returns all the locks in existence"
+        return list(cls._instances)
+
+    @property
+    def readers(self):
+        "The number of threads holding the lock shared"
+        with self._state_lock:
+            return sum(
+                len(times) for ((ident, mode), times) in self._holding.items()
+                if mode == 'shared')
+
+    @property
+    def writers(self):
+        "The number of threads holding the lock exclusively (0 or 1)"
+        with self._state_lock:
+            return sum(
+                len(times) for ((ident, mode), times) in self._holding.items()
+                if mode == 'exclusive')
+
+    def dump(self):
+        """
+        Returns a description of the threads holding and waiting for the
+        lock, including the current stack of each
+        """
+        now = time.monotonic()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        lines = ['SELock %s' % (self.name or hex(id(self)))]
+        with self._state_lock:
+            threads = [
+                (state, ident, mode, since)
+                for (state, entries) in (
+                    ('holding', self._holding), ('waiting', self._waiting))
+                for ((ident, mode), times) in entries.items()
+                for since in times
+                ]
+        for state, ident, mode, since in threads:
+            lines.append('  %s %s for %.3fs: thread %s (%d)' % (
+                state, mode, now - since, names.get(ident, '?'), ident))
+            if ident in frames:
+                lines.extend(
+                    '    ' + line
+                    for line in ''.join(
+                        traceback.format_stack(frames[ident])).splitlines())
+        return '\n'.join(lines)
+
+    def _wait(self, mode):
+        ident = threading.get_ident()
+        start = time.monotonic()
+        with self._state_lock:
+            self._waiting.setdefault((ident, mode), []).append(start)
+        if self.name:
+            LOCK_WAITERS.inc(self.name, mode)
+        return start
+
+    def _acquired(self, mode, start, acquired):
+        ident = threading.get_ident()
+        now = time.monotonic()
+        with self._state_lock:
+            times = self._waiting[(ident, mode)]
+            times.remove(start)
+            if not times:
+                del self._waiting[(ident, mode)]
+            if acquired:
+                self._holding.setdefault((ident, mode), []).append(now)
+        if self.name:
+            LOCK_WAIT_SECONDS.observe(now - start, self.name, mode)
+            LOCK_WAITERS.dec(self.name, mode)
+            if acquired:
+                LOCK_HOLDERS.inc(self.name, mode)
+        if self.warn_after is not None and now - start > self.warn_after:
+            log.warning(
+                'Waited %.3fs for %s lock (%s)\n%s', now - start, mode,
+                'acquired' if acquired else 'timed out', self.dump())
+
+    def _released(self, mode):
+        ident = threading.get_ident()
+        now = time.monotonic()
+        with self._state_lock:
+            key = (ident, mode)
+            if key not in self._holding:
+                # Released by a different thread to the one that acquired it;
+                # attribute the release to the longest holder
+                holders = [key for key in self._holding if key[1] == mode]
+                if not holders:
+                    return
+                key = min(holders, key=lambda key: self._holding[key][0])
+            times = self._holding[key]
+            since = times.pop()
+            if not times:
+                del self._holding[key]
+        if self.name:
+            LOCK_HOLD_SECONDS.observe(now - since, self.name, mode)
+            LOCK_HOLDERS.dec(self.name, mode)
+
+    def _enter(self, side):
+        if not side.acquire(-1 if self.timeout is None else self.timeout):
+            raise LockTimeout(
+                'Timed out after %.3fs acquiring %s\n%s' % (
+                    self.timeout, side, self.dump()))
 
 
 class _SharedLock():
-    def __init__(self, no_readers, read_switch):
+    def __init__(self, owner, no_readers, read_switch):
+        self._owner = owner
         self._no_readers = no_readers
         self._read_switch = read_switch
         self._readers_queue = threading.Lock()
 
-    def acquire(self):
-        with self._readers_queue:
-            with self._no_readers:
-                self._read_switch.acquire()
+    def __repr__(self):
+        return '<shared side of %s>' % (self._owner.name or 'SELock')
+
+    def acquire(self, timeout=-1):
+        start = self._owner._wait('shared')
+        acquired = False
+        try:
+            deadline = None if timeout < 0 else start + timeout
+            if self._readers_queue.acquire(timeout=_remaining(deadline)):
+                try:
+                    if self._no_readers.acquire(timeout=_remaining(deadline)):
+                        try:
+                            acquired = self._read_switch.acquire(_remaining(deadline))
+                        finally:
+                            self._no_readers.release()
+                finally:
+                    self._readers_queue.release()
+        finally:
+            self._owner._acquired('shared', start, acquired)
+        return acquired
 
     def release(self):
+        self._owner._released('shared')
         self._read_switch.release()
 
     def __enter__(self):
-        self.acquire()
+        self._owner._enter(self)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -131,20 +315,35 @@ class _SharedLock():
 
 
 class _ExclusiveLock():
-    def __init__(self, no_writers, write_switch):
+    def __init__(self, owner, no_writers, write_switch):
+        self._owner = owner
         self._no_writers = no_writers
         self._write_switch = write_switch
 
-    def acquire(self):
-        self._write_switch.acquire()
-        self._no_writers.acquire()
+    def __repr__(self):
+        return '<exclusive side of %s>' % (self._owner.name or 'SELock')
+
+    def acquire(self, timeout=-1):
+        start = self._owner._wait('exclusive')
+        acquired = False
+        try:
+            deadline = None if timeout < 0 else start + timeout
+            if self._write_switch.acquire(_remaining(deadline)):
+                if self._no_writers.acquire(timeout=_remaining(deadline)):
+                    acquired = True
+                else:
+                    self._write_switch.release()
+        finally:
+            self._owner._acquired('exclusive', start, acquired)
+        return acquired
 
     def release(self):
+        self._owner._released('exclusive')
         self._no_writers.release()
         self._write_switch.release()
 
     def __enter__(self):
-        self.acquire()
+        self._owner._enter(self)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -18,41 +18,42 @@
 # You should have received a copy of the GNU General Public License along with
 # ratbot comics. If not, see <http://www.gnu.org/licenses/>.
 
-import bleach
+import importlib
+import importlib.util
+
 import webhelpers2
 import webhelpers2.html.builder
-import webhelpers2.html.tools
 
 MARKUP_LANGUAGES = {
     'text':    'Plain Text',
     'html':    'HTML',
     }
 
-try:
-    import markdown
-    MARKUP_LANGUAGES['md'] = 'MarkDown'
-except ImportError:
-    pass
+# The modules required by each optional markup language. These are only
+# imported when something is first rendered (or by preload); their
+# availability is determined without importing them
+MARKUP_MODULES = {
+    'md':      ('markdown',),
+    'rst':     ('docutils', 'docutils.core'),
+    'creole':  ('creole', 'creole.html_emitter'),
+    'textile': ('textile',),
+    }
 
-try:
-    import docutils
-    import docutils.core
-    MARKUP_LANGUAGES['rst'] = 'reStructuredText'
-except ImportError:
-    pass
+def available(module):
+    "Returns True if *module* can be imported, without importing it"
+    try:
+        return importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        return False
 
-try:
-    import creole
-    import creole.html_emitter
+if available('markdown'):
+    MARKUP_LANGUAGES['md'] = 'MarkDown'
+if available('docutils'):
+    MARKUP_LANGUAGES['rst'] = 'reStructuredText'
+if available('creole'):
     MARKUP_LANGUAGES['creole'] = 'Creole'
-except ImportError:
-    pass
-
-try:
-    import textile
+if available('textile'):
     MARKUP_LANGUAGES['textile'] = 'Textile'
-except ImportError:
-    pass
 
 ALLOWED_TAGS = set((
     'a', 'abbr', 'acronym', 'address', 'b', 'big', 'blockquote', 'br',
@@ -130,17 +131,44 @@ ALLOWED_ATTRS = {
     'ul'         : LIST_ATTRS,
 }
 
+def preload():
+    """
+    Imports bleach and all available markup engines. If this is called
+    before a server forks its workers (see "site.preload"), they'll share the
+    imported modules copy-on-write.
+    """
+    import bleach
+    import webhelpers2.html.tools
+    for language in MARKUP_LANGUAGES:
+        for module in MARKUP_MODULES.get(language, ()):
+            importlib.import_module(module)
+
+def cached(html, language=None, source=None):
+    """
+    Marks *html*, the output of a prior call to :func:`render` which has been
+    stored in the database, as safe for inclusion in a template. If *html* is
+    None (the row hasn't been rendered since upgrading), *source* is rendered
+    in *language* instead.
+    """
+    if html is None:
+        return render(language or 'html', source or '')
+    return webhelpers2.html.builder.literal(html)
+
 def render(language, source):
+    import bleach
     if language == 'text':
-        html = bleach.linkify(
-            webhelpers2.html.tools.text_to_html(source))
+        from webhelpers2.html.tools import text_to_html
+        html = bleach.linkify(text_to_html(source))
     elif language == 'html':
         html = source
     elif language == 'md':
+        import markdown
         html = markdown.markdown(source)
     elif language == 'textile':
+        import textile
         html = textile.textile(source)
     elif language == 'rst':
+        import docutils.core
         overrides = {
             'input_encoding':       'unicode',
             'doctitle_xform':       False,
@@ -150,6 +178,8 @@ def render(language, source):
                 source=source, writer_name='html',
                 settings_overrides=overrides)['fragment']
     elif language == 'creole':
+        import creole
+        import creole.html_emitter
         html = creole.html_emitter.HtmlEmitter(
                 creole.Parser(source).parse()).emit()
     else:
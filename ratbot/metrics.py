@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collects internal metrics, and serves them in the Prometheus text format from
+``/metrics``.
+
+Metrics are always collected; each observation is a dict update under a lock
+so they're cheap enough to leave on. The endpoint (and ``/metrics/locks``, which
+describes the threads holding and waiting for each lock of the process that
+answers) is only served if ``metrics.enabled`` is set, to the addresses in ``metrics.hosts`` (by
+default, localhost) and, if ``metrics.token`` is set, only to requests
+carrying it as a bearer token. Note that behind a reverse proxy on the same
+machine every request appears to come from localhost, so such deployments
+must set ``metrics.token`` (or block /metrics at the proxy).
+
+Each process collects its own metrics. If ``metrics.dir`` is set, every
+process writes a snapshot of its metrics to ``<pid>.json`` in that directory
+each ``metrics.interval`` seconds (and on exit), and the endpoint serves the
+sum of all the snapshots, so it doesn't matter which worker answers the
+scrape. The snapshots of processes which have exited are folded into
+``retired.json`` and removed, so counters never go backwards and a new
+process which reuses a pid doesn't overwrite the counts of the old one.
+"""
+
+import io
+import os
+import hmac
+import json
+import fcntl
+import atexit
+import bisect
+import threading
+import logging
+log = logging.getLogger(__name__)
+
+from pyramid.events import NewRequest
+from pyramid.settings import asbool
+from pyramid.response import Response
+from pyramid.httpexceptions import HTTPNotFound
+
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'REGISTRY',
+    'RENDERS',
+    'FILE_REQUESTS',
+    'SWEEP_SECONDS',
+    'SWEEP_FILES',
+    'LOCK_WAIT_SECONDS',
+    'LOCK_HOLD_SECONDS',
+    'LOCK_HOLDERS',
+    'LOCK_WAITERS',
+    'LICENSE_LOADS',
+    'LICENSE_DOWNLOADS',
+    'REQUEST_DB_SECONDS',
+    'REQUEST_QUERIES',
+    'snapshot',
+    'exposition',
+    'includeme',
+    ]
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket bounds for durations, in seconds
+DURATION_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Bucket bounds for counts of things
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# All metrics, in the order they're served
+REGISTRY = []
+
+
+class Counter():
+    """
+    A monotonically increasing value, with optional *labels*. Label values
+    are passed positionally to :meth:`inc`.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        assert len(labels) == len(self.labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return {labels: value for (labels, value) in self._values.items()}
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, labels)), value
+
+
+class Gauge(Counter):
+    """
+    A value which can go up (with :meth:`inc`) and down (with :meth:`dec`),
+    with optional *labels*. The gauges of processes which have exited are
+    discarded rather than retired.
+    """
+    type = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Counter):
+    """
+    Counts observations into cumulative *buckets*, with optional *labels*.
+    Label values are passed positionally to :meth:`observe` after the
+    observed value.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        assert len(labels) == len(self.labels)
+        with self._lock:
+            try:
+                counts = self._values[labels]
+            except KeyError:
+                # One count per bucket, plus the +Inf bucket, the sum, and the
+                # total count
+                counts = self._values[labels] = [0] * (len(self.buckets) + 3)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def values(self):
+        with self._lock:
+            return {labels: list(counts) for (labels, counts) in self._values.items()}
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for (x, y) in zip(a, b)]
+
+    def samples(self, values):
+        for labels, counts in sorted(values.items()):
+            labels = dict(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=str(bound)), cumulative
+            yield self.name + '_sum', labels, counts[-2]
+            yield self.name + '_count', labels, counts[-1]
+
+
+RENDERS = Histogram(
+    'ratbot_render_seconds',
+    'Time spent rendering derivative files',
+    labels=('derivative',))
+FILE_REQUESTS = Counter(
+    'ratbot_file_requests_total',
+    'Requests for derivative files, by whether the file had to be rendered '
+    '(cold), already existed (warm), or was deferred by the build budget '
+    '(deferred)',
+    labels=('route', 'state'))
+SWEEP_SECONDS = Histogram(
+    'ratbot_sweep_seconds',
+    'Time spent by the files thread sweeping the files directory')
+SWEEP_FILES = Counter(
+    'ratbot_sweep_files_total',
+    'Files scanned and deleted by the files thread',
+    labels=('action',))
+LOCK_WAIT_SECONDS = Histogram(
+    'ratbot_lock_wait_seconds',
+    'Time spent waiting to acquire named locks',
+    labels=('lock', 'mode'))
+LOCK_HOLD_SECONDS = Histogram(
+    'ratbot_lock_hold_seconds',
+    'Time spent holding named locks',
+    labels=('lock', 'mode'))
+LOCK_HOLDERS = Gauge(
+    'ratbot_lock_holders',
+    'Threads currently holding named locks',
+    labels=('lock', 'mode'))
+LOCK_WAITERS = Gauge(
+    'ratbot_lock_waiters',
+    'Threads currently waiting for named locks',
+    labels=('lock', 'mode'))
+LICENSE_LOADS = Counter(
+    'ratbot_license_loads_total',
+    'Parses of the license database (each reload of the cache)')
+LICENSE_DOWNLOADS = Counter(
+    'ratbot_license_downloads_total',
+    'Downloads of the license database',
+    labels=('result',))
+REQUEST_DB_SECONDS = Histogram(
+    'ratbot_request_db_seconds',
+    'Time spent executing SQL per request',
+    labels=('route',))
+REQUEST_QUERIES = Histogram(
+    'ratbot_request_queries',
+    'SQL statements executed per request',
+    labels=('route',), buckets=COUNT_BUCKETS)
+
+
+def _encode(labels):
+    return '\x1f'.join(labels)
+
+
+def _decode(key):
+    return tuple(key.split('\x1f')) if key else ()
+
+
+def snapshot():
+    """
+    Returns the metrics of this process as a JSON-serializable dict.
+    """
+    return {
+        metric.name: {
+            _encode(labels): value
+            for (labels, value) in metric.values().items()
+            }
+        for metric in REGISTRY
+        }
+
+
+def merge_snapshots(a, b):
+    """
+    Returns the sum of the snapshots *a* and *b* (as returned by
+    :func:`snapshot`).
+    """
+    metrics = {metric.name: metric for metric in REGISTRY}
+    result = {name: dict(values) for (name, values) in a.items()}
+    for name, values in b.items():
+        target = result.setdefault(name, {})
+        for key, value in values.items():
+            if key in target and name in metrics:
+                target[key] = metrics[name].merge(target[key], value)
+            else:
+                target[key] = value
+    return result
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def exposition(snapshots):
+    """
+    Returns the sum of the *snapshots* (as returned by :func:`snapshot`) in
+    the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        values = {}
+        for snap in snapshots:
+            for key, value in snap.get(metric.name, {}).items():
+                labels = _decode(key)
+                if labels in values:
+                    values[labels] = metric.merge(values[labels], value)
+                else:
+                    values[labels] = value
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric.samples(values):
+            if labels:
+                lines.append('%s{%s} %s' % (name, ','.join(
+                    '%s="%s"' % (label, _escape(label_value))
+                    for (label, label_value) in sorted(labels.items())),
+                    repr(float(value))))
+            else:
+                lines.append('%s %s' % (name, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Periodically writes the snapshot of the process that started it to a file
+    named after its pid in *path*.
+    """
+    def __init__(self, path, interval):
+        super().__init__(name='metrics-writer')
+        self.daemon = True
+        self.pid = os.getpid()
+        self.path = path
+        self.interval = interval
+        self._event = threading.Event()
+        # Any snapshot under our pid was left by an earlier process
+        self.retire({self.pid})
+        atexit.register(self.stop)
+        self.start()
+
+    @property
+    def _retired_file(self):
+        return os.path.join(self.path, 'retired.json')
+
+    def _lock(self):
+        # Held while retiring snapshots, and while reading them so a reader
+        # never sees a snapshot both in retired.json and under its pid
+        f = io.open(os.path.join(self.path, 'lock'), 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _load(self, filename):
+        try:
+            with io.open(filename, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # The snapshot vanished, or was half-written by a process which
+            # crashed; skip it
+            return None
+
+    def retire(self, pids=()):
+        """
+        Folds the snapshots of exited processes (and of *pids*) into
+        retired.json, and removes them.
+        """
+        gauges = {metric.name for metric in REGISTRY if metric.type == 'gauge'}
+        with self._lock():
+            retired = self._load(self._retired_file) or {}
+            removed = []
+            for name in os.listdir(self.path):
+                if name.endswith('.json') and name[:-5].isdigit():
+                    pid = int(name[:-5])
+                    if pid in pids or not _pid_alive(pid):
+                        filename = os.path.join(self.path, name)
+                        snap = self._load(filename)
+                        if snap is not None:
+                            retired = merge_snapshots(retired, {
+                                name: values
+                                for (name, values) in snap.items()
+                                if name not in gauges
+                                })
+                        removed.append(filename)
+            if removed:
+                with io.open(self._retired_file + '.new', 'w') as f:
+                    json.dump(retired, f)
+                os.rename(self._retired_file + '.new', self._retired_file)
+                for filename in removed:
+                    os.unlink(filename)
+
+    def run(self):
+        while not self._event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        filename = os.path.join(self.path, '%d.json' % self.pid)
+        try:
+            with io.open(filename + '.new', 'w') as f:
+                json.dump(snapshot(), f)
+            os.rename(filename + '.new', filename)
+        except OSError:
+            log.exception('Failed to write metrics to %s', filename)
+
+    def read(self):
+        self.retire()
+        with self._lock():
+            return [
+                snap
+                for snap in (
+                    self._load(os.path.join(self.path, name))
+                    for name in os.listdir(self.path)
+                    if name.endswith('.json')
+                    )
+                if snap is not None
+                ]
+
+    def stop(self):
+        # Only the process which started the writer may write its snapshot
+        if self.pid == os.getpid():
+            self._event.set()
+            self.write()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def snapshot_writer(path, interval):
+    """
+    Returns the :class:`SnapshotWriter` of the calling process, starting it
+    if necessary. Writers are started on demand (rather than when the
+    application is loaded) as servers may load the application and then fork
+    their workers.
+    """
+    global _writer
+    pid = os.getpid()
+    writer = _writer
+    if writer is None or writer.pid != pid:
+        with _writer_lock:
+            if _writer is None or _writer.pid != pid:
+                _writer = SnapshotWriter(path, interval)
+            writer = _writer
+    return writer
+
+
+def includeme(config):
+    """
+    Adds the metrics endpoint to *config*, if ``metrics.enabled`` is set.
+    """
+    settings = config.registry.settings
+    if not asbool(settings.get('metrics.enabled', False)):
+        return
+    hosts = set(settings.get('metrics.hosts', '127.0.0.1 ::1').split())
+    token = settings.get('metrics.token')
+    path = settings.get('metrics.dir')
+    interval = int(settings.get('metrics.interval', 10))
+    if path:
+        path = os.path.normpath(os.path.expanduser(path))
+        os.makedirs(path, exist_ok=True)
+
+        def start_writer(event):
+            snapshot_writer(path, interval)
+
+        config.add_subscriber(start_writer, NewRequest)
+
+    def check_access(request):
+        if request.remote_addr not in hosts:
+            raise HTTPNotFound()
+        if token:
+            try:
+                scheme, credentials = request.authorization
+            except (TypeError, ValueError):
+                raise HTTPNotFound()
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(
+                    credentials.encode('utf-8'), token.encode('utf-8')):
+                raise HTTPNotFound()
+
+    def metrics_view(request):
+        check_access(request)
+        if path:
+            writer = snapshot_writer(path, interval)
+            writer.write()
+            snapshots = writer.read()
+        else:
+            snapshots = [snapshot()]
+        response = Response(exposition(snapshots).encode('utf-8'))
+        response.headers['Content-Type'] = CONTENT_TYPE
+        response.cache_control = 'no-cache'
+        return response
+
+    def locks_view(request):
+        # The locks are per process, so this only describes the process
+        # which happens to answer the request
+        check_access(request)
+        from .locking import SELock
+        response = Response('\n\n'.join(
+            ['Process %d' % os.getpid()] +
+            [lock.dump() for lock in SELock.instances()]
+            ).encode('utf-8'))
+        response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        response.cache_control = 'no-cache'
+        return response
+
+    config.add_route('metrics', '/metrics')
+    config.add_view(metrics_view, route_name='metrics')
+    config.add_route('metrics_locks', '/metrics/locks')
+    config.add_view(locks_view, route_name='metrics_locks')
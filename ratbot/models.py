@@ -22,6 +22,7 @@ import io
 import os
 import os.path
 import sys
+import time
 import tempfile
 import shutil
 import threading
@@ -30,17 +31,11 @@ import logging
 from datetime import datetime
 from contextlib import closing
 from collections import deque
+from functools import lru_cache, wraps
 log = logging.getLogger(__name__)
 
-import gi
-gi.require_version('Rsvg', '2.0')
 import pytz
-import cairo
 import transaction
-from gi.repository import Rsvg
-from PIL import Image
-from PyPDF2 import PdfFileWriter, PdfFileReader
-from PyPDF2.generic import NameObject, createStringObject
 from sqlalchemy import (
     Table,
     ForeignKey,
@@ -51,10 +46,16 @@ from sqlalchemy import (
     func,
     event,
     text,
+    select,
+    inspect,
     )
 from sqlalchemy.types import (
+    Boolean,
+    BigInteger,
+    DateTime,
     Integer,
     Unicode,
+    UnicodeText,
     )
 from sqlalchemy.orm import (
     relationship,
@@ -64,14 +65,19 @@ from sqlalchemy.orm.exc import (
     NoResultFound,
     MultipleResultsFound,
     )
+from sqlalchemy.exc import NoSuchTableError
 from sqlalchemy.schema import FetchedValue
 from sqlalchemy.ext.declarative import declarative_base
 from pyramid.decorator import reify
 from pyramid.threadlocal import get_current_registry
+from zope.sqlalchemy import mark_changed
 
 from .licenses import License
+from .markup import render as render_markup
 from .zip import ZipFile, ZIP_STORED
 from .locking import SELock
+from .metrics import RENDERS, SWEEP_SECONDS, SWEEP_FILES
+from .slowlog import phase
 from .db_session import DBSession
 
 
@@ -83,13 +89,19 @@ __all__ = [
     'Issue',
     'Page',
     'User',
+    'RenderJob',
     'utcnow',
+    'verify_schema',
+    'preload',
+    'verify_schema_on_connect',
     ]
 
 
-# SQLAlchemy mapper base class
+# SQLAlchemy mapper base class. The tables below are defined explicitly
+# (following sql/create.sql) rather than reflected so that the models can be
+# imported without a database connection; see verify_schema for the check
+# that they still match the database
 Base = declarative_base()
-Base.metadata.reflect(DBSession.get_bind(), views=True)
 
 # Horizontal size to render bitmaps of a vector
 BITMAP_WIDTH = 900
@@ -98,14 +110,35 @@ BITMAP_WIDTH = 900
 # backing storage
 SPOOL_LIMIT = 1024*1024
 
+# Seconds the files thread waits for the files lock before postponing a sweep
+SWEEP_LOCK_TIMEOUT = 0.5
+
+# Waits for the files lock longer than this many seconds are logged, along
+# with the threads holding it
+FILES_LOCK_WARNING = 5
+
 # Maximum size of a page thumbnail
 THUMB_SIZE = (200, 300)
 
-def create_mask():
+# The rendering libraries below are only imported when first used (or by
+# preload) as most workers never render anything and they're expensive to
+# import
+
+def rsvg():
+    "Returns the Rsvg module, importing it if necessary"
+    import gi
+    gi.require_version('Rsvg', '2.0')
+    from gi.repository import Rsvg
+    return Rsvg
+
+@lru_cache()
+def thumb_mask():
     """
     Create a mask for fading out the bottom of extremely tall thumbnails which
-    are cropped. As the thumbnail limits are fixed, this can be pre-calculated.
+    are cropped. As the thumbnail limits are fixed, this is only calculated
+    once.
     """
+    from PIL import Image
     mask = Image.new('L', THUMB_SIZE, color=255)
     pa = mask.load()
     y_from = int(THUMB_SIZE[1] * 0.8)
@@ -115,9 +148,18 @@ def create_mask():
             pa[x, y] = 255 - int(255 * (y - y_from) / (y_max - y_from))
     return mask
 
-# Mask for fading out the bottom of extremely tall thumbnails which are cropped
-THUMB_MASK = create_mask()
-del create_mask
+def preload():
+    """
+    Imports the rendering libraries and calculates the thumbnail mask. If
+    this is called before a server forks its workers (see "site.preload"),
+    they'll all share the result copy-on-write instead of each paying for it
+    on first use.
+    """
+    rsvg()
+    import cairo
+    import PIL.Image
+    import PyPDF2
+    thumb_mask()
 
 
 def adjacent(iterable, obj, key=None):
@@ -163,7 +205,7 @@ class FilesThread(threading.Thread):
     """
     def __init__(self):
         super().__init__()
-        self.lock = SELock()
+        self.lock = SELock('files', warn_after=FILES_LOCK_WARNING)
         self.daemon = True
         self._event = threading.Event()
         self._changed = False
@@ -184,51 +226,76 @@ class FilesThread(threading.Thread):
 
     def run(self):
         try:
+            retry = False
             while not self._terminated:
-                if self._event.wait(1):
+                if self._event.wait(1) or retry:
                     self._event.clear()
-                    with self.lock.exclusive, transaction.manager:
-                        files_dir = DBSession.info['site.files']
-                        log.info('FileThread sweeping %s' % files_dir)
-                        to_delete = set(
-                                os.path.join(files_dir, f)
-                                for f in os.listdir(files_dir)
-                                if f.endswith(('.svg', '.png', '.pdf', '.zip', '.jpg'))
-                                )
-                        for user in DBSession.query(User):
-                            for filename in (
-                                    user.bitmap_filename,
-                                    ):
-                                if filename:
-                                    to_delete.remove(filename)
-                        for page in DBSession.query(Page):
-                            for filename in (
-                                    page.vector_filename,
-                                    page.bitmap_filename,
-                                    page.thumbnail_filename,
-                                    ):
-                                if filename:
-                                    to_delete.remove(filename)
-                        for issue in DBSession.query(Issue):
-                            for filename in (
-                                    issue.archive_filename,
-                                    issue.pdf_filename,
-                                    ):
-                                if filename:
-                                    to_delete.remove(filename)
-                        log.info('FileThread found %d files to remove' % len(to_delete))
-                        for filename in to_delete:
-                            try:
-                                log.info('FileThread removing %s' % filename)
-                                os.unlink(filename)
-                            except IOError as e:
-                                log.error('Failed to remove %s' % filename)
-                                log.error(str(e))
+                    # While the sweep waits for the lock, new writers of
+                    # files queue behind it; rather than stall them all behind
+                    # a slow writer, give up and try again a second later
+                    retry = not self.lock.exclusive.acquire(timeout=SWEEP_LOCK_TIMEOUT)
+                    if retry:
+                        log.info('FileThread postponing sweep; files lock is busy')
+                        continue
+                    try:
+                        with transaction.manager:
+                            start = time.perf_counter()
+                            files_dir = DBSession.info['site.files']
+                            log.info('FileThread sweeping %s' % files_dir)
+                            to_delete = set(
+                                    os.path.join(files_dir, f)
+                                    for f in os.listdir(files_dir)
+                                    if f.endswith(('.svg', '.png', '.pdf', '.zip', '.jpg'))
+                                    )
+                            SWEEP_FILES.inc('scanned', amount=len(to_delete))
+                            to_delete -= self.referenced_files()
+                            log.info('FileThread found %d files to remove' % len(to_delete))
+                            for filename in to_delete:
+                                try:
+                                    log.info('FileThread removing %s' % filename)
+                                    os.unlink(filename)
+                                except IOError as e:
+                                    log.error('Failed to remove %s' % filename)
+                                    log.error(str(e))
+                                else:
+                                    SWEEP_FILES.inc('deleted')
+                            SWEEP_SECONDS.observe(time.perf_counter() - start)
+                    finally:
+                        self.lock.exclusive.release()
         finally:
             # Need to close the session we've been using here as some DBAPI
             # implementations won't close our session back in the main thread
             DBSession.remove()
 
+    def referenced_files(self):
+        """
+        Returns the set of filenames referenced by the database; all other
+        files in the site.files dir are removed by the sweep.
+        """
+        result = set()
+        for user in DBSession.query(User):
+            for filename in (
+                    user.bitmap_filename,
+                    ):
+                if filename:
+                    result.add(filename)
+        for page in DBSession.query(Page):
+            for filename in (
+                    page.vector_filename,
+                    page.bitmap_filename,
+                    page.thumbnail_filename,
+                    ):
+                if filename:
+                    result.add(filename)
+        for issue in DBSession.query(Issue):
+            for filename in (
+                    issue.archive_filename,
+                    issue.pdf_filename,
+                    ):
+                if filename:
+                    result.add(filename)
+        return result
+
     def stop(self):
         self._terminated = True
         self.join()
@@ -298,6 +365,28 @@ def file_property(filename_attr, prefix='tmp', suffix='.tmp', create_method=None
     return property(getter, setter)
 
 
+def rendered(derivative):
+    """
+    Decorates a create method to record the time taken whenever it renders a
+    new *derivative* file. Whether it will is decided up front, by the
+    ``<derivative>_stale`` property, so the whole call is attributed to the
+    render phase of the slow request log; calls which find the file is
+    already up to date count as freshness checks
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self):
+            with phase('freshness'):
+                stale = getattr(self, derivative + '_stale')
+            with phase('render' if stale else 'freshness'):
+                start = time.perf_counter()
+                method(self)
+                if stale:
+                    RENDERS.observe(time.perf_counter() - start, derivative)
+        return wrapper
+    return decorator
+
+
 def updated_property(filename_attr):
     "Makes a file-last-modified property based on the filename_attr attribute"
     def getter(self):
@@ -313,15 +402,24 @@ class Page(Base):
     """
 
     __table__ = Table('pages', Base.metadata,
-            # ... all other columns reflected
-            Column('prior_page_number', server_onupdate=FetchedValue()),
-            Column('next_page_number', server_onupdate=FetchedValue()),
+            Column('comic_id', Unicode(20), nullable=False),
+            Column('issue_number', Integer, nullable=False),
+            Column('page_number', Integer, nullable=False),
+            Column('created', DateTime, nullable=False),
+            Column('published', DateTime),
+            Column('markup', Unicode(8), nullable=False),
+            Column('description', UnicodeText, nullable=False),
+            Column('description_html', UnicodeText),
+            Column('thumbnail', Unicode(200)),
+            Column('bitmap', Unicode(200)),
+            Column('vector', Unicode(200)),
+            Column('prior_page_number', Integer, server_onupdate=FetchedValue()),
+            Column('next_page_number', Integer, server_onupdate=FetchedValue()),
             PrimaryKeyConstraint('comic_id', 'issue_number', 'page_number'),
             ForeignKeyConstraint(
                 ['comic_id', 'issue_number'],
                 ['issues.comic_id', 'issues.issue_number'],
                 onupdate='CASCADE', ondelete='CASCADE'),
-            extend_existing=True
             )
 
     _created = __table__.c.created
@@ -355,14 +453,25 @@ class Page(Base):
         return '%s, issue #%d, "%s", page #%d' % (
             self.issue.comic.title, self.issue.issue_number, self.issue.title, self.page_number)
 
+    @property
+    def bitmap_stale(self):
+        "True if :meth:`create_bitmap` would have to render the bitmap"
+        return bool(self.vector_filename) and (
+            not self.bitmap_filename or self.bitmap_updated < self.vector_updated)
+
+    @property
+    def thumbnail_stale(self):
+        "True if :meth:`create_thumbnail` would have to render the thumbnail"
+        return self.bitmap_stale or (bool(self.bitmap_filename) and (
+            not self.thumbnail_filename or
+            self.thumbnail_updated < self.bitmap_updated))
+
+    @rendered('thumbnail')
     def create_thumbnail(self):
+        from PIL import Image
         # Ensure a bitmap exists to create the thumbnail from
         self.create_bitmap()
-        if (
-                self.bitmap_filename and
-                (not self.thumbnail_filename or
-                    self.thumbnail_updated < self.bitmap_updated)
-                ):
+        if self.thumbnail_stale:
             with closing(self.bitmap) as source:
                 image = Image.open(source)
                 image.load()
@@ -376,7 +485,7 @@ class Page(Base):
                 # then use the pre-calculated mask to fade out the bottom of
                 # the image
                 thumb = image.resize(tsize, Image.ANTIALIAS).crop((0, 0) + THUMB_SIZE)
-                thumb.putalpha(THUMB_MASK)
+                thumb.putalpha(thumb_mask())
             elif (image.size[1] * scale) <= THUMB_SIZE[1]:
                 # Image fits nicely within defined thumbnail limits; resize
                 # normally
@@ -392,16 +501,14 @@ class Page(Base):
                 stream.seek(0)
                 self.thumbnail = stream
 
+    @rendered('bitmap')
     def create_bitmap(self):
-        if (
-                self.vector_filename and
-                (not self.bitmap_filename or
-                    self.bitmap_updated < self.vector_updated)
-                ):
+        import cairo
+        if self.bitmap_stale:
             # Load the SVG file with librsvg (using copyfileobj is a bit of a
             # dirty hack given that svg isn't a file-like object, but too
             # tempting given that it's got a simple write() method for loading)
-            svg = Rsvg.Handle()
+            svg = rsvg().Handle()
             with closing(self.vector) as source:
                 shutil.copyfileobj(source, svg)
             svg.close()
@@ -438,6 +545,23 @@ class Page(Base):
                     (self.comic_id, self.issue_number, self.next_page_number)
                     )
 
+    @classmethod
+    def latest(cls, limit=6):
+        """
+        Returns a query of the (comic_id, issue_number, page_number,
+        published) of the *limit* most recently published front pages,
+        newest first.
+        """
+        return DBSession.query(
+                'comic_id', 'issue_number', 'page_number', 'published'
+            ).from_statement(
+                text(
+                    "SELECT comic_id, issue_number, page_number, published "
+                    "FROM front_pages "
+                    "ORDER BY published DESC "
+                    "LIMIT :limit").bindparams(limit=limit)
+            )
+
     @reify
     def is_published(self):
         return self.published is not None and self.published <= utcnow()
@@ -449,18 +573,25 @@ class Issue(Base):
     """
 
     __table__ = Table('issues', Base.metadata,
-            # ... all other columns reflected
-            Column('published', server_onupdate=FetchedValue()),
-            Column('prior_issue_number', server_onupdate=FetchedValue()),
-            Column('next_issue_number', server_onupdate=FetchedValue()),
-            Column('first_page_number', server_onupdate=FetchedValue()),
-            Column('last_page_number', server_onupdate=FetchedValue()),
-            Column('page_count', server_onupdate=FetchedValue()),
+            Column('comic_id', Unicode(20), nullable=False),
+            Column('issue_number', Integer, nullable=False),
+            Column('title', Unicode(500), nullable=False),
+            Column('markup', Unicode(8), nullable=False),
+            Column('description', UnicodeText, nullable=False),
+            Column('description_html', UnicodeText),
+            Column('created', DateTime, nullable=False),
+            Column('archive', Unicode(200)),
+            Column('pdf', Unicode(200)),
+            Column('published', DateTime, server_onupdate=FetchedValue()),
+            Column('prior_issue_number', Integer, server_onupdate=FetchedValue()),
+            Column('next_issue_number', Integer, server_onupdate=FetchedValue()),
+            Column('first_page_number', Integer, server_onupdate=FetchedValue()),
+            Column('last_page_number', Integer, server_onupdate=FetchedValue()),
+            Column('page_count', BigInteger, server_onupdate=FetchedValue()),
             PrimaryKeyConstraint('comic_id', 'issue_number'),
             ForeignKeyConstraint(
                 ['comic_id'], ['comics.comic_id'],
                 onupdate='CASCADE', ondelete='CASCADE'),
-            extend_existing=True
             )
 
     _created = __table__.c.created
@@ -496,10 +627,23 @@ class Issue(Base):
         self.archive = None
         self.pdf = None
 
+    @property
+    def archive_stale(self):
+        "True if :meth:`create_archive` would have to build the archive"
+        return bool(self.published) and (
+            not self.archive_filename or self.archive_updated < self.published)
+
+    @property
+    def pdf_stale(self):
+        "True if :meth:`create_pdf` would have to build the PDF"
+        return bool(self.published) and (
+            not self.pdf_filename or self.pdf_updated < self.published)
+
+    @rendered('archive')
     def create_archive(self):
         if not self.published:
             self.archive = None
-        elif (not self.archive_filename or self.archive_updated < self.published):
+        elif self.archive_stale:
             with tempfile.SpooledTemporaryFile(SPOOL_LIMIT) as temp:
                 # We don't bother with compression here as PNGs are already
                 # compressed (and zip usually can't do any better)
@@ -510,31 +654,32 @@ class Issue(Base):
                             self.title,
                             self.description,
                             )).encode('utf-8')
-                    page = self.first_page
-                    while page:
+                    for page in self.published_pages():
                         page.create_bitmap()
                         archive.write(page.bitmap, '%02d.png' % page.page_number)
-                        page = page.next_page
                 temp.seek(0)
                 self.archive = temp
 
+    @rendered('pdf')
     def create_pdf(self):
+        import cairo
+        from PyPDF2 import PdfFileWriter, PdfFileReader
+        from PyPDF2.generic import NameObject, createStringObject
         if not self.published:
             self.pdf = None
-        elif (not self.pdf_filename or self.pdf_updated < self.published):
+        elif self.pdf_stale:
             with tempfile.SpooledTemporaryFile(SPOOL_LIMIT) as temp:
                 # Create an output PDF surface with an arbitrary size (the
                 # size doesn't matter as we'll set it independently for each
                 # page below)
                 surface = cairo.PDFSurface(temp, 144.0, 144.0)
                 context = cairo.Context(surface)
-                page = self.first_page
-                while page:
+                for page in self.published_pages():
                     context.save()
                     try:
                         # Render the page's vector image if it has one
                         if page.vector_filename:
-                            svg = Rsvg.Handle()
+                            svg = rsvg().Handle()
                             shutil.copyfileobj(page.vector, svg)
                             svg.close()
                             surface.set_size(
@@ -557,7 +702,6 @@ class Issue(Base):
                         context.show_page()
                     finally:
                         context.restore()
-                    page = page.next_page
                 surface.finish()
                 # Use PyPdf to rewrite the metadata on the file (cairo provides
                 # no PDF metadata manipulation). This involves generating a new
@@ -585,6 +729,63 @@ class Issue(Base):
                     temp.seek(0)
                     self.pdf = temp
 
+    def remove_page(self, page):
+        """
+        Deletes *page* from the issue and closes the gap it leaves in the page
+        numbering. All subsequent pages are renumbered by a single server-side
+        operation rather than an UPDATE per page.
+        """
+        number = page.page_number
+        DBSession.delete(page)
+        DBSession.flush()
+        DBSession.execute(select([
+            func.renumber_pages(self.comic_id, self.issue_number, number)]))
+        mark_changed(DBSession())
+        # Any subsequent pages already in the session still have their old
+        # numbers as their identities; discard them so they can't be used
+        for obj in list(DBSession.identity_map.values()):
+            if isinstance(obj, Page):
+                comic_id, issue_number, page_number = inspect(obj).identity
+                if (
+                        comic_id == self.comic_id and
+                        issue_number == self.issue_number and
+                        page_number > number):
+                    DBSession.expunge(obj)
+        DBSession.expire(self)
+
+    def published_pages(self):
+        """
+        Returns all published pages of the issue in page order. The pages are
+        retrieved with a single query (rather than walking the next_page
+        links, each of which would query the pages view separately) so this
+        should be preferred by anything that needs to iterate over the whole
+        issue.
+        """
+        return DBSession.query(Page).filter(
+                (Page.comic_id == self.comic_id) &
+                (Page.issue_number == self.issue_number) &
+                (Page._published != None) &
+                (Page._published <= func.current_timestamp())
+            ).order_by(Page.page_number).all()
+
+    @classmethod
+    def listing(cls, comic_id, published_only=True):
+        """
+        Returns an unordered query of the displayed columns of the issues of
+        *comic_id* (only those published, if *published_only*), suitable for
+        paging with a KeysetPager on issue_number.
+        """
+        query = DBSession.query(
+                cls.comic_id,
+                cls.issue_number,
+                cls.title,
+                cls.published,
+                cls.first_page_number,
+            ).filter(cls.comic_id == comic_id)
+        if published_only:
+            query = query.filter(cls.published != None)
+        return query
+
     @reify
     def first_page(self):
         if self.first_page_number:
@@ -620,16 +821,22 @@ class Comic(Base):
     """
 
     __table__ = Table('comics', Base.metadata,
-            # ... all other columns reflected
-            Column('first_issue_number', server_onupdate=FetchedValue()),
-            Column('last_issue_number', server_onupdate=FetchedValue()),
-            Column('issue_count', server_onupdate=FetchedValue()),
-            Column('latest_publication', server_onupdate=FetchedValue()),
+            Column('comic_id', Unicode(20), nullable=False),
+            Column('title', Unicode(200), nullable=False),
+            Column('author_id', Unicode(200), nullable=False),
+            Column('license_id', Unicode(50), nullable=False),
+            Column('markup', Unicode(8), nullable=False),
+            Column('description', UnicodeText, nullable=False),
+            Column('description_html', UnicodeText),
+            Column('created', DateTime, nullable=False),
+            Column('first_issue_number', Integer, server_onupdate=FetchedValue()),
+            Column('last_issue_number', Integer, server_onupdate=FetchedValue()),
+            Column('issue_count', BigInteger, server_onupdate=FetchedValue()),
+            Column('latest_publication', DateTime, server_onupdate=FetchedValue()),
             PrimaryKeyConstraint('comic_id'),
             ForeignKeyConstraint(
                 ['author_id'], ['users.user_id'],
                 onupdate='CASCADE', ondelete='RESTRICT'),
-            extend_existing=True
             )
 
     _created = __table__.c.created
@@ -645,6 +852,27 @@ class Comic(Base):
     def __unicode__(self):
         return self.title
 
+    def remove_issue(self, issue):
+        """
+        Deletes *issue* (and all its pages) from the comic and closes the gap
+        it leaves in the issue numbering. All subsequent issues are renumbered
+        by a single server-side operation rather than an UPDATE per issue.
+        """
+        number = issue.issue_number
+        DBSession.delete(issue)
+        DBSession.flush()
+        DBSession.execute(select([
+            func.renumber_issues(self.comic_id, number)]))
+        mark_changed(DBSession())
+        # As in Issue.remove_page, discard anything in the session which is
+        # identified by an old issue number
+        for obj in list(DBSession.identity_map.values()):
+            if isinstance(obj, (Issue, Page)):
+                identity = inspect(obj).identity
+                if identity[0] == self.comic_id and identity[1] > number:
+                    DBSession.expunge(obj)
+        DBSession.expire(self)
+
     @property
     def first_issue(self):
         return DBSession.query(Issue).get((self.comic_id, self.first_issue_number))
@@ -653,8 +881,60 @@ class Comic(Base):
     def last_issue(self):
         return DBSession.query(Issue).get((self.comic_id, self.last_issue_number))
 
+    @classmethod
+    def listing(cls):
+        """
+        Returns a query of the displayed columns of all comics (excluding the
+        blog), with the first page of each comic's latest issue, most
+        recently published first.
+        """
+        return DBSession.query(
+                cls.comic_id,
+                cls.title,
+                cls.author_id,
+                cls.markup,
+                cls.description,
+                cls.description_html,
+                cls.first_issue_number,
+                cls.last_issue_number,
+                Issue.first_page_number,
+            ).outerjoin(Issue,
+                (Issue.comic_id == cls.comic_id) &
+                (Issue.issue_number == cls.last_issue_number)
+            ).filter(
+                cls.comic_id != 'blog'
+            ).order_by(
+                cls.latest_publication.desc()
+            )
+
+    @classmethod
+    def summary(cls):
+        """
+        Returns a query of each comic's id, title, author's name and number
+        of issues, ordered by title.
+        """
+        return DBSession.query(
+                cls.comic_id,
+                cls.title,
+                User.name.label('author_name'),
+                func.count(Issue.issue_number).label('issues'),
+            ).outerjoin(
+                Issue, Issue.comic_id == cls.comic_id
+            ).join(
+                User, User.user_id == cls.author_id
+            ).group_by(
+                cls.comic_id,
+                cls.title,
+                User.name
+            ).order_by(
+                cls.title
+            )
+
     def _get_license(self):
-        return get_current_registry()['licenses']()[self.license_id]
+        try:
+            return get_current_registry()['licenses']()[self.license_id]
+        except KeyError:
+            return License.unknown(self.license_id)
     def _set_license(self, value):
         assert isinstance(value, License)
         self.license_id = value.id
@@ -669,8 +949,14 @@ class User(Base):
     """
 
     __table__ = Table('users', Base.metadata,
+            Column('user_id', Unicode(200), nullable=False),
+            Column('name', Unicode(200), nullable=False),
+            Column('admin', Boolean, nullable=False, server_default=text('false')),
+            Column('markup', Unicode(8), nullable=False, server_default='html'),
+            Column('description', UnicodeText, nullable=False, server_default=''),
+            Column('description_html', UnicodeText),
+            Column('bitmap', Unicode(200)),
             PrimaryKeyConstraint('user_id'),
-            extend_existing=True
             )
 
     _bitmap = __table__.c.bitmap
@@ -693,11 +979,102 @@ class User(Base):
             ).distinct()
 
 
+class RenderJob(Base):
+    """
+    Represents a queued job generating a derivative file of a page or (when
+    :attr:`page_number` is 0) an issue; see :mod:`ratbot.jobs`.
+    """
+
+    __table__ = Table('render_jobs', Base.metadata,
+            Column('job_id', Integer, nullable=False),
+            Column('comic_id', Unicode(20), nullable=False),
+            Column('issue_number', Integer, nullable=False),
+            Column('page_number', Integer, nullable=False, server_default=text('0')),
+            Column('derivative', Unicode(10), nullable=False),
+            Column('source_version', Unicode(200), nullable=False),
+            Column('state', Unicode(10), nullable=False, server_default='pending'),
+            Column('attempts', Integer, nullable=False, server_default=text('0')),
+            Column('created', DateTime, nullable=False, server_default=func.current_timestamp()),
+            Column('run_after', DateTime, nullable=False, server_default=func.current_timestamp()),
+            Column('started', DateTime),
+            Column('finished', DateTime),
+            Column('worker', Unicode(200)),
+            Column('error', UnicodeText),
+            PrimaryKeyConstraint('job_id'),
+            ForeignKeyConstraint(
+                ['comic_id', 'issue_number'],
+                ['issues.comic_id', 'issues.issue_number'],
+                onupdate='CASCADE', ondelete='CASCADE'),
+            )
+
+    def __repr__(self):
+        return '<RenderJob: job=%d, %s of comic=%s, issue=%d, page=%d>' % (
+            self.job_id, self.derivative, self.comic_id, self.issue_number,
+            self.page_number)
+
+
+def verify_schema(connection):
+    """
+    Compare the table definitions above against the database accessed by
+    *connection*, logging an error for any table or column that the models
+    expect but which the database lacks. Returns True if no discrepancies were
+    found.
+    """
+    inspector = inspect(connection)
+    result = True
+    for table in Base.metadata.sorted_tables:
+        try:
+            columns = {c['name'] for c in inspector.get_columns(table.name)}
+        except NoSuchTableError:
+            log.error('Table or view %s does not exist', table.name)
+            result = False
+        else:
+            for column in table.c:
+                if column.name not in columns:
+                    log.error(
+                        'Column %s.%s does not exist', table.name, column.name)
+                    result = False
+    return result
+
+
+def verify_schema_on_connect(engine):
+    """
+    Arrange for :func:`verify_schema` to be run against the first connection
+    made by *engine*, instead of querying the catalog before it's needed.
+    The check runs once, even when several connections are made at the same
+    time.
+    """
+    def first_connect(connection, branch):
+        verify_schema(connection)
+    event.listen(engine, 'engine_connect', first_connect, once=True)
+
+
 # Notify the FilesThread about various occurrences
 @event.listens_for(DBSession, 'after_rollback')
 @event.listens_for(DBSession, 'after_commit')
 def clean_after_txn(session):
-    FilesThread.clean()
+    # Read-only requests can't have changed any files
+    if not session.info.get('read_only'):
+        FilesThread.clean()
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+@event.listens_for(Comic, 'before_insert')
+@event.listens_for(Comic, 'before_update')
+@event.listens_for(Issue, 'before_insert')
+@event.listens_for(Issue, 'before_update')
+@event.listens_for(Page, 'before_insert')
+@event.listens_for(Page, 'before_update')
+def render_description(mapper, connection, target):
+    # Only re-render the description when it (or its markup) has changed;
+    # pages in particular are updated whenever a derivative is generated
+    state = inspect(target)
+    if (
+            target.description_html is None or
+            state.attrs.markup.history.has_changes() or
+            state.attrs.description.history.has_changes()):
+        target.description_html = render_markup(
+            target.markup or 'html', target.description or '')
 
 @event.listens_for(User, 'after_insert')
 @event.listens_for(User, 'after_update')
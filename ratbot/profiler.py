@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Statistical profiling of individual requests.
+
+The profiler tween is only added when ``profile.dir`` is configured, so there
+is no overhead at all otherwise. When it is, a request is profiled if it
+carries a valid :data:`PROFILE_HEADER` (see :func:`sign_token`, and the
+``profile_ratbot_token`` script), or at random for a fraction
+``profile.sample`` of requests (0 by default).
+
+While a request is profiled, a thread samples the request thread's stack
+every ``profile.interval`` milliseconds. The samples are written to
+``profile.dir`` in the "folded" format understood by flamegraph.pl and
+speedscope, one line per distinct stack. Time spent in C extensions (librsvg,
+cairo, PIL) is attributed to the Python frame which called them. A summary of
+the time spent in rendering, templates, SQL and markup sanitizing is logged.
+"""
+
+import io
+import os
+import sys
+import hmac
+import time
+import random
+import hashlib
+import itertools
+import threading
+from datetime import datetime
+from collections import Counter
+import logging
+log = logging.getLogger(__name__)
+
+
+__all__ = [
+    'PROFILE_HEADER',
+    'sign_token',
+    'verify_token',
+    'Sampler',
+    'profiler_tween_factory',
+    ]
+
+
+# Request header which triggers profiling of the request
+PROFILE_HEADER = 'X-Ratbot-Profile'
+
+# Response header naming the file the profile was written to, when it was
+# triggered by PROFILE_HEADER
+PROFILE_FILE_HEADER = 'X-Ratbot-Profile-File'
+
+# Categories of the summary, checked from the innermost frame outwards; the
+# first frame whose filename contains one of the fragments determines the
+# category of each sample
+CATEGORIES = (
+    ('render',   ('/PIL/', '/cairo/', '/gi/', '/PyPDF2/', 'ratbot/zip.py')),
+    ('template', ('/chameleon/', '.pt')),
+    ('sql',      ('/sqlalchemy/', '/psycopg2/')),
+    ('markup',   ('/bleach/', '/html5lib/', '/markdown/', '/docutils/', '/creole/')),
+    )
+
+# Rendering happens in C extensions, called from these methods in ratbot's
+# models, so samples inside them (but no deeper Python frame) count as render
+RENDER_FUNCTIONS = {'create_bitmap', 'create_thumbnail', 'create_archive', 'create_pdf'}
+
+
+def sign_token(secret, expires):
+    """
+    Returns a value for :data:`PROFILE_HEADER`, signed with *secret*, which is
+    valid until *expires* (a UNIX timestamp)
+    """
+    expires = str(int(expires))
+    digest = hmac.new(
+        secret.encode('utf-8'), ('profile:' + expires).encode('ascii'),
+        hashlib.sha256).hexdigest()
+    return '%s.%s' % (expires, digest)
+
+
+def verify_token(secret, token):
+    """
+    Returns True if *token* was produced by :func:`sign_token` with *secret*
+    and hasn't expired
+    """
+    try:
+        expires, digest = token.split('.', 1)
+        if int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(sign_token(secret, int(expires)), token)
+
+
+def categorize(frames):
+    "Returns the summary category of a stack of (filename, function) tuples"
+    for filename, function in reversed(frames):
+        for category, fragments in CATEGORIES:
+            if any(fragment in filename for fragment in fragments):
+                return category
+        if function in RENDER_FUNCTIONS and filename.endswith('ratbot/models.py'):
+            return 'render'
+    return 'other'
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the stack of the thread identified by *thread_id* every
+    *interval* seconds until :meth:`stop` is called.
+    """
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profiler')
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._event = threading.Event()
+
+    def run(self):
+        while not self._event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append((frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+
+    def stop(self):
+        self._event.set()
+        self.join()
+
+    def folded(self):
+        "Returns the samples in the folded stack format"
+        return ''.join(
+            '%s %d\n' % (';'.join(
+                '%s:%s' % (os.path.basename(filename), function)
+                for (filename, function) in stack), count)
+            for (stack, count) in sorted(self.stacks.items())
+            )
+
+    def summary(self):
+        "Returns a dict of the number of samples in each category"
+        result = Counter()
+        for stack, count in self.stacks.items():
+            result[categorize(stack)] += count
+        return result
+
+
+def profiler_tween_factory(handler, registry):
+    """
+    Profiles requests carrying a valid :data:`PROFILE_HEADER`, and a
+    ``profile.sample`` fraction of all others, writing the results to
+    ``profile.dir``.
+    """
+    settings = registry.settings
+    path = os.path.normpath(os.path.expanduser(settings['profile.dir']))
+    os.makedirs(path, exist_ok=True)
+    secret = settings.get('session.secret', 'secret')
+    sample = float(settings.get('profile.sample', 0))
+    interval = float(settings.get('profile.interval', 5)) / 1000
+    counter = itertools.count()
+
+    def profiler_tween(request):
+        token = request.headers.get(PROFILE_HEADER)
+        signed = token is not None and verify_token(secret, token)
+        if not signed and not (sample and random.random() < sample):
+            return handler(request)
+        sampler = Sampler(threading.get_ident(), interval)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            response = handler(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            sampler.stop()
+            route = request.matched_route.name if request.matched_route else 'none'
+            filename = os.path.join(path, '%s-%s-%d-%d.folded' % (
+                datetime.utcnow().strftime('%Y%m%d-%H%M%S'), route,
+                os.getpid(), next(counter)))
+            with io.open(filename, 'w') as f:
+                f.write(sampler.folded())
+            summary = sampler.summary()
+            total = sum(summary.values()) or 1
+            log.info(
+                'Profiled %s %s (route %s) in %.1fms: %s; written to %s',
+                request.method, request.path_qs, route, elapsed * 1000,
+                ', '.join(
+                    '%s %.0f%%' % (category, summary[category] * 100 / total)
+                    for category in [c for (c, f) in CATEGORIES] + ['other']),
+                filename)
+        if signed:
+            response.headers[PROFILE_FILE_HEADER] = os.path.basename(filename)
+        return response
+
+    return profiler_tween
@@ -0,0 +1,199 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+import transaction
+from sqlalchemy import engine_from_config, func
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from pyramid.request import Request
+
+from ratbot.models import (
+    FilesThread,
+    DBSession,
+    Comic,
+    Issue,
+    Page,
+    )
+from ratbot.views import KeysetPager
+from ratbot.views.comics import ISSUES_PAGE_SIZE
+from ratbot.scripts.gendata import generate, PREFIX
+
+
+# The default scale points, in pages
+DEFAULT_SCALES = (1000, 10000, 50000)
+
+
+# Each of the following runs a query of the views (or the files thread),
+# built by the same code the views use; *keys* is a dict of random samples of
+# generated keys. They must fetch all their results so that the cost of the
+# whole query is measured
+
+def context_comic(keys):
+    "ComicContextFactory"
+    return DBSession.query(Comic).get(random.choice(keys['comics']))
+
+def context_issue(keys):
+    "IssueContextFactory"
+    return DBSession.query(Issue).get(random.choice(keys['issues']))
+
+def context_page(keys):
+    "PageContextFactory"
+    return DBSession.query(Page).get(random.choice(keys['pages']))
+
+def front_pages(keys):
+    "ComicsView.index"
+    return Page.latest().all()
+
+def comics_listing(keys):
+    "ComicsView.comics"
+    return Comic.listing().all()
+
+def issues_listing(keys):
+    "ComicsView.issues (first page of the listing)"
+    return KeysetPager(
+        Request.blank('/'), Issue.listing(random.choice(keys['comics'])),
+        Issue.issue_number, page_size=ISSUES_PAGE_SIZE, descending=True).rows
+
+def published_pages(keys):
+    "Issue.published_pages (archive and PDF generation)"
+    comic_id, issue_number = random.choice(keys['issues'])
+    # A transient issue avoids measuring the query that would load it
+    return Issue(comic_id=comic_id, issue_number=issue_number).published_pages()
+
+def admin_index(keys):
+    "AdminView.index (comics aggregate)"
+    return Comic.summary().all()
+
+def files_sweep(keys):
+    "FilesThread.referenced_files"
+    return FilesThread.referenced_files()
+
+QUERIES = (
+    context_comic,
+    context_issue,
+    context_page,
+    front_pages,
+    comics_listing,
+    issues_listing,
+    published_pages,
+    admin_index,
+    files_sweep,
+    )
+
+# Queries which are slow enough at scale to only be run once per repeat
+SLOW_QUERIES = {files_sweep}
+
+
+def sample_keys(size=1000):
+    "Returns random samples of the generated comic, issue and page keys"
+    like = PREFIX + '%'
+    return {
+        'comics': [
+            row.comic_id for row in
+            DBSession.query(Comic.comic_id).filter(Comic.comic_id.like(like)).
+            order_by(func.random()).limit(size)],
+        'issues': [
+            (row.comic_id, row.issue_number) for row in
+            DBSession.query(Issue.comic_id, Issue.issue_number).
+            filter(Issue.comic_id.like(like)).
+            order_by(func.random()).limit(size)],
+        'pages': [
+            (row.comic_id, row.issue_number, row.page_number) for row in
+            DBSession.query(Page.comic_id, Page.issue_number, Page.page_number).
+            filter(Page.comic_id.like(like)).
+            order_by(func.random()).limit(size)],
+        }
+
+
+def measure(query, keys, repeat):
+    timings = []
+    for i in range(repeat if query not in SLOW_QUERIES else max(1, repeat // 10)):
+        # Each request starts with an empty identity map
+        DBSession.expunge_all()
+        start = time.perf_counter()
+        query(keys)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'p90_ms': timings[int(len(timings) * 0.9)] * 1000,
+        'max_ms': timings[-1] * 1000,
+        'runs': len(timings),
+        }
+
+
+def run_scale(pages, repeat, seed):
+    transaction.begin()
+    try:
+        start = time.perf_counter()
+        counts = generate(pages, seed=seed)
+        print('Generated %d users, %d comics, %d issues, %d pages in %.1fs' % (
+            counts['users'], counts['comics'], counts['issues'],
+            counts['pages'], time.perf_counter() - start))
+        keys = sample_keys()
+        results = {}
+        for query in QUERIES:
+            results[query.__name__] = measure(query, keys, repeat)
+            print('  %-20s %9.2fms median %9.2fms p90  (%s)' % (
+                query.__name__,
+                results[query.__name__]['median_ms'],
+                results[query.__name__]['p90_ms'],
+                query.__doc__))
+        return {'rows': counts, 'queries': results}
+    finally:
+        transaction.abort()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Benchmarks the queries run by the views against '
+        'synthetic sites of increasing size. Each site is generated in a '
+        'transaction which is rolled back after its benchmarks.')
+    parser.add_argument('config_uri', help='the configuration to use, e.g. development.ini')
+    parser.add_argument(
+        '-s', '--scales', default=','.join(str(s) for s in DEFAULT_SCALES),
+        help='comma-separated list of site sizes, in pages '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=50,
+        help='the number of times to run each query (default: %(default)s)')
+    parser.add_argument(
+        '-o', '--output', metavar='FILE',
+        help='write the results to FILE as JSON')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the random seed (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    FilesThread.stop()
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine, info={'site.files': settings['site.files']})
+    random.seed(args.seed)
+    results = {}
+    for scale in (int(s) for s in args.scales.split(',')):
+        print('Scale: %d pages' % scale)
+        results[scale] = run_scale(scale, args.repeat, args.seed)
+
+    # Summarise the growth of each query across the scale points
+    scales = sorted(results)
+    print()
+    print('%-20s' % 'query' + ''.join('%12d' % scale for scale in scales))
+    for query in QUERIES:
+        print('%-20s' % query.__name__ + ''.join(
+            '%10.2fms' % results[scale]['queries'][query.__name__]['median_ms']
+            for scale in scales))
+    if args.output:
+        with io.open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
@@ -0,0 +1,312 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+from datetime import timedelta
+
+import transaction
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ratbot.models import (
+    FilesThread,
+    DBSession,
+    User,
+    Comic,
+    Issue,
+    Page,
+    utcnow,
+    )
+
+
+# Synthetic pages rendered by the benchmark: (name, height in SVG units,
+# number of shapes). All pages are 900 units wide, matching BITMAP_WIDTH
+SVG_PAGES = (
+    ('svg-simple',   1300,   20),
+    ('svg-complex',  1300, 2000),
+    ('svg-tall',     5000,  200),
+    )
+
+# Synthetic bitmap uploads: (name, width, height). These deliberately exceed
+# the bitmaps rendered from vectors to exercise the thumbnail resizing
+PNG_PAGES = (
+    ('png-oversized', 3000, 4500),
+    ('png-tall',      2000, 9000),
+    )
+
+# The fraction by which a stage may be slower than the baseline before it is
+# reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def synthetic_svg(height, shapes, seed):
+    "Returns the bytes of a synthetic SVG page with *shapes* random shapes"
+    rnd = random.Random(seed)
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg" width="900" height="%d" '
+        'viewBox="0 0 900 %d">\n' % (height, height),
+        '<rect x="0" y="0" width="900" height="%d" fill="white"/>\n' % height,
+        ]
+    for i in range(shapes):
+        colour = '#%06x' % rnd.randrange(0x1000000)
+        if i % 3 == 0:
+            parts.append(
+                '<circle cx="%d" cy="%d" r="%d" fill="%s" opacity="0.7"/>\n' % (
+                    rnd.randrange(900), rnd.randrange(height),
+                    rnd.randrange(5, 80), colour))
+        elif i % 3 == 1:
+            parts.append(
+                '<rect x="%d" y="%d" width="%d" height="%d" fill="%s" '
+                'stroke="black" stroke-width="2"/>\n' % (
+                    rnd.randrange(900), rnd.randrange(height),
+                    rnd.randrange(10, 200), rnd.randrange(10, 200), colour))
+        else:
+            points = ' '.join(
+                '%d,%d' % (rnd.randrange(900), rnd.randrange(height))
+                for j in range(rnd.randrange(3, 12)))
+            parts.append(
+                '<path d="M %s Z" fill="none" stroke="%s" stroke-width="3"/>\n' % (
+                    points, colour))
+    parts.append(
+        '<text x="450" y="%d" font-size="48" text-anchor="middle">'
+        'Synthetic page</text>\n' % (height // 2))
+    parts.append('</svg>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def synthetic_png(width, height):
+    "Returns the bytes of a synthetic PNG of the specified size"
+    from PIL import Image
+    image = Image.merge('RGB', (
+        Image.linear_gradient('L').resize((width, height)),
+        Image.effect_noise((width, height), 64),
+        Image.linear_gradient('L').rotate(90).resize((width, height)),
+        ))
+    with io.BytesIO() as stream:
+        image.save(stream, 'PNG')
+        return stream.getvalue()
+
+
+def reset_peak_rss():
+    "Resets the process' peak RSS, where the platform permits"
+    try:
+        with io.open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    "Returns the peak RSS of the process in KB"
+    try:
+        with io.open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(stage, repeat, reset, run, output):
+    """
+    Calls *reset* then times *run* *repeat* times, returning a dict of
+    statistics for *stage*. *output* is called after each run to return the
+    name of the file produced.
+    """
+    timings = []
+    size = 0
+    reset_peak_rss()
+    for i in range(repeat):
+        reset()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+        size = os.path.getsize(output())
+    timings.sort()
+    median = timings[len(timings) // 2]
+    result = {
+        'seconds': median,
+        'min_seconds': timings[0],
+        'max_seconds': timings[-1],
+        'per_second': 1 / median if median else None,
+        'output_bytes': size,
+        'peak_rss_kb': peak_rss(),
+        }
+    print('%-28s %8.3fs (min %.3fs) %10d bytes %8d KB RSS' % (
+        stage, median, timings[0], size, result['peak_rss_kb']))
+    return result
+
+
+def create_corpus():
+    """
+    Adds a synthetic comic to the session. Returns its single issue, and a
+    dict mapping the names in SVG_PAGES and PNG_PAGES to the issue's pages.
+    """
+    suffix = '%08x' % random.getrandbits(32)
+    now = utcnow()
+    user = User(user_id='bench-%s' % suffix, name='Benchmark %s' % suffix)
+    comic = Comic(
+        comic_id='bench%s' % suffix,
+        title='Benchmark %s' % suffix,
+        author_id=user.user_id,
+        license_id='notspecified',
+        markup='text',
+        description='Synthetic comic for render benchmarks',
+        created=now)
+    issue = Issue(
+        comic_id=comic.comic_id,
+        issue_number=1,
+        title='Synthetic issue',
+        markup='text',
+        description='',
+        created=now)
+    DBSession.add_all((user, comic, issue))
+    DBSession.flush()
+    pages = {}
+    number = 1
+    for name, height, shapes in SVG_PAGES:
+        page = Page(
+            comic_id=comic.comic_id,
+            issue_number=issue.issue_number,
+            page_number=number,
+            created=now,
+            published=now - timedelta(days=1),
+            markup='text',
+            description=name)
+        page.vector = io.BytesIO(synthetic_svg(height, shapes, seed=number))
+        pages[name] = page
+        number += 1
+    for name, width, height in PNG_PAGES:
+        page = Page(
+            comic_id=comic.comic_id,
+            issue_number=issue.issue_number,
+            page_number=number,
+            created=now,
+            published=now - timedelta(days=1),
+            markup='text',
+            description=name)
+        page.bitmap = io.BytesIO(synthetic_png(width, height))
+        pages[name] = page
+        number += 1
+    DBSession.add_all(pages.values())
+    DBSession.flush()
+    # Re-read the issue's publication date, which is calculated by the view
+    DBSession.expire(issue)
+    return issue, pages
+
+
+def run_benchmarks(repeat):
+    issue, pages = create_corpus()
+    results = {}
+    for name, height, shapes in SVG_PAGES:
+        page = pages[name]
+        def reset(page=page):
+            page.bitmap = None
+            page.thumbnail = None
+        results['create_bitmap:%s' % name] = measure(
+            'create_bitmap:%s' % name, repeat, reset,
+            page.create_bitmap, lambda page=page: page.bitmap_filename)
+    for name in [name for (name, height, shapes) in SVG_PAGES] + [
+            name for (name, width, height) in PNG_PAGES]:
+        page = pages[name]
+        page.create_bitmap()
+        def reset(page=page):
+            page.thumbnail = None
+        results['create_thumbnail:%s' % name] = measure(
+            'create_thumbnail:%s' % name, repeat, reset,
+            page.create_thumbnail, lambda page=page: page.thumbnail_filename)
+    def reset():
+        issue.archive = None
+    results['create_archive'] = measure(
+        'create_archive', repeat, reset,
+        issue.create_archive, lambda: issue.archive_filename)
+    def reset():
+        issue.pdf = None
+    results['create_pdf'] = measure(
+        'create_pdf', repeat, reset,
+        issue.create_pdf, lambda: issue.pdf_filename)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints a comparison of *results* against *baseline*, returning the number
+    of stages that regressed by more than *tolerance*
+    """
+    regressions = 0
+    print()
+    print('%-28s %10s %10s %8s' % ('stage', 'baseline', 'current', 'change'))
+    for stage, result in sorted(results.items()):
+        try:
+            before = baseline[stage]['seconds']
+        except KeyError:
+            print('%-28s %10s %9.3fs %8s' % (stage, '-', result['seconds'], 'new'))
+            continue
+        change = (result['seconds'] - before) / before if before else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = ' REGRESSION'
+            regressions += 1
+        print('%-28s %9.3fs %9.3fs %+7.1f%%%s' % (
+            stage, before, result['seconds'], change * 100, flag))
+    return regressions
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Benchmarks the creation of page and issue derivatives '
+        'from a synthetic comic. The comic is created in a transaction which '
+        'is rolled back, and all files are written to a temporary directory.')
+    parser.add_argument('config_uri', help='the configuration to use, e.g. development.ini')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='the number of times to run each stage (default: %(default)s)')
+    parser.add_argument(
+        '-s', '--save', metavar='FILE',
+        help='write the results to FILE as JSON, for use as a baseline')
+    parser.add_argument(
+        '-b', '--baseline', metavar='FILE',
+        help='compare the results to the baseline in FILE, exiting with '
+        'status 1 if any stage regressed')
+    parser.add_argument(
+        '-t', '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='the fraction by which a stage may be slower than the baseline '
+        'before it counts as a regression (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    FilesThread.stop()
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    scratch = tempfile.mkdtemp(prefix='ratbot-bench-')
+    DBSession.configure(bind=engine, info={'site.files': scratch})
+    try:
+        transaction.begin()
+        try:
+            results = run_benchmarks(args.repeat)
+        finally:
+            transaction.abort()
+    finally:
+        shutil.rmtree(scratch)
+
+    if args.save:
+        with io.open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.baseline:
+        with io.open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
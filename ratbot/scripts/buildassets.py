@@ -0,0 +1,112 @@
+import io
+import os
+import sys
+import gzip
+import shutil
+
+from ratbot.assets import STATIC_DIR, ENCODINGS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Assets which are worth compressing; images other than SVG are already
+# compressed
+COMPRESSIBLE = {
+    '.css',
+    '.eot',
+    '.html',
+    '.ico',
+    '.js',
+    '.json',
+    '.svg',
+    '.ttf',
+    '.txt',
+    '.xml',
+    }
+
+# Don't bother keeping compressed siblings that save less than this fraction
+MIN_SAVING = 0.1
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s [--clean]\n\n'
+          'Builds gzip (and, if the brotli package is installed, brotli)\n'
+          'compressed siblings of the static assets, or removes them with\n'
+          '--clean' % cmd)
+    sys.exit(1)
+
+
+def compress_gzip(data):
+    buf = io.BytesIO()
+    # mtime=0 keeps the output (and thus the package) reproducible
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def compress_brotli(data):
+    return brotli.compress(data)
+
+
+COMPRESSORS = {
+    '.gz': compress_gzip,
+    '.br': compress_brotli if brotli is not None else None,
+    }
+
+
+def siblings(path):
+    for encoding, ext in ENCODINGS:
+        yield ext, path + ext
+
+
+def clean():
+    for dirpath, dirnames, filenames in os.walk(STATIC_DIR):
+        for filename in filenames:
+            if any(filename.endswith(ext) for encoding, ext in ENCODINGS):
+                os.unlink(os.path.join(dirpath, filename))
+
+
+def build():
+    for dirpath, dirnames, filenames in os.walk(STATIC_DIR):
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            if os.path.splitext(filename)[1].lower() not in COMPRESSIBLE:
+                continue
+            source_stat = os.stat(source)
+            data = None
+            for ext, target in siblings(source):
+                compressor = COMPRESSORS[ext]
+                if compressor is None:
+                    continue
+                try:
+                    if os.stat(target).st_mtime >= source_stat.st_mtime:
+                        continue
+                except FileNotFoundError:
+                    pass
+                if data is None:
+                    with io.open(source, 'rb') as f:
+                        data = f.read()
+                compressed = compressor(data)
+                if len(compressed) > len(data) * (1 - MIN_SAVING):
+                    if os.path.exists(target):
+                        os.unlink(target)
+                    continue
+                with io.open(target + '.new', 'wb') as f:
+                    f.write(compressed)
+                shutil.copystat(source, target + '.new')
+                os.rename(target + '.new', target)
+                print('%s: %d -> %d bytes' % (
+                    os.path.relpath(target, STATIC_DIR), len(data), len(compressed)))
+
+
+def main(argv=sys.argv):
+    if len(argv) == 1:
+        build()
+    elif argv[1:] == ['--clean']:
+        clean()
+    else:
+        usage(argv)
@@ -0,0 +1,225 @@
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+
+import transaction
+from sqlalchemy import engine_from_config
+from sqlalchemy.sql import table, column
+from zope.sqlalchemy import mark_changed
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ratbot.models import (
+    FilesThread,
+    DBSession,
+    )
+
+
+# The generator writes straight to the underlying tables; going through the
+# views would fire their INSTEAD OF triggers once per row
+users_table = table('users',
+    column('user_id'), column('name'), column('admin'), column('markup'),
+    column('description'), column('description_html'))
+comics_table = table('comics_data',
+    column('comic_id'), column('title'), column('author_id'),
+    column('license_id'), column('markup'), column('description'),
+    column('description_html'), column('created'))
+issues_table = table('issues_data',
+    column('comic_id'), column('issue_number'), column('title'),
+    column('markup'), column('description'), column('description_html'),
+    column('created'))
+pages_table = table('pages_data',
+    column('comic_id'), column('issue_number'), column('page_number'),
+    column('created'), column('published'), column('markup'),
+    column('description'), column('description_html'))
+
+# Prefix of every generated comic and user id, which keeps generated data
+# apart from real data
+PREFIX = 'synth'
+
+# Number of rows inserted per statement
+BATCH_SIZE = 5000
+
+
+def batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(pages, pages_per_issue=20, issues_per_comic=50, readers=None,
+        future=0.05, unpublished=0.01, seed=0):
+    """
+    Inserts a synthetic site with roughly *pages* pages into the database via
+    the current session, returning a dict of the number of rows generated for
+    each table.
+
+    Issues have between half and one and a half times *pages_per_issue*
+    pages, comics have up to *issues_per_comic* issues, and each comic has its
+    own author. *readers* extra users are generated (by default, one for
+    every hundred pages). Each comic publishes a page every few days from a
+    random point in the past, such that roughly a fraction *future* of its
+    pages are scheduled for publication in the future, and the final
+    *unpublished* fraction of its pages have no publication date at all.
+    """
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    if readers is None:
+        readers = pages // 100
+    counts = {'users': 0, 'comics': 0, 'issues': 0, 'pages': 0}
+    connection = DBSession.connection()
+
+    # Plan the comics first so that the timelines can be calculated
+    comics = []
+    remaining = pages
+    while remaining > 0:
+        issues = []
+        for issue_number in range(1, rnd.randint(1, issues_per_comic) + 1):
+            count = min(remaining, rnd.randint(
+                max(1, pages_per_issue // 2), max(1, pages_per_issue * 3 // 2)))
+            issues.append(count)
+            remaining -= count
+            if remaining <= 0:
+                break
+        comics.append(issues)
+
+    def user_rows():
+        for comic_index in range(len(comics)):
+            yield {
+                'user_id': '%s-author-%d' % (PREFIX, comic_index),
+                'name': 'Synthetic Author %d' % comic_index,
+                'admin': False,
+                'markup': 'text',
+                'description': 'Author of synthetic comic %d' % comic_index,
+                'description_html': '<p>Author of synthetic comic %d</p>' % comic_index,
+                }
+        for reader_index in range(readers):
+            yield {
+                'user_id': '%s-reader-%d' % (PREFIX, reader_index),
+                'name': 'Synthetic Reader %d' % reader_index,
+                'admin': False,
+                'markup': 'text',
+                'description': '',
+                'description_html': '',
+                }
+
+    comic_rows = []
+    issue_rows = []
+    page_rows = []
+    for comic_index, issues in enumerate(comics):
+        comic_id = '%s%05d' % (PREFIX, comic_index)
+        total = sum(issues)
+        interval = timedelta(days=rnd.randint(1, 7), hours=rnd.randint(0, 23))
+        published = now - interval * int(total * (1 - future))
+        created = published - timedelta(days=rnd.randint(1, 30))
+        comic_rows.append({
+            'comic_id': comic_id,
+            'title': 'Synthetic Comic %d' % comic_index,
+            'author_id': '%s-author-%d' % (PREFIX, comic_index),
+            'license_id': 'notspecified',
+            'markup': 'text',
+            'description': 'Synthetic comic %d' % comic_index,
+            'description_html': '<p>Synthetic comic %d</p>' % comic_index,
+            'created': created,
+            })
+        unpublished_from = total - int(total * unpublished)
+        index = 0
+        for issue_number, count in enumerate(issues, start=1):
+            issue_rows.append({
+                'comic_id': comic_id,
+                'issue_number': issue_number,
+                'title': 'Issue %d' % issue_number,
+                'markup': 'text',
+                'description': '',
+                'description_html': '',
+                'created': published,
+                })
+            for page_number in range(1, count + 1):
+                page_rows.append({
+                    'comic_id': comic_id,
+                    'issue_number': issue_number,
+                    'page_number': page_number,
+                    'created': published - timedelta(days=1),
+                    'published': published if index < unpublished_from else None,
+                    'markup': 'text',
+                    'description': '',
+                    'description_html': '',
+                    })
+                published += interval
+                index += 1
+
+    for batch in batches(user_rows()):
+        connection.execute(users_table.insert(), batch)
+        counts['users'] += len(batch)
+    for name, tbl, rows in (
+            ('comics', comics_table, comic_rows),
+            ('issues', issues_table, issue_rows),
+            ('pages', pages_table, page_rows),
+            ):
+        for batch in batches(rows):
+            connection.execute(tbl.insert(), batch)
+            counts[name] += len(batch)
+    # Ensure the planner has statistics for the new rows
+    for tbl in ('users', 'comics_data', 'issues_data', 'pages_data'):
+        connection.execute('ANALYZE %s' % tbl)
+    return counts
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Fills the database with a synthetic site of the '
+        'specified size. All generated comic and user ids start with "%s".'
+        % PREFIX)
+    parser.add_argument('config_uri', help='the configuration to use, e.g. development.ini')
+    parser.add_argument(
+        '-p', '--pages', type=int, default=10000,
+        help='the number of pages to generate (default: %(default)s)')
+    parser.add_argument(
+        '--pages-per-issue', type=int, default=20,
+        help='the average number of pages per issue (default: %(default)s)')
+    parser.add_argument(
+        '--issues-per-comic', type=int, default=50,
+        help='the maximum number of issues per comic (default: %(default)s)')
+    parser.add_argument(
+        '--readers', type=int, default=None,
+        help='the number of reader users to generate (default: one per '
+        'hundred pages)')
+    parser.add_argument(
+        '--future', type=float, default=0.05,
+        help='the fraction of pages scheduled for future publication '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--unpublished', type=float, default=0.01,
+        help='the fraction of pages with no publication date '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the random seed (default: %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    FilesThread.stop()
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    with transaction.manager:
+        counts = generate(
+            args.pages, pages_per_issue=args.pages_per_issue,
+            issues_per_comic=args.issues_per_comic, readers=args.readers,
+            future=args.future, unpublished=args.unpublished, seed=args.seed)
+        # The rows were inserted directly, so the session doesn't know it has
+        # changes to commit
+        mark_changed(DBSession())
+    for name in ('users', 'comics', 'issues', 'pages'):
+        print('Generated %d %s' % (counts[name], name))
@@ -1,6 +1,6 @@
+import io
 import os
 import sys
-import transaction
 
 from sqlalchemy import engine_from_config
 
@@ -11,28 +11,60 @@ from pyramid.paster import (
 
 from ratbot.models import (
     FilesThread,
-    DBSession,
-    Base,
+    verify_schema,
     )
 
 
+# The schema script in a source checkout; the models map several views (and
+# the INSTEAD OF triggers and functions behind them) which only this script
+# defines, so the schema can't be created from the models' metadata
+CREATE_SQL = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'sql', 'create.sql')
+
+
 def usage(argv):
     cmd = os.path.basename(argv[0])
-    print('usage: %s <config_uri>\n'
-          '(example: "%s development.ini")' % (cmd, cmd))
+    print('usage: %s <config_uri> [<create_sql>]\n'
+          '(example: "%s development.ini sql/create.sql")\n\n'
+          'Creates the database schema by running create_sql (sql/create.sql\n'
+          'in the source tree by default) against an empty PostgreSQL\n'
+          'database, then verifies the schema against the models' % (cmd, cmd))
     sys.exit(1)
 
 
 def main(argv=sys.argv):
     FilesThread.stop()
-    if len(argv) != 2:
+    if len(argv) not in (2, 3):
         usage(argv)
     config_uri = argv[1]
+    create_sql = argv[2] if len(argv) == 3 else CREATE_SQL
     setup_logging(config_uri)
     settings = get_appsettings(config_uri)
     engine = engine_from_config(settings, 'sqlalchemy.')
-    DBSession.configure(bind=engine)
-    Base.metadata.create_all(engine)
-    #with transaction.manager:
-    #    model = MyModel(name='one', value=1)
-    #    DBSession.add(model)
+    if engine.dialect.name != 'postgresql':
+        sys.exit('The ratbot schema requires PostgreSQL')
+    if engine.has_table('users'):
+        print('The database already has a schema; verifying it')
+    else:
+        if not os.path.exists(create_sql):
+            sys.exit(
+                'Cannot find %s; specify the path of sql/create.sql, or run it '
+                'with psql' % create_sql)
+        # The script is executed whole with the DB-API cursor, which (given
+        # no parameters) passes it verbatim to the server, plpgsql bodies
+        # and all
+        with io.open(create_sql, encoding='utf-8') as f:
+            script = f.read()
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(script)
+            cursor.close()
+            connection.commit()
+        finally:
+            connection.close()
+        print('Created the schema from %s' % create_sql)
+    with engine.connect() as connection:
+        if not verify_schema(connection):
+            sys.exit('The schema does not match the models; see the log')
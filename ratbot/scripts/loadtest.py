@@ -0,0 +1,293 @@
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+from webob import Request
+from sqlalchemy import func
+
+from pyramid.paster import (
+    get_app,
+    setup_logging,
+    )
+
+from ratbot.models import (
+    DBSession,
+    Page,
+    )
+
+
+# The default request mix as route name to relative weight
+DEFAULT_MIX = {
+    'page':          50,
+    'page_thumb':    25,
+    'page_bitmap':   17,
+    'issue_pdf':      4,
+    'issue_archive':  4,
+    }
+
+# The size of the thread pool in server.py
+DEFAULT_THREADS = 30
+
+# Routes that produce files which clients revalidate with conditional GETs
+FILE_ROUTES = {'page_thumb', 'page_bitmap', 'page_vector', 'issue_pdf', 'issue_archive'}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Target():
+    """
+    The published pages (and their issues) which requests are made against,
+    with the means to generate the URLs of each route for them.
+    """
+
+    def __init__(self, app, sample):
+        self.mapper = app.routes_mapper
+        with transaction.manager:
+            self.pages = [
+                (row.comic_id, row.issue_number, row.page_number)
+                for row in DBSession.query(
+                    Page.comic_id, Page.issue_number, Page.page_number).
+                filter(Page._published != None).
+                filter(Page._published <= func.current_timestamp()).
+                order_by(func.random()).limit(sample)
+                ]
+        if not self.pages:
+            raise ValueError('There are no published pages to request')
+
+    def path(self, route, page=None):
+        comic, issue, number = page or random.choice(self.pages)
+        return self.mapper.get_route(route).generate({
+            'comic': comic,
+            'issue': str(issue),
+            'page': str(number),
+            })
+
+
+class Harness():
+    """
+    Replays requests against *app* from a pool of *threads* threads (the
+    threaded server's workers), recording latencies and thread occupancy.
+    """
+
+    def __init__(self, app, threads, conditional):
+        self.app = app
+        self.threads = threads
+        self.conditional = conditional
+        self.lock = threading.Lock()
+        self.validators = {}
+        self.in_flight = 0
+        self.occupancy = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = defaultdict(list)
+            self.waits = []
+            self.statuses = defaultdict(Counter)
+            self.occupancy = []
+
+    def request(self, route, path, scheduled):
+        headers = {}
+        with self.lock:
+            self.in_flight += 1
+            validators = self.validators.get(path)
+        if validators and route in FILE_ROUTES and random.random() < self.conditional:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        start = time.perf_counter()
+        try:
+            response = Request.blank(path, headers=headers).get_response(self.app)
+            # Ensure the entire body is generated and read
+            response.body
+        finally:
+            finish = time.perf_counter()
+            with self.lock:
+                self.in_flight -= 1
+        with self.lock:
+            self.latencies[route].append(finish - scheduled)
+            self.waits.append(start - scheduled)
+            self.statuses[route][response.status_int] += 1
+            if response.status_int == 200 and route in FILE_ROUTES:
+                self.validators[path] = (
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'))
+
+    def sample_occupancy(self, stop):
+        while not stop.wait(0.01):
+            with self.lock:
+                self.occupancy.append(min(self.in_flight, self.threads))
+
+    def run(self, requests, rate=None):
+        """
+        Makes *requests*, a list of (route, path) tuples. If *rate* is None,
+        every request is submitted at once (so the pool is always saturated);
+        otherwise requests arrive at *rate* per second in a Poisson process.
+        Returns the elapsed time.
+        """
+        stop = threading.Event()
+        sampler = threading.Thread(target=self.sample_occupancy, args=(stop,))
+        sampler.start()
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                futures = []
+                scheduled = start
+                for route, path in requests:
+                    if rate:
+                        scheduled += random.expovariate(rate)
+                        delay = scheduled - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    else:
+                        scheduled = time.perf_counter()
+                    futures.append(
+                        executor.submit(self.request, route, path, scheduled))
+                for future in futures:
+                    future.result()
+            return time.perf_counter() - start
+        finally:
+            stop.set()
+            sampler.join()
+
+    def report(self, title, elapsed):
+        print(title)
+        total = sum(len(l) for l in self.latencies.values())
+        print('  %d requests in %.2fs: %.1f requests/s' % (
+            total, elapsed, total / elapsed if elapsed else 0.0))
+        print('  %-14s %7s %9s %9s %9s  %s' % (
+            'route', 'count', 'p50', 'p99', 'max', 'statuses'))
+        for route, latencies in sorted(self.latencies.items()):
+            print('  %-14s %7d %8.1fms %8.1fms %8.1fms  %s' % (
+                route, len(latencies),
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                max(latencies) * 1000,
+                ' '.join('%d:%d' % (status, count) for status, count in
+                    sorted(self.statuses[route].items()))))
+        all_latencies = [l for latencies in self.latencies.values() for l in latencies]
+        print('  %-14s %7d %8.1fms %8.1fms %8.1fms' % (
+            'all', len(all_latencies),
+            percentile(all_latencies, 0.5) * 1000,
+            percentile(all_latencies, 0.99) * 1000,
+            max(all_latencies) * 1000 if all_latencies else 0.0))
+        if self.occupancy:
+            print('  threads: %.1f of %d busy on average, all busy %.0f%% of the '
+                'time; queue wait p50 %.1fms p99 %.1fms' % (
+                sum(self.occupancy) / len(self.occupancy),
+                self.threads,
+                100 * sum(1 for o in self.occupancy if o >= self.threads) / len(self.occupancy),
+                percentile(self.waits, 0.5) * 1000,
+                percentile(self.waits, 0.99) * 1000))
+        print()
+
+
+def parse_mix(s):
+    mix = {}
+    for item in s.split(','):
+        route, weight = item.split('=')
+        mix[route.strip()] = float(weight)
+    return mix
+
+
+def publish(pages):
+    """
+    Simulates the publication of *pages* by discarding their derivatives (and
+    those of their issues), so the next requests for them must be rendered
+    from scratch. Pages without a vector are skipped as their bitmaps can't
+    be regenerated.
+    """
+    with transaction.manager:
+        for key in pages:
+            page = DBSession.query(Page).get(key)
+            if page is not None and page.vector_filename:
+                page.bitmap = None
+                page.thumbnail = None
+                page.issue.invalidate()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Replays a mix of reader requests against the '
+        'application in-process and reports latency, throughput and thread '
+        'saturation.')
+    parser.add_argument('config_uri', help='the configuration to use, e.g. production.ini')
+    parser.add_argument(
+        '-n', '--requests', type=int, default=2000,
+        help='the number of requests to make (default: %(default)s)')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=DEFAULT_THREADS,
+        help='the number of request threads (default: %(default)s, as in '
+        'server.py)')
+    parser.add_argument(
+        '-r', '--rate', type=float, default=None,
+        help='the mean arrival rate in requests/s (default: submit all '
+        'requests at once, saturating the threads)')
+    parser.add_argument(
+        '-m', '--mix', type=parse_mix,
+        default=','.join('%s=%d' % i for i in sorted(DEFAULT_MIX.items())),
+        help='comma-separated route=weight pairs (default: %(default)s)')
+    parser.add_argument(
+        '-c', '--conditional', type=float, default=0.3,
+        help='the fraction of repeated file requests made conditional '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--sample', type=int, default=500,
+        help='the number of published pages to request (default: %(default)s)')
+    parser.add_argument(
+        '-b', '--burst', type=int, default=0, metavar='PAGES',
+        help='first simulate the publication of PAGES pages by discarding '
+        'their derivatives, then request them all at once (default: no '
+        'burst). NOTE: this modifies the database; the derivatives are '
+        'regenerated by the burst')
+    parser.add_argument(
+        '--seed', type=int, default=None,
+        help='the random seed')
+    args = parser.parse_args(argv[1:])
+
+    random.seed(args.seed)
+    setup_logging(args.config_uri)
+    app = get_app(args.config_uri, 'main')
+    target = Target(app, args.sample)
+    harness = Harness(app, args.threads, args.conditional)
+
+    if args.burst:
+        pages = random.sample(target.pages, min(args.burst, len(target.pages)))
+        publish(pages)
+        requests = [
+            (route, target.path(route, page))
+            for page in pages
+            for route in ('page', 'page_thumb', 'page_bitmap')
+            ]
+        requests.extend(
+            (route, target.path(route, page))
+            for page in {(c, i, 1) for (c, i, p) in pages}
+            for route in ('issue_pdf', 'issue_archive')
+            )
+        random.shuffle(requests)
+        elapsed = harness.run(requests)
+        harness.report('Cold burst after publishing %d pages' % len(pages), elapsed)
+        harness.reset()
+
+    routes = list(args.mix)
+    weights = [args.mix[route] for route in routes]
+    requests = [
+        (route, target.path(route))
+        for route in random.choices(routes, weights, k=args.requests)
+        ]
+    elapsed = harness.run(requests, rate=args.rate)
+    harness.report('Steady mix of %d requests' % len(requests), elapsed)
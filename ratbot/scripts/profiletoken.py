@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+import argparse
+
+from pyramid.paster import get_appsettings
+
+from ratbot.models import FilesThread
+from ratbot.profiler import PROFILE_HEADER, sign_token
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Prints a signed header which causes the requests that '
+        'carry it to be profiled (when profile.dir is configured)')
+    parser.add_argument('config_uri', help='the configuration to use, e.g. production.ini')
+    parser.add_argument(
+        '-l', '--lifetime', type=int, default=60,
+        help='the number of minutes the header is valid for (default: '
+        '%(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    FilesThread.stop()
+    settings = get_appsettings(args.config_uri)
+    if not settings.get('profile.dir'):
+        print('Warning: profile.dir is not set in %s' % args.config_uri,
+            file=sys.stderr)
+    print('%s: %s' % (PROFILE_HEADER, sign_token(
+        settings.get('session.secret', 'secret'),
+        time.time() + args.lifetime * 60)))
@@ -0,0 +1,51 @@
+import os
+import sys
+import transaction
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ratbot.markup import render
+from ratbot.models import (
+    FilesThread,
+    DBSession,
+    User,
+    Comic,
+    Issue,
+    Page,
+    )
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s development.ini")\n\n'
+          'Re-renders the stored HTML of every description. Run this after\n'
+          'upgrading the database, or changing ALLOWED_TAGS / ALLOWED_ATTRS\n'
+          'in ratbot.markup' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    FilesThread.stop()
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    with transaction.manager:
+        for cls in (User, Comic, Issue, Page):
+            count = 0
+            for obj in DBSession.query(cls):
+                html = render(obj.markup, obj.description)
+                if obj.description_html != html:
+                    obj.description_html = html
+                    count += 1
+            DBSession.flush()
+            print('Re-rendered %d %s description(s)' % (count, cls.__name__))
@@ -0,0 +1,81 @@
+import os
+import sys
+import signal
+import argparse
+import multiprocessing
+from datetime import timedelta
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ratbot.models import (
+    FilesThread,
+    DBSession,
+    )
+from ratbot.jobs import Worker
+
+
+def run_worker(settings):
+    # Each worker process needs its own engine (connections can't be shared
+    # across a fork)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine, info={
+        'site.files': os.path.normpath(os.path.expanduser(settings['site.files'])),
+        })
+    worker = Worker(
+        engine,
+        max_attempts=int(settings.get('render.max_attempts', 5)),
+        backoff=int(settings.get('render.backoff', 30)),
+        lease=int(settings.get('render.lease', 600)),
+        keep=timedelta(days=int(settings.get('render.keep', 7))),
+        )
+    def terminate(signum, frame):
+        worker.terminated = True
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    worker.run()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Runs render workers which generate the derivative files '
+        'queued in the render_jobs table (see render.queue). Workers may be '
+        'run on any machine which shares the database and the site.files '
+        'directory.')
+    parser.add_argument('config_uri', help='the configuration to use, e.g. production.ini')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+        help='the number of worker processes to run (default: the number of '
+        'CPUs, %(default)s)')
+    args = parser.parse_args(argv[1:])
+
+    FilesThread.stop()
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    processes = [
+        multiprocessing.Process(
+            target=run_worker, args=(settings,),
+            name='render-worker-%d' % i)
+        for i in range(args.workers)
+        ]
+    for process in processes:
+        process.start()
+    def terminate(signum, frame):
+        # Pass the signal on; the workers stop once they've finished their
+        # current jobs
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers received the SIGINT too, and will stop once they've
+        # finished their current jobs
+        for process in processes:
+            process.join()
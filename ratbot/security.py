@@ -34,6 +34,7 @@ from .models import (
     Page,
     User,
     )
+from .sessions import session_cookie_name
 
 
 class Permission():
@@ -80,6 +81,48 @@ class RequestWithUser(Request):
         if user_id:
             return DBSession.query(User).get(user_id)
 
+    @reify
+    def flashes(self):
+        # Only consult the session if the client already has one; popping the
+        # flash queue of a new session would otherwise start a session for
+        # every reader that views a page
+        if session_cookie_name(self.registry.settings) in self.cookies:
+            return self.session.pop_flash()
+        return []
+
+    @reify
+    def permission_cache(self):
+        # Maps (permission, id(context)) to (context, result); the context is
+        # kept both to keep it alive (so its id can't be re-used) and to
+        # verify the match
+        return {}
+
+    @reify
+    def principal_cache(self):
+        # Maps id(context) to (context, principals) for group_finder
+        return {}
+
+    def has_permission(self, permission, context=None):
+        """
+        Memoized version of :meth:`pyramid.request.Request.has_permission`.
+        Templates check the same few permissions against the same context
+        many times (once per row in some listings); only the first check of
+        each permission evaluates the ACL.
+        """
+        if context is None:
+            context = self.context
+        key = (permission, id(context))
+        try:
+            cached_context, result = self.permission_cache[key]
+        except KeyError:
+            pass
+        else:
+            if cached_context is context:
+                return result
+        result = super().has_permission(permission, context)
+        self.permission_cache[key] = (context, result)
+        return result
+
 
 class RootContextFactory():
     __acl__ = [
@@ -137,19 +180,31 @@ class PageContextFactory(RootContextFactory):
 
 
 def group_finder(user_name, request):
-    user = request.user
-    if not user:
-        return None
-    principals = []
     try:
         context = request.context
     except AttributeError:
+        context = None
+    try:
+        cached_context, principals = request.principal_cache[id(context)]
+    except KeyError:
         pass
     else:
-        if isinstance(context, (ComicContextFactory, IssueContextFactory, PageContextFactory)):
-            if user.user_id == context.comic.author_id:
-                principals.append(Principal.author)
+        if cached_context is context:
+            return principals
+    principals = _find_groups(request.user, context)
+    request.principal_cache[id(context)] = (context, principals)
+    return principals
+
+
+def _find_groups(user, context):
+    # Anonymous users have no groups, so there's no need to load the context's
+    # comic to check its author
+    if not user:
+        return None
+    principals = []
+    if isinstance(context, (ComicContextFactory, IssueContextFactory, PageContextFactory)):
+        if user.user_id == context.comic.author_id:
+            principals.append(Principal.author)
     if user.admin:
         principals.append(Principal.admin)
     return principals
-
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Constructs the session factory from Paste style settings.
+
+With ``session.type = cookie`` the (small) session payload is stored in a
+cookie signed with ``session.secret``, which requires no storage or locking on
+the server and works across any number of hosts. Any other session type is
+handed to pyramid_beaker as before.
+
+Either way, readers only acquire a session when something is stored in it (a
+login, or a flash message); see :attr:`ratbot.security.RequestWithUser.flashes`.
+"""
+
+import json
+
+from pyramid.settings import asbool
+
+
+__all__ = [
+    'JSONSerializer',
+    'session_cookie_name',
+    'session_factory_from_settings',
+    ]
+
+
+class JSONSerializer():
+    """
+    Serializes cookie sessions as JSON. Pyramid's default is pickle, which
+    would let anyone who learned ``session.secret`` run code on the server.
+    """
+    def dumps(self, appstruct):
+        return json.dumps(appstruct, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, bstruct):
+        # Pyramid treats a ValueError as an invalid (e.g. old pickled)
+        # session, and starts a new one
+        try:
+            return json.loads(bstruct.decode('utf-8'))
+        except UnicodeDecodeError as e:
+            raise ValueError(str(e))
+
+
+def session_cookie_name(settings):
+    "Returns the name of the cookie that holds (or identifies) the session"
+    if settings.get('session.type') == 'cookie':
+        return settings.get('session.key', 'session')
+    else:
+        return settings.get('session.key', 'beaker.session.id')
+
+
+def session_factory_from_settings(settings):
+    if settings.get('session.type') == 'cookie':
+        from pyramid.session import SignedCookieSessionFactory
+        return SignedCookieSessionFactory(
+            settings['session.secret'],
+            cookie_name=session_cookie_name(settings),
+            secure=asbool(settings.get('session.secure', False)),
+            httponly=asbool(settings.get('session.httponly', True)),
+            timeout=int(settings.get('session.timeout', 3600)),
+            set_on_exception=asbool(settings.get('session.cookie_on_exception', True)),
+            hashalg='sha512',
+            serializer=JSONSerializer(),
+            )
+    else:
+        from pyramid_beaker import session_factory_from_settings
+        return session_factory_from_settings(settings)
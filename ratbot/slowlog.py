@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logs requests which take longer than ``slowlog.threshold`` milliseconds, with
+a breakdown of where the time went.
+
+The time of each request is split into phases by the :func:`phase` context
+manager, which the context factories, the derivative create methods and the
+template renderer are wrapped in. Phases are exclusive: time spent in a phase
+nested within another (e.g. rendering a bitmap while creating a thumbnail)
+only counts towards the inner phase. The remainder of the request is
+reported as "other". SQL time is measured separately and overlaps the
+phases.
+
+Entries are written to the "ratbot.slowlog" logger at WARNING level. The
+handlers of that logger are moved behind a queue, so entries are written by a
+background thread rather than the request's.
+"""
+
+import time
+import queue
+import atexit
+import threading
+import contextlib
+from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener
+import logging
+log = logging.getLogger(__name__)
+
+from .sqlstats import query_counter
+
+
+__all__ = [
+    'PHASES',
+    'phase',
+    'timed_factory',
+    'template_renderer_factory',
+    'record_user',
+    'slowlog_tween_factory',
+    ]
+
+
+# The phases reported, in order
+PHASES = ('context', 'freshness', 'render', 'template')
+
+_local = threading.local()
+
+
+class Phase():
+    """
+    A phase of a request, as yielded by :func:`phase`. The :attr:`name` may
+    be changed before the phase ends, when what the phase turned out to be
+    is only known at the end.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+
+class PhaseTimer():
+    """
+    Accumulates the time spent in each phase of a request, in :attr:`totals`.
+    """
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.user_class = None
+        self._stack = []
+
+    def push(self, phase):
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            self.totals[parent.name] += now - parent.start
+        phase.start = now
+        self._stack.append(phase)
+
+    def pop(self):
+        now = time.perf_counter()
+        phase = self._stack.pop()
+        self.totals[phase.name] += now - phase.start
+        if self._stack:
+            self._stack[-1].start = now
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Attributes the time spent within the context to the phase *name* of the
+    current request, if it's being timed. Yields a :class:`Phase`.
+    """
+    p = Phase(name)
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        yield p
+    else:
+        timer.push(p)
+        try:
+            yield p
+        finally:
+            timer.pop()
+
+
+def timed_factory(factory):
+    "Wraps the context *factory* of a route in the context phase"
+    def wrapper(request):
+        with phase('context'):
+            return factory(request)
+    return wrapper
+
+
+def template_renderer_factory(info):
+    "Wraps pyramid_chameleon's renderers in the template phase"
+    from pyramid_chameleon.zpt import renderer_factory
+    renderer = renderer_factory(info)
+    def render(value, system):
+        with phase('template'):
+            return renderer(value, system)
+    return render
+
+
+def record_user(event):
+    """
+    A NewResponse subscriber recording the class of user that made the
+    request. This runs before the transaction ends, but only uses the user
+    if something else has already loaded it.
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        request = event.request
+        if 'user' in request.__dict__:
+            user = request.user
+            timer.user_class = (
+                'anonymous' if user is None else
+                'admin' if user.admin else
+                'user')
+        elif request.unauthenticated_userid:
+            timer.user_class = 'user'
+        else:
+            timer.user_class = 'anonymous'
+
+
+def buffer_logger(logger):
+    """
+    Moves the handlers which would handle records of *logger* behind a queue,
+    so that they're called by a background thread. Does nothing if *logger*
+    is already buffered (e.g. when the application is created again).
+    """
+    if any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        return
+    handlers = []
+    current = logger
+    while current is not None:
+        handlers.extend(current.handlers)
+        if not current.propagate:
+            break
+        current = current.parent
+    records = queue.Queue()
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    logger.handlers = [QueueHandler(records)]
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def slowlog_tween_factory(handler, registry):
+    """
+    Logs requests which take longer than ``slowlog.threshold`` milliseconds
+    with the route, matchdict, class of user, and the time spent in SQL and
+    each of the :data:`PHASES`.
+    """
+    threshold = float(registry.settings['slowlog.threshold']) / 1000
+    buffer_logger(log)
+
+    def slowlog_tween(request):
+        timer = _local.timer = PhaseTimer()
+        start = time.perf_counter()
+        try:
+            with query_counter() as stats:
+                return handler(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            _local.timer = None
+            if elapsed >= threshold:
+                route = request.matched_route.name if request.matched_route else None
+                log.warning(
+                    'Slow request %s %s took %.1fms: route=%s matchdict=%r '
+                    'user=%s sql=%.1fms (%d queries) %s other=%.1fms',
+                    request.method, request.path_qs, elapsed * 1000, route,
+                    request.matchdict, timer.user_class, stats.seconds * 1000,
+                    stats.count, ' '.join(
+                        '%s=%.1fms' % (name, timer.totals[name] * 1000)
+                        for name in PHASES),
+                    (elapsed - sum(timer.totals.values())) * 1000)
+
+    return slowlog_tween
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Counts the SQL statements executed, and the time spent executing them, per
+request.
+
+Statements are counted by engine events, so they're counted whichever engine
+(primary or replica) executes them. Counts are kept per thread: a
+:func:`query_counter` only sees the statements executed by the thread that
+entered it. Counters may be nested; every active counter in the thread counts
+each statement.
+
+Within tests, :func:`query_counter` can be used to assert a budget for a
+route::
+
+    with query_counter() as stats:
+        app.get('/comics.html')
+    assert stats.count <= 5, stats.statements
+"""
+
+import time
+import threading
+import contextlib
+import logging
+log = logging.getLogger(__name__)
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from pyramid.settings import asbool
+
+from .metrics import REQUEST_DB_SECONDS, REQUEST_QUERIES
+
+
+__all__ = [
+    'QueryStats',
+    'query_counter',
+    'sqlstats_tween_factory',
+    ]
+
+
+# Response headers reporting the statistics, when enabled by sqlstats.headers
+COUNT_HEADER = 'X-SQL-Queries'
+TIME_HEADER = 'X-SQL-Time'
+
+_local = threading.local()
+
+
+class QueryStats():
+    """
+    The statements executed within a :func:`query_counter`. :attr:`count` is
+    the number of statements, and :attr:`seconds` the total time spent
+    executing them. If *record* is True, :attr:`statements` lists the SQL of
+    each statement executed (useful when a budget assertion fails).
+    """
+
+    def __init__(self, record=False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] if record else None
+
+    def __repr__(self):
+        return '<QueryStats count=%d seconds=%.3f>' % (self.count, self.seconds)
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+def _counters():
+    try:
+        return _local.counters
+    except AttributeError:
+        _local.counters = []
+        return _local.counters
+
+
+@contextlib.contextmanager
+def query_counter(record=False):
+    """
+    Counts the SQL statements executed by the calling thread within the
+    context, yielding a :class:`QueryStats` instance.
+    """
+    stats = QueryStats(record)
+    counters = _counters()
+    counters.append(stats)
+    try:
+        yield stats
+    finally:
+        counters.remove(stats)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _counters():
+        conn.info.setdefault('sqlstats.start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counters = _counters()
+    if counters:
+        try:
+            start = conn.info['sqlstats.start'].pop()
+        except (KeyError, IndexError):
+            # The counter was entered part way through the statement
+            return
+        seconds = time.perf_counter() - start
+        for stats in counters:
+            stats.add(statement, seconds)
+
+
+def sqlstats_tween_factory(handler, registry):
+    """
+    Counts the SQL statements executed by each request, including those of
+    the transaction's commit.
+
+    If ``sqlstats.headers`` is true (intended for development), the count and
+    total time (in milliseconds) are added to the response as the
+    X-SQL-Queries and X-SQL-Time headers. Every request's statistics are
+    logged at DEBUG level, and those of requests which exceed
+    ``sqlstats.budget`` statements or ``sqlstats.time`` milliseconds are logged
+    at WARNING level. The statistics of every request are also recorded in the
+    metrics (see :mod:`ratbot.metrics`) by route.
+    """
+    headers = asbool(registry.settings.get('sqlstats.headers', False))
+    budget = int(registry.settings.get('sqlstats.budget', 25))
+    time_budget = float(registry.settings.get('sqlstats.time', 250)) / 1000
+
+    def sqlstats_tween(request):
+        with query_counter() as stats:
+            response = handler(request)
+        request.sql_stats = stats
+        route = request.matched_route.name if request.matched_route else None
+        REQUEST_DB_SECONDS.observe(stats.seconds, route or '-')
+        REQUEST_QUERIES.observe(stats.count, route or '-')
+        if stats.count > budget or stats.seconds > time_budget:
+            log.warning(
+                '%d queries in %.1fms for %s %s (route %s)',
+                stats.count, stats.seconds * 1000,
+                request.method, request.path_qs, route)
+        else:
+            log.debug(
+                '%d queries in %.1fms for %s %s (route %s)',
+                stats.count, stats.seconds * 1000,
+                request.method, request.path_qs, route)
+        if headers:
+            response.headers[COUNT_HEADER] = str(stats.count)
+            response.headers[TIME_HEADER] = '%.1f' % (stats.seconds * 1000)
+        return response
+
+    return sqlstats_tween
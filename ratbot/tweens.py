@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Defines the tweens used by the application.
+
+Tweens wrap the entire request, including route matching and the context
+factories, which makes them the place to decide how the database should be
+accessed before anything has touched it.
+"""
+
+import random
+import logging
+log = logging.getLogger(__name__)
+
+import transaction
+from pyramid.interfaces import IRoutesMapper
+
+from .db_session import DBSession
+
+
+# Name of the cookie which directs a client's reads to the primary database
+# for a short period after it has written to it
+PRIMARY_COOKIE = 'ratbot.primary'
+
+
+def route_name(request):
+    """
+    Return the name of the route that *request* will match, or None if it
+    matches no route. This permits tweens to make decisions based on the route
+    before the router has matched it.
+    """
+    mapper = request.registry.queryUtility(IRoutesMapper)
+    if mapper is not None:
+        route = mapper(request)['route']
+        if route is not None:
+            return route.name
+
+
+def tm_activate_hook(request):
+    """
+    Used as pyramid_tm's ``tm.activate_hook`` to exclude read-only requests
+    (see :func:`database_tween_factory`) from the transaction manager.
+    """
+    return not DBSession().info.get('read_only', False)
+
+
+def database_tween_factory(handler, registry):
+    """
+    Decides how each request will access the database, before routing (and
+    therefore the context factories) can touch it.
+
+    GET and HEAD requests for the reader routes (those defined in
+    :mod:`ratbot.views.comics`) which never write run in a light-weight
+    read-only mode: the transaction is marked READ ONLY, autoflush is
+    disabled, pyramid_tm is bypassed (see :func:`tm_activate_hook`) and the
+    transaction is simply discarded at the end of the request.
+
+    If any replica engines are configured in the "replicas" entry of
+    DBSession's info, reads for all the reader routes are directed to one of
+    them. Any request which writes to the database sets a cookie which sends
+    the client's subsequent requests to the primary for ``replica.window``
+    seconds, so that administrators see their own changes despite any
+    replication lag.
+    """
+    from .views.comics import routes as comic_routes, DERIVATIVE_ROUTES
+    reader_routes = {name for (name, pattern) in comic_routes()}
+    read_only_routes = reader_routes - DERIVATIVE_ROUTES
+    window = int(registry.settings.get('replica.window', 10))
+
+    def database_tween(request):
+        session = DBSession()
+        replicas = session.info.get('replicas')
+        if request.method in ('GET', 'HEAD'):
+            route = route_name(request)
+        else:
+            route = None
+        read_only = route in read_only_routes
+        session.info['read_only'] = read_only
+        session.info['replica'] = None
+        session.info['wrote'] = False
+        session.autoflush = not read_only
+        if (
+                replicas and
+                route in reader_routes and
+                PRIMARY_COOKIE not in request.cookies):
+            session.info['replica'] = random.choice(replicas)
+        try:
+            response = handler(request)
+        finally:
+            if read_only:
+                # Nothing can have been written so there's nothing to commit;
+                # just throw away the transaction zope.sqlalchemy joined
+                transaction.manager.abort()
+        if session.info['wrote']:
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=window, httponly=True)
+        return response
+
+    return database_tween
@@ -27,6 +27,7 @@ from formencode import (
     )
 from pyramid.threadlocal import get_current_registry
 
+from .licenses import License
 from .markup import MARKUP_LANGUAGES
 from .models import (
     DBSession,
@@ -129,7 +130,11 @@ class ValidLicense(validators.OneOf):
         super().validate_python(value.id, state)
 
     def _to_python(self, value, state):
-        return get_current_registry()['licenses']()[value]
+        # Unknown licenses are rejected by validate_python
+        try:
+            return get_current_registry()['licenses']()[value]
+        except KeyError:
+            return License.unknown(value)
 
     def _from_python(self, value, state):
         return value.id
@@ -32,6 +32,7 @@ import webhelpers2.constants
 import webhelpers2.containers
 from pyramid.decorator import reify
 from pyramid.renderers import get_renderer
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.events import subscriber, BeforeRender
 
 from .. import html, markup
@@ -51,6 +52,84 @@ def renderer_globals(event):
     event['Principal'] = Principal
 
 
+class KeysetPager():
+    """
+    Paginates *query* with keyset (or "seek") pagination on *column* which
+    must be unique within the query's results (e.g. an issue or page number).
+    The query must not already be ordered.
+
+    Rather than an offset, the current position is given by the ``after`` or
+    ``before`` parameters of the *request*, which hold the key of the last (or
+    first) row of the adjacent page; *key_type* is used to convert these back
+    to the type of *column*. Every page therefore costs the same to retrieve
+    regardless of how far into the listing it lies.
+
+    The rows of the current page can be retrieved by iterating over the pager.
+    The :attr:`prior_url` and :attr:`next_url` attributes provide links to
+    the adjacent pages (or None if there is no such page).
+    """
+
+    def __init__(self, request, query, column, key_type=int, page_size=20,
+            descending=False):
+        self.request = request
+        self.column = column
+        self.page_size = page_size
+        try:
+            after = request.GET.get('after')
+            before = request.GET.get('before')
+            after = key_type(after) if after is not None else None
+            before = key_type(before) if before is not None else None
+        except ValueError:
+            raise HTTPBadRequest('Invalid pagination key')
+        forward = column.desc() if descending else column.asc()
+        backward = column.asc() if descending else column.desc()
+        if before is not None:
+            # Seek backward from the key, then reverse the rows to restore
+            # display order
+            rows = query.filter(
+                column > before if descending else column < before
+                ).order_by(backward).limit(page_size + 1).all()
+            self.has_prior = len(rows) > page_size
+            self.has_next = True
+            self.rows = rows[:page_size][::-1]
+        else:
+            if after is not None:
+                query = query.filter(
+                    column < after if descending else column > after)
+            rows = query.order_by(forward).limit(page_size + 1).all()
+            self.has_prior = after is not None
+            self.has_next = len(rows) > page_size
+            self.rows = rows[:page_size]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _key(self, row):
+        return getattr(row, self.column.key)
+
+    def _url(self, **kw):
+        query = [
+            (key, value)
+            for (key, value) in self.request.GET.items()
+            if key not in ('after', 'before')
+            ]
+        query.extend(kw.items())
+        return self.request.current_route_url(_query=query)
+
+    @property
+    def prior_url(self):
+        if self.has_prior and self.rows:
+            return self._url(before=self._key(self.rows[0]))
+
+    @property
+    def next_url(self):
+        if self.has_next and self.rows:
+            return self._url(after=self._key(self.rows[-1]))
+
+
 class BaseView():
     def __init__(self, context, request):
         self.context = context
@@ -71,6 +150,11 @@ class BaseView():
         renderer = get_renderer('../templates/nav_page.pt')
         return renderer.implementation().macros['nav-page']
 
+    @reify
+    def pager(self):
+        renderer = get_renderer('../templates/pager.pt')
+        return renderer.implementation().macros['pager']
+
     @reify
     def flashes(self):
         renderer = get_renderer('../templates/flashes.pt')
@@ -34,7 +34,7 @@ from pyramid.security import remember, forget
 from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
-from . import BaseView
+from . import BaseView, KeysetPager
 from ..forms import Form, FormRendererFoundation
 from ..markup import MARKUP_LANGUAGES
 from ..models import (
@@ -56,6 +56,10 @@ from ..schemas import (
     )
 
 
+# Number of users shown per page of the administration index
+USERS_PAGE_SIZE = 30
+
+
 def is_upload(request, name):
     return isinstance(request.POST.get(name), cgi.FieldStorage)
 
@@ -120,20 +124,17 @@ class AdminView(BaseView):
             permission=Permission.view_admin,
             renderer='../templates/admin/index.pt')
     def index(self):
-        comics_query = DBSession.query(
-                Comic,
+        comics_query = Comic.summary()
+        users_query = DBSession.query(
+                User.user_id,
                 User.name,
-                func.count(Issue.issue_number),
-            ).outerjoin(Issue).join(User).group_by(
-                Comic,
-                User.name
-            ).order_by(
-                Comic.title
+                User.admin,
             )
-        users_query = DBSession.query(User).order_by(User.name)
         return {
                 'comics': comics_query,
-                'users': users_query,
+                'users': KeysetPager(
+                    self.request, users_query, User.user_id, key_type=str,
+                    page_size=USERS_PAGE_SIZE),
                 }
 
     @view_config(
@@ -299,25 +300,20 @@ class AdminView(BaseView):
                     self.request.route_url('blog_index', comic='blog'),
                 variable_decode=True)
         if form.validate():
+            # Grab a copy of the comic ID before the object becomes invalid
+            comic_id = issue.comic_id
             if bool(self.request.POST.get('delete', '')):
-                DBSession.delete(issue)
                 self.request.session.flash('Deleted issue #%d of %s' % (
                     issue.issue_number,
                     issue.comic.title,
                     ))
-                for i in DBSession.query(Issue).filter(
-                        (Issue.comic_id == issue.comic_id) &
-                        (Issue.issue_number > issue.issue_number)
-                        ).order_by(Issue.issue_number):
-                    i.issue_number = i.issue_number - 1
+                issue.comic.remove_issue(issue)
             else:
                 form.bind(issue)
                 self.request.session.flash('Updated issue #%d of %s' % (
                     issue.issue_number,
                     issue.comic.title,
                     ))
-            # Grab a copy of the comic ID before the object becomes invalid
-            comic_id = issue.comic_id
             DBSession.flush()
             return HTTPFound(location=
                     self.request.route_url('issues', comic=comic_id)
@@ -409,19 +405,17 @@ class AdminView(BaseView):
                 if self.request.POST['thumbnail'].type != 'image/png':
                     form.errors['thumbnail'] = 'Bitmap must be a PNG image'
         if form.validate():
+            # Grab a copy of the issue and comic ID before the object becomes
+            # invalid
+            issue = page.issue
+            comic_id = page.comic_id
             if bool(self.request.POST.get('delete', '')):
-                DBSession.delete(page)
                 self.request.session.flash('Deleted page %d of %s #%d' % (
                     page.page_number,
-                    page.issue.comic.title,
+                    issue.comic.title,
                     page.issue_number,
                     ))
-                for p in DBSession.query(Page).filter(
-                        (Page.comic_id == page.comic_id) &
-                        (Page.issue_number == page.issue_number) &
-                        (Page.page_number > page.page_number)
-                        ).order_by(Page.page_number):
-                    p.page_number = p.page_number - 1
+                issue.remove_page(page)
             else:
                 if bool(self.request.POST.get('delete_vector', '')):
                     page.vector = None
@@ -441,9 +435,7 @@ class AdminView(BaseView):
                     page.issue.comic.title,
                     page.issue_number,
                     ))
-            page.issue.invalidate()
-            # Grab a copy of the comic ID before the object becomes invalid
-            comic_id = page.comic_id
+            issue.invalidate()
             DBSession.flush()
             return HTTPFound(location=
                     self.request.route_url('issues', comic=comic_id)
@@ -24,14 +24,18 @@ import logging
 from sqlite3 import Connection as SQLite3Connection
 log = logging.getLogger(__name__)
 
+import transaction
 from pyramid.response import FileResponse
-from pyramid.httpexceptions import HTTPFound, HTTPMovedPermanently
+from pyramid.httpexceptions import HTTPFound, HTTPMovedPermanently, HTTPAccepted
 from pyramid.view import view_config
-from sqlalchemy import func, text
+from sqlalchemy import func
 from velruse.api import login_url
+from zope.sqlalchemy import mark_changed
 
-from . import BaseView
+from . import BaseView, KeysetPager
 from ..forms import Form, FormRendererFoundation
+from ..jobs import enqueue, issue_version, ISSUE_JOB
+from ..metrics import FILE_REQUESTS
 from ..models import (
     DBSession,
     Page,
@@ -41,6 +45,30 @@ from ..models import (
     utcnow,
     adjacent,
     )
+from ..security import Permission
+
+
+# Reader routes which may write to the database (to record the filenames of
+# the derivatives they generate); all other reader routes are read-only
+DERIVATIVE_ROUTES = {
+    'issue_archive',
+    'issue_pdf',
+    'page_bitmap',
+    'page_thumb',
+    }
+
+# Derivatives which are expensive enough to build that requests for them are
+# subject to the build budget (see ratbot.admission)
+BUDGETED_DERIVATIVES = {
+    'archive',
+    'pdf',
+    }
+
+# Number of issues shown per page of a comic's issue list
+ISSUES_PAGE_SIZE = 24
+
+# Number of posts shown per page of a blog month
+BLOG_PAGE_SIZE = 10
 
 
 class FileResponseEtag(FileResponse):
@@ -60,19 +88,79 @@ class FileResponseEtag(FileResponse):
 
 
 class ComicsView(BaseView):
+    def derivative_response(self, obj, derivative):
+        """
+        Brings the *derivative* file of *obj* up to date with its create
+        method (e.g. create_pdf for "pdf"), and returns a response serving
+        it. Counts whether the file had to be rendered.
+
+        If *derivative* is one of the :data:`BUDGETED_DERIVATIVES` and must be
+        built, but the build budget is exhausted or another request is
+        already building it, returns 202 Accepted instead.
+        """
+        if derivative in BUDGETED_DERIVATIVES and self.stale(obj, derivative):
+            budget = self.request.registry['build_budget']
+            key = (derivative, obj.comic_id, obj.issue_number)
+            if not budget.admit(key):
+                return self.deferred_response(obj, derivative, budget.retry_after)
+            budget.release_after(key, transaction.get())
+        return self.file_response(obj, derivative)
+
+    def stale(self, obj, derivative):
+        """
+        Returns True if the *derivative* file of *obj* must be built. The
+        request may be reading from a replica which hasn't caught up with
+        another request's build yet, so a stale file is checked again against
+        the primary (which the rest of the request then reads from too).
+        """
+        if not getattr(obj, derivative + '_stale'):
+            return False
+        session = DBSession()
+        if session.info.get('replica') is not None:
+            session.info['replica'] = None
+            session.refresh(obj)
+            return getattr(obj, derivative + '_stale')
+        return True
+
+    def file_response(self, obj, derivative):
+        before = getattr(obj, derivative + '_filename')
+        getattr(obj, 'create_' + derivative)()
+        filename = getattr(obj, derivative + '_filename')
+        FILE_REQUESTS.inc(
+            self.request.matched_route.name,
+            'warm' if filename == before else 'cold')
+        return FileResponseEtag(filename, request=self.request)
+
+    def deferred_response(self, issue, derivative, retry_after):
+        """
+        Returns a 202 Accepted response asking the client to retry after
+        *retry_after* seconds. If the render queue is enabled, the build is
+        queued so a render worker can get on with it in the meantime.
+        """
+        FILE_REQUESTS.inc(self.request.matched_route.name, 'deferred')
+        session = DBSession()
+        if session.info.get('render.queue'):
+            # Explicitly use the primary, as the request may be reading from
+            # a replica. The issue's published date is that of its latest
+            # page, so this is usually the job publication already queued
+            enqueue(
+                session.connection(bind=session.bind),
+                issue.comic_id, issue.issue_number, ISSUE_JOB, derivative,
+                issue_version(issue.published))
+            mark_changed(session)
+        response = HTTPAccepted(
+            'The file is being prepared; please try again in %d seconds' %
+            retry_after)
+        response.retry_after = retry_after
+        response.cache_control = 'no-store'
+        return response
+
     @view_config(
             route_name='index',
             renderer='../templates/comics/index.pt')
     def index(self):
-        latest_query = DBSession.query('comic_id', 'issue_number', 'page_number', 'published').from_statement(
-            text(
-                "SELECT comic_id, issue_number, page_number, published "
-                "FROM front_pages "
-                "ORDER BY published DESC "
-                "LIMIT 6")
-            )
         return {
-                'latest': latest_query,
+                'latest': Page.latest(),
                 'login_url': login_url,
                 }
 
@@ -89,15 +177,38 @@ class ComicsView(BaseView):
             route_name='blog_issue',
             renderer='../templates/comics/blog.pt')
     def blog_issue(self):
-        return {}
+        pages = DBSession.query(Page).filter(
+                (Page.comic_id == self.context.issue.comic_id) &
+                (Page.issue_number == self.context.issue.issue_number)
+                )
+        if not self.request.has_permission(
+                Permission.view_unpublished, self.context):
+            pages = pages.filter(
+                (Page._published != None) &
+                (Page._published <= func.current_timestamp())
+                )
+        return {
+            'pages': KeysetPager(
+                self.request, pages, Page.page_number,
+                page_size=BLOG_PAGE_SIZE, descending=True),
+            }
 
     @view_config(
             route_name='bio',
             renderer='../templates/comics/bio.pt')
     def bio(self):
+        # Listings query only the displayed columns; the rows returned are
+        # light-weight named tuples rather than full ORM entities
         return {
-            'authors': DBSession.query(User).\
-                    join(Comic).\
+            'authors': DBSession.query(
+                        User.user_id,
+                        User.name,
+                        User.markup,
+                        User.description,
+                        User.description_html,
+                        User._bitmap.label('bitmap_filename'),
+                    ).\
+                    join(Comic, Comic.author_id == User.user_id).\
                     distinct().\
                     order_by(User.name),
             }
@@ -107,16 +218,22 @@ class ComicsView(BaseView):
             renderer='../templates/comics/comics.pt')
     def comics(self):
         return {
-            'comics': DBSession.query(Comic).\
-                    filter(Comic.comic_id != 'blog').\
-                    order_by(Comic.latest_publication.desc()),
+            'comics': Comic.listing(),
             }
 
     @view_config(
             route_name='issues',
             renderer='../templates/comics/issues.pt')
     def issues(self):
-        return {}
+        issues = Issue.listing(
+            self.context.comic.comic_id,
+            published_only=not self.request.has_permission(
+                Permission.view_unpublished, self.context))
+        return {
+            'issues': KeysetPager(
+                self.request, issues, Issue.issue_number,
+                page_size=ISSUES_PAGE_SIZE, descending=True),
+            }
 
     @view_config(
             route_name='issue',
@@ -132,13 +249,11 @@ class ComicsView(BaseView):
 
     @view_config(route_name='issue_archive')
     def issue_archive(self):
-        self.context.issue.create_archive()
-        return FileResponseEtag(self.context.issue.archive_filename, request=self.request)
+        return self.derivative_response(self.context.issue, 'archive')
 
     @view_config(route_name='issue_pdf')
     def issue_pdf(self):
-        self.context.issue.create_pdf()
-        return FileResponseEtag(self.context.issue.pdf_filename, request=self.request)
+        return self.derivative_response(self.context.issue, 'pdf')
 
     @view_config(
             route_name='page',
@@ -153,13 +268,11 @@ class ComicsView(BaseView):
 
     @view_config(route_name='page_thumb')
     def page_thumb(self):
-        self.context.page.create_thumbnail()
-        return FileResponseEtag(self.context.page.thumbnail_filename, request=self.request)
+        return self.derivative_response(self.context.page, 'thumbnail')
 
     @view_config(route_name='page_bitmap')
     def page_bitmap(self):
-        self.context.page.create_bitmap()
-        return FileResponseEtag(self.context.page.bitmap_filename, request=self.request)
+        return self.derivative_response(self.context.page, 'bitmap')
 
     @view_config(route_name='page_vector')
     def page_vector(self):
@@ -68,9 +68,9 @@ __keywords__ = [
     ]
 
 __requires__ = [
-    'pyramid<1.7dev',
+    'pyramid>=1.6,<1.7dev',
     'sqlalchemy<1.4dev',
-    'transaction',
+    'transaction>=3.0',
     'pyramid_tm',
     'pyramid_beaker',
     'pyramid_debugtoolbar',
@@ -97,6 +97,7 @@ __requires__ = [
 __extra_requires__ = {
     'doc':   ['sphinx'],
     'test':  ['pytest', 'coverage', 'mock'],
+    'brotli': ['brotli'],
     }
 
 __entry_points__ = {
@@ -105,6 +106,14 @@ __entry_points__ = {
             ],
         'console_scripts': [
             'initialize_ratbot_db = ratbot.scripts.initializedb:main',
+            'render_ratbot_markup = ratbot.scripts.rendermarkup:main',
+            'build_ratbot_assets = ratbot.scripts.buildassets:main',
+            'bench_ratbot_render = ratbot.scripts.benchrender:main',
+            'bench_ratbot_queries = ratbot.scripts.benchqueries:main',
+            'generate_ratbot_data = ratbot.scripts.gendata:main',
+            'load_ratbot = ratbot.scripts.loadtest:main',
+            'profile_ratbot_token = ratbot.scripts.profiletoken:main',
+            'render_ratbot_workers = ratbot.scripts.renderworkers:main',
             ],
     }
 
@@ -0,0 +1,86 @@
+-- renumber_pages
+-------------------------------------------------------------------------------
+-- Closes the gap left in the page numbering of an issue after a page has been
+-- deleted, by decrementing the number of all subsequent pages in a single
+-- set-based operation. Subsequent pages are first moved beyond the current
+-- highest page number so that no intermediate state of either UPDATE
+-- collides with the primary key. Returns the number of pages renumbered.
+-------------------------------------------------------------------------------
+
+CREATE FUNCTION renumber_pages(
+    p_comic_id varchar,
+    p_issue_number integer,
+    p_page_number integer
+)
+    RETURNS integer
+    LANGUAGE plpgsql
+    VOLATILE
+AS $$
+DECLARE
+    shift integer;
+    moved integer;
+BEGIN
+    SELECT COALESCE(MAX(page_number), 0) INTO shift
+    FROM pages_data
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number = p_issue_number;
+
+    UPDATE pages_data SET
+        page_number = page_number + shift
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number = p_issue_number
+        AND page_number > p_page_number;
+    GET DIAGNOSTICS moved = ROW_COUNT;
+
+    UPDATE pages_data SET
+        page_number = page_number - shift - 1
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number = p_issue_number
+        AND page_number > shift;
+    RETURN moved;
+END;
+$$;
+
+-- renumber_issues
+-------------------------------------------------------------------------------
+-- Closes the gap left in the issue numbering of a comic after an issue has
+-- been deleted in the same manner as renumber_pages above. The pages of the
+-- renumbered issues follow them via the ON UPDATE CASCADE foreign key of
+-- pages_data. Returns the number of issues renumbered.
+-------------------------------------------------------------------------------
+
+CREATE FUNCTION renumber_issues(
+    p_comic_id varchar,
+    p_issue_number integer
+)
+    RETURNS integer
+    LANGUAGE plpgsql
+    VOLATILE
+AS $$
+DECLARE
+    shift integer;
+    moved integer;
+BEGIN
+    SELECT COALESCE(MAX(issue_number), 0) INTO shift
+    FROM issues_data
+    WHERE
+        comic_id = p_comic_id;
+
+    UPDATE issues_data SET
+        issue_number = issue_number + shift
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number > p_issue_number;
+    GET DIAGNOSTICS moved = ROW_COUNT;
+
+    UPDATE issues_data SET
+        issue_number = issue_number - shift - 1
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number > shift;
+    RETURN moved;
+END;
+$$;
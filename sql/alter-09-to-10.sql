@@ -0,0 +1,104 @@
+-- Adds the render_jobs queue, from which the render workers (run by
+-- render_ratbot_workers) generate derivative files in the background.
+
+-- render_jobs
+-------------------------------------------------------------------------------
+-- Queues the generation of derivative files (page bitmaps and thumbnails,
+-- issue archives and PDFs) for the render workers. Jobs for an issue have a
+-- page_number of 0. Each job is unique by its target, derivative, and the
+-- version of the source it was queued for (e.g. the vector filename, or the
+-- publication date of the page that triggered it), which de-duplicates
+-- repeated requests for the same work. Inserting jobs notifies the render_jobs
+-- channel to wake listening workers. Jobs which fail are retried after
+-- run_after until they've been attempted too many times.
+-------------------------------------------------------------------------------
+
+CREATE TABLE render_jobs (
+    job_id         serial NOT NULL,
+    comic_id       varchar(20) NOT NULL,
+    issue_number   integer NOT NULL,
+    page_number    integer DEFAULT 0 NOT NULL,
+    derivative     varchar(10) NOT NULL,
+    source_version varchar(200) NOT NULL,
+    state          varchar(10) DEFAULT 'pending' NOT NULL,
+    attempts       integer DEFAULT 0 NOT NULL,
+    created        timestamp DEFAULT current_timestamp NOT NULL,
+    run_after      timestamp DEFAULT current_timestamp NOT NULL,
+    started        timestamp DEFAULT NULL,
+    finished       timestamp DEFAULT NULL,
+    worker         varchar(200) DEFAULT NULL,
+    error          text DEFAULT NULL
+);
+
+ALTER TABLE render_jobs
+    ADD CONSTRAINT render_jobs_pkey PRIMARY KEY (job_id),
+    ADD CONSTRAINT render_jobs_source_key
+        UNIQUE (comic_id, issue_number, page_number, derivative, source_version),
+    ADD CONSTRAINT render_jobs_issue_fkey FOREIGN KEY (comic_id, issue_number)
+        REFERENCES issues_data(comic_id, issue_number) ON UPDATE CASCADE ON DELETE CASCADE,
+    ADD CONSTRAINT render_jobs_derivative_check
+        CHECK (derivative IN ('bitmap', 'thumbnail', 'archive', 'pdf')),
+    ADD CONSTRAINT render_jobs_state_check
+        CHECK (state IN ('pending', 'running', 'done', 'failed'));
+
+CREATE INDEX render_jobs_pending_idx ON render_jobs(run_after)
+    WHERE state IN ('pending', 'running');
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON render_jobs TO ratbot;
+GRANT USAGE ON render_jobs_job_id_seq TO ratbot;
+
+CREATE FUNCTION render_jobs_notify()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('render_jobs', '');
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER render_jobs_notify
+    AFTER INSERT ON render_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE render_jobs_notify();
+
+-- enqueue_render_job
+-------------------------------------------------------------------------------
+-- Queues a render job unless an identical job (by target, derivative and
+-- source version) already exists. Returns true if the job was queued.
+-------------------------------------------------------------------------------
+
+CREATE FUNCTION enqueue_render_job(
+    p_comic_id varchar,
+    p_issue_number integer,
+    p_page_number integer,
+    p_derivative varchar,
+    p_source_version varchar,
+    p_run_after timestamp
+)
+    RETURNS boolean
+    LANGUAGE plpgsql
+    VOLATILE
+AS $$
+BEGIN
+    INSERT INTO render_jobs (
+        comic_id,
+        issue_number,
+        page_number,
+        derivative,
+        source_version,
+        run_after
+    ) VALUES (
+        p_comic_id,
+        p_issue_number,
+        p_page_number,
+        p_derivative,
+        p_source_version,
+        GREATEST(COALESCE(p_run_after, current_timestamp), current_timestamp)
+    );
+    RETURN true;
+EXCEPTION
+    WHEN unique_violation THEN
+        RETURN false;
+END;
+$$;
@@ -14,6 +14,7 @@ CREATE TABLE users (
     admin       boolean DEFAULT false NOT NULL,
     markup      varchar(8) DEFAULT 'html' NOT NULL,
     description text DEFAULT '' NOT NULL,
+    description_html text DEFAULT NULL,
     bitmap      varchar(200) DEFAULT NULL
 );
 
@@ -36,6 +37,7 @@ CREATE TABLE comics_data (
     license_id   varchar(50) NOT NULL,
     markup       varchar(8) DEFAULT 'html' NOT NULL,
     description  text DEFAULT '' NOT NULL,
+    description_html text DEFAULT NULL,
     created      timestamp DEFAULT current_timestamp NOT NULL
 );
 
@@ -61,6 +63,7 @@ CREATE TABLE issues_data (
     title         varchar(500) NOT NULL,
     markup        varchar(8) DEFAULT 'html' NOT NULL,
     description   varchar DEFAULT '' NOT NULL,
+    description_html text DEFAULT NULL,
     created       timestamp DEFAULT current_timestamp NOT NULL,
     archive       varchar(200) DEFAULT NULL,
     pdf           varchar(200) DEFAULT NULL
@@ -90,6 +93,7 @@ CREATE TABLE pages_data (
     published    timestamp DEFAULT NULL,
     markup       varchar(8) DEFAULT 'html' NOT NULL,
     description  text DEFAULT '' NOT NULL,
+    description_html text DEFAULT NULL,
     thumbnail    varchar(200) DEFAULT NULL,
     bitmap       varchar(200) DEFAULT NULL,
     vector       varchar(200) DEFAULT NULL
@@ -103,6 +107,108 @@ ALTER TABLE pages_data
 
 GRANT SELECT, INSERT, UPDATE, DELETE ON pages_data TO ratbot;
 
+-- render_jobs
+-------------------------------------------------------------------------------
+-- Queues the generation of derivative files (page bitmaps and thumbnails,
+-- issue archives and PDFs) for the render workers. Jobs for an issue have a
+-- page_number of 0. Each job is unique by its target, derivative, and the
+-- version of the source it was queued for (e.g. the vector filename, or the
+-- publication date of the page that triggered it), which de-duplicates
+-- repeated requests for the same work. Inserting jobs notifies the render_jobs
+-- channel to wake listening workers. Jobs which fail are retried after
+-- run_after until they've been attempted too many times.
+-------------------------------------------------------------------------------
+
+CREATE TABLE render_jobs (
+    job_id         serial NOT NULL,
+    comic_id       varchar(20) NOT NULL,
+    issue_number   integer NOT NULL,
+    page_number    integer DEFAULT 0 NOT NULL,
+    derivative     varchar(10) NOT NULL,
+    source_version varchar(200) NOT NULL,
+    state          varchar(10) DEFAULT 'pending' NOT NULL,
+    attempts       integer DEFAULT 0 NOT NULL,
+    created        timestamp DEFAULT current_timestamp NOT NULL,
+    run_after      timestamp DEFAULT current_timestamp NOT NULL,
+    started        timestamp DEFAULT NULL,
+    finished       timestamp DEFAULT NULL,
+    worker         varchar(200) DEFAULT NULL,
+    error          text DEFAULT NULL
+);
+
+ALTER TABLE render_jobs
+    ADD CONSTRAINT render_jobs_pkey PRIMARY KEY (job_id),
+    ADD CONSTRAINT render_jobs_source_key
+        UNIQUE (comic_id, issue_number, page_number, derivative, source_version),
+    ADD CONSTRAINT render_jobs_issue_fkey FOREIGN KEY (comic_id, issue_number)
+        REFERENCES issues_data(comic_id, issue_number) ON UPDATE CASCADE ON DELETE CASCADE,
+    ADD CONSTRAINT render_jobs_derivative_check
+        CHECK (derivative IN ('bitmap', 'thumbnail', 'archive', 'pdf')),
+    ADD CONSTRAINT render_jobs_state_check
+        CHECK (state IN ('pending', 'running', 'done', 'failed'));
+
+CREATE INDEX render_jobs_pending_idx ON render_jobs(run_after)
+    WHERE state IN ('pending', 'running');
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON render_jobs TO ratbot;
+GRANT USAGE ON render_jobs_job_id_seq TO ratbot;
+
+CREATE FUNCTION render_jobs_notify()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('render_jobs', '');
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER render_jobs_notify
+    AFTER INSERT ON render_jobs
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE render_jobs_notify();
+
+-- enqueue_render_job
+-------------------------------------------------------------------------------
+-- Queues a render job unless an identical job (by target, derivative and
+-- source version) already exists. Returns true if the job was queued.
+-------------------------------------------------------------------------------
+
+CREATE FUNCTION enqueue_render_job(
+    p_comic_id varchar,
+    p_issue_number integer,
+    p_page_number integer,
+    p_derivative varchar,
+    p_source_version varchar,
+    p_run_after timestamp
+)
+    RETURNS boolean
+    LANGUAGE plpgsql
+    VOLATILE
+AS $$
+BEGIN
+    INSERT INTO render_jobs (
+        comic_id,
+        issue_number,
+        page_number,
+        derivative,
+        source_version,
+        run_after
+    ) VALUES (
+        p_comic_id,
+        p_issue_number,
+        p_page_number,
+        p_derivative,
+        p_source_version,
+        GREATEST(COALESCE(p_run_after, current_timestamp), current_timestamp)
+    );
+    RETURN true;
+EXCEPTION
+    WHEN unique_violation THEN
+        RETURN false;
+END;
+$$;
+
 -- pages
 -------------------------------------------------------------------------------
 -- Provides a view of the pages table which includes additional columns for
@@ -118,6 +224,7 @@ SELECT
     p.published,
     p.markup,
     p.description,
+    p.description_html,
     p.thumbnail,
     p.bitmap,
     p.vector,
@@ -163,6 +270,7 @@ BEGIN
             published,
             markup,
             description,
+            description_html,
             thumbnail,
             bitmap,
             vector
@@ -175,6 +283,7 @@ BEGIN
             COALESCE(NEW.published, CURRENT_TIMESTAMP),
             NEW.markup,
             NEW.description,
+            NEW.description_html,
             NEW.thumbnail,
             NEW.bitmap,
             NEW.vector
@@ -189,6 +298,7 @@ BEGIN
             published = NEW.published,
             markup = NEW.markup,
             description = NEW.description,
+            description_html = NEW.description_html,
             thumbnail = NEW.thumbnail,
             bitmap = NEW.bitmap,
             vector = NEW.vector
@@ -238,6 +348,7 @@ SELECT
     i.title,
     i.markup,
     i.description,
+    i.description_html,
     i.created,
     i.archive,
     i.pdf,
@@ -299,6 +410,7 @@ BEGIN
             title,
             markup,
             description,
+            description_html,
             created,
             archive,
             pdf
@@ -309,6 +421,7 @@ BEGIN
             NEW.title,
             NEW.markup,
             NEW.description,
+            NEW.description_html,
             COALESCE(NEW.created, CURRENT_TIMESTAMP),
             NEW.archive,
             NEW.pdf
@@ -321,6 +434,7 @@ BEGIN
             title = NEW.title,
             markup = NEW.markup,
             description = NEW.description,
+            description_html = NEW.description_html,
             created = NEW.created,
             archive = NEW.archive,
             pdf = NEW.pdf
@@ -369,6 +483,7 @@ SELECT
     c.license_id,
     c.markup,
     c.description,
+    c.description_html,
     c.created,
     MIN(p.issue_number)            AS first_issue_number,
     MAX(p.issue_number)            AS last_issue_number,
@@ -388,6 +503,7 @@ GROUP BY
     c.license_id,
     c.markup,
     c.description,
+    c.description_html,
     c.created;
 
 CREATE FUNCTION comics_redirect()
@@ -404,6 +520,7 @@ BEGIN
             license_id,
             markup,
             description,
+            description_html,
             created
         )
         VALUES (
@@ -413,6 +530,7 @@ BEGIN
             NEW.license_id,
             NEW.markup,
             NEW.description,
+            NEW.description_html,
             COALESCE(NEW.created, CURRENT_TIMESTAMP)
         );
         RETURN NEW;
@@ -424,6 +542,7 @@ BEGIN
             license_id = NEW.license_id,
             markup = NEW.markup,
             description = NEW.description,
+            description_html = NEW.description_html,
             created = NEW.created
         WHERE
             comic_id = OLD.comic_id;
@@ -452,6 +571,93 @@ CREATE TRIGGER comics_redirect
 
 GRANT SELECT, INSERT, UPDATE, DELETE ON comics TO ratbot;
 
+-- renumber_pages
+-------------------------------------------------------------------------------
+-- Closes the gap left in the page numbering of an issue after a page has been
+-- deleted, by decrementing the number of all subsequent pages in a single
+-- set-based operation. Subsequent pages are first moved beyond the current
+-- highest page number so that no intermediate state of either UPDATE
+-- collides with the primary key. Returns the number of pages renumbered.
+-------------------------------------------------------------------------------
+
+CREATE FUNCTION renumber_pages(
+    p_comic_id varchar,
+    p_issue_number integer,
+    p_page_number integer
+)
+    RETURNS integer
+    LANGUAGE plpgsql
+    VOLATILE
+AS $$
+DECLARE
+    shift integer;
+    moved integer;
+BEGIN
+    SELECT COALESCE(MAX(page_number), 0) INTO shift
+    FROM pages_data
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number = p_issue_number;
+
+    UPDATE pages_data SET
+        page_number = page_number + shift
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number = p_issue_number
+        AND page_number > p_page_number;
+    GET DIAGNOSTICS moved = ROW_COUNT;
+
+    UPDATE pages_data SET
+        page_number = page_number - shift - 1
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number = p_issue_number
+        AND page_number > shift;
+    RETURN moved;
+END;
+$$;
+
+-- renumber_issues
+-------------------------------------------------------------------------------
+-- Closes the gap left in the issue numbering of a comic after an issue has
+-- been deleted in the same manner as renumber_pages above. The pages of the
+-- renumbered issues follow them via the ON UPDATE CASCADE foreign key of
+-- pages_data. Returns the number of issues renumbered.
+-------------------------------------------------------------------------------
+
+CREATE FUNCTION renumber_issues(
+    p_comic_id varchar,
+    p_issue_number integer
+)
+    RETURNS integer
+    LANGUAGE plpgsql
+    VOLATILE
+AS $$
+DECLARE
+    shift integer;
+    moved integer;
+BEGIN
+    SELECT COALESCE(MAX(issue_number), 0) INTO shift
+    FROM issues_data
+    WHERE
+        comic_id = p_comic_id;
+
+    UPDATE issues_data SET
+        issue_number = issue_number + shift
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number > p_issue_number;
+    GET DIAGNOSTICS moved = ROW_COUNT;
+
+    UPDATE issues_data SET
+        issue_number = issue_number - shift - 1
+    WHERE
+        comic_id = p_comic_id
+        AND issue_number > shift;
+    RETURN moved;
+END;
+$$;
+
 -- front_pages
 -------------------------------------------------------------------------------
 -- Defines the set of pages that will appear on the front page of the site.
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+import transaction
+
+from ratbot.admission import BuildBudget, build_budget_from_settings
+
+
+def test_budget_limits_builds():
+    budget = BuildBudget(size=2)
+    assert budget.admit('a')
+    assert not budget.admit('a')
+    assert budget.admit('b')
+    assert not budget.admit('c')
+    budget.release('a')
+    assert budget.admit('c')
+    assert budget.building == {'b', 'c'}
+
+
+def test_budget_released_after_commit():
+    budget = BuildBudget(size=1)
+    manager = transaction.TransactionManager()
+    assert budget.admit('a')
+    budget.release_after('a', manager.begin())
+    assert not budget.admit('b')
+    manager.commit()
+    assert budget.building == set()
+
+
+def test_budget_released_after_abort():
+    budget = BuildBudget(size=1)
+    manager = transaction.TransactionManager()
+    assert budget.admit('a')
+    budget.release_after('a', manager.begin())
+    manager.abort()
+    assert budget.building == set()
+
+
+def test_budget_from_settings():
+    budget = build_budget_from_settings({'render.builds': '4'})
+    assert budget.size == 4
+    assert budget.retry_after == 10
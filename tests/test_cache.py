@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import time
+import pickle
+
+import pytest
+from mock import patch
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+from sqlalchemy import create_engine
+
+from ratbot.db_session import DBSession
+from ratbot.cache import (
+    CachedResponse,
+    ResponseCache,
+    decode_entry,
+    response_cache_tween_factory,
+    )
+from ratbot.tweens import database_tween_factory
+from ratbot.views.comics import routes as comic_routes
+
+
+@pytest.fixture()
+def session():
+    replica = create_engine('sqlite://')
+    DBSession.configure(bind=create_engine('sqlite://'), info={'replicas': [replica]})
+    yield DBSession()
+    DBSession.remove()
+    DBSession.configure(bind=None, info={})
+
+
+@pytest.fixture()
+def registry():
+    config = testing.setUp()
+    for name, pattern in comic_routes():
+        config.add_route(name, pattern)
+    config.commit()
+    config.registry['response_cache'] = ResponseCache()
+    yield config.registry
+    testing.tearDown()
+
+
+def run(registry, content):
+    # Runs a request for the comics listing through the database and cache
+    # tweens; the handler renders content['replica'] when reading from the
+    # replica, and content['primary'] otherwise
+    def handler(request):
+        source = 'primary' if DBSession().info['replica'] is None else 'replica'
+        return Response(content[source], content_type='text/html')
+    tween = database_tween_factory(
+        response_cache_tween_factory(handler, registry), registry)
+    request = Request.blank('/comics.html')
+    request.registry = registry
+    with patch('ratbot.cache.next_publication', return_value=None):
+        return tween(request).text
+
+
+def test_miss_renders_from_primary(registry, session):
+    cache = registry['response_cache']
+    content = {'primary': 'old', 'replica': 'old'}
+    assert run(registry, content) == 'old'
+    # An edit commits, but the replica hasn't caught up yet
+    cache.invalidate()
+    content['primary'] = 'new'
+    assert run(registry, content) == 'new'
+    # Subsequent requests are served the new page from the cache
+    content['primary'] = content['replica'] = 'stale'
+    assert run(registry, content) == 'new'
+
+
+def make_entry(cache, body=b'\x00<html>'):
+    return CachedResponse(
+        generation=cache.generation(),
+        expires=time.time() + 60,
+        status='200 OK',
+        headerlist=[('Content-Type', 'text/html')],
+        body=body)
+
+
+def test_disk_round_trip(tmpdir):
+    entry = make_entry(ResponseCache(path=str(tmpdir)))
+    ResponseCache(path=str(tmpdir)).set('key', entry)
+    # A new cache (as in another process) has nothing in memory, so the entry
+    # must come from the disk tier
+    assert ResponseCache(path=str(tmpdir)).get('key', entry.generation) == entry
+
+
+def test_disk_ignores_pickles(tmpdir):
+    cache = ResponseCache(path=str(tmpdir))
+    entry = make_entry(cache)
+    with io.open(cache._entry_file('key'), 'wb') as f:
+        pickle.dump(entry, f)
+    assert cache.get('key', entry.generation) is None
+
+
+@pytest.mark.parametrize('data', [
+    b'[]',
+    b'{"generation": null, "expires": "soon", "status": "200 OK", '
+    b'"headerlist": [], "body": ""}',
+    b'{"generation": null, "expires": 0, "status": "200 OK", '
+    b'"headerlist": [["Content-Type"]], "body": ""}',
+    b'{"generation": null, "expires": 0, "status": "200 OK", '
+    b'"headerlist": [], "body": "not base64!"}',
+    ])
+def test_decode_entry_malformed(data):
+    with pytest.raises(ValueError):
+        decode_entry(data)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from collections import namedtuple
+
+import pytest
+from mock import patch, MagicMock
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.dialects import postgresql
+
+from ratbot.models import Page
+from ratbot.jobs import Worker, enqueue as real_enqueue, queue_page_jobs, ISSUE_JOB
+
+
+Job = namedtuple('Job', (
+    'job_id', 'comic_id', 'issue_number', 'page_number', 'derivative',
+    'attempts'))
+
+
+def make_page(session, persistent=True, **kwargs):
+    values = {
+        'comic_id': 'foo',
+        'issue_number': 1,
+        'page_number': 2,
+        '_published': None,
+        '_thumbnail': None,
+        '_bitmap': None,
+        '_vector': None,
+        }
+    values.update(kwargs)
+    page = Page(**values)
+    if persistent:
+        # Reset the page's history, as though it had been loaded
+        make_transient_to_detached(page)
+    session.add(page)
+    return page
+
+
+@pytest.fixture()
+def session():
+    return Session(info={'render.queue': True})
+
+
+@pytest.fixture()
+def enqueue():
+    with patch('ratbot.jobs.enqueue') as enqueue:
+        yield enqueue
+
+
+def test_retry_delay():
+    worker = Worker(None, backoff=30)
+    assert [worker.retry_delay(n) for n in (1, 2, 3, 4)] == [30, 60, 120, 240]
+
+
+def test_enqueue_deduplicates_in_database():
+    # Duplicates are discarded by enqueue_render_job (which ignores the
+    # unique_violation), so enqueue must always go through it
+    connection = MagicMock()
+    real_enqueue(connection, 'foo', 1, 2, 'bitmap', 'page_a.svg')
+    statement = connection.execute.call_args[0][0]
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+    assert 'enqueue_render_job(' in sql
+    with pytest.raises(AssertionError):
+        real_enqueue(connection, 'foo', 1, 2, 'vector', 'page_a.svg')
+
+
+def test_claim_fails_abandoned_jobs_first():
+    worker = Worker(None, name='test', max_attempts=4, lease=60)
+    with patch('ratbot.jobs.DBSession') as db, patch('ratbot.jobs.mark_changed'):
+        db.execute.return_value.first.return_value = None
+        assert worker.claim() is None
+    (abandon, abandon_params), (claim, claim_params) = [
+        c[0] for c in db.execute.call_args_list]
+    assert "state = 'failed'" in str(abandon)
+    assert 'attempts < :max_attempts' in str(claim)
+    assert abandon_params == claim_params == {
+        'worker': 'test', 'lease': 60, 'max_attempts': 4}
+
+
+def test_run_job_retries_failures():
+    worker = Worker(None, max_attempts=3, backoff=10)
+    job = Job(1, 'foo', 1, 2, 'bitmap', 2)
+    with patch('ratbot.jobs.DBSession') as db, \
+            patch.object(worker, '_finish') as finish:
+        db.query.return_value.get.side_effect = RuntimeError('boom')
+        worker.run_job(job)
+    finish.assert_called_once_with(job, state='pending', error='boom', delay=20)
+
+
+def test_run_job_fails_after_max_attempts():
+    worker = Worker(None, max_attempts=3, backoff=10)
+    job = Job(1, 'foo', 1, 0, 'pdf', 3)
+    with patch('ratbot.jobs.DBSession') as db, \
+            patch.object(worker, '_finish') as finish:
+        db.query.return_value.get.side_effect = RuntimeError('boom')
+        worker.run_job(job)
+    finish.assert_called_once_with(job, state='failed', error='boom')
+
+
+def test_run_job_ignores_deleted_targets():
+    worker = Worker(None)
+    job = Job(1, 'foo', 1, 2, 'thumbnail', 1)
+    with patch('ratbot.jobs.DBSession') as db, \
+            patch.object(worker, '_finish') as finish:
+        db.query.return_value.get.return_value = None
+        worker.run_job(job)
+    finish.assert_called_once_with(job, state='done')
+
+
+def finish_sql(state, delay=None):
+    worker = Worker(None)
+    job = Job(1, 'foo', 1, 2, 'bitmap', 1)
+    with patch('ratbot.jobs.DBSession') as db, patch('ratbot.jobs.mark_changed'):
+        worker._finish(job, state=state, error='boom', delay=delay)
+    statement = db.execute.call_args[0][0]
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_finish_pending_delays_retry():
+    sql = finish_sql('pending', delay=60)
+    assert 'run_after=(CURRENT_TIMESTAMP + ' in sql
+    assert 'started=' in sql
+    assert 'finished=' not in sql
+
+
+def test_finish_done():
+    sql = finish_sql('done')
+    assert 'finished=CURRENT_TIMESTAMP' in sql
+    assert 'run_after=' not in sql
+
+
+def test_queue_disabled(enqueue):
+    session = Session(info={'render.queue': False})
+    page = make_page(session, persistent=False, _vector='/files/page_a.svg')
+    queue_page_jobs(None, None, page)
+    assert not enqueue.called
+
+
+def test_queue_new_vector(session, enqueue):
+    page = make_page(session, persistent=False, _vector='/files/page_a.svg')
+    queue_page_jobs(None, 'conn', page)
+    assert enqueue.call_args_list == [
+        (('conn', 'foo', 1, 2, 'bitmap', 'page_a.svg'),),
+        (('conn', 'foo', 1, 2, 'thumbnail', 'page_a.svg'),),
+        ]
+
+
+def test_queue_changed_vector(session, enqueue):
+    page = make_page(session, _vector='/files/page_a.svg', _bitmap='/files/page_b.png')
+    page._vector = '/files/page_c.svg'
+    queue_page_jobs(None, 'conn', page)
+    assert [c[0][4] for c in enqueue.call_args_list] == ['bitmap', 'thumbnail']
+    assert enqueue.call_args[0][5] == 'page_c.svg'
+
+
+def test_queue_changed_bitmap(session, enqueue):
+    page = make_page(session, _bitmap='/files/page_a.png')
+    page._bitmap = '/files/page_b.png'
+    queue_page_jobs(None, 'conn', page)
+    assert enqueue.call_args_list == [
+        (('conn', 'foo', 1, 2, 'thumbnail', 'page_b.png'),),
+        ]
+
+
+def test_queue_ignores_rendered_bitmap(session, enqueue):
+    # A bitmap rendered from the vector mustn't queue anything
+    page = make_page(session, _vector='/files/page_a.svg')
+    page._bitmap = '/files/page_b.png'
+    queue_page_jobs(None, 'conn', page)
+    assert not enqueue.called
+
+
+def test_queue_ignores_other_changes(session, enqueue):
+    page = make_page(session, _vector='/files/page_a.svg')
+    page.description = 'foo'
+    queue_page_jobs(None, 'conn', page)
+    assert not enqueue.called
+
+
+def test_queue_published(session, enqueue):
+    published = datetime(2017, 1, 2, 3, 4, 5)
+    page = make_page(session, _vector='/files/page_a.svg')
+    page._published = published
+    queue_page_jobs(None, 'conn', page)
+    version = 'published 2017-01-02T03:04:05'
+    assert enqueue.call_args_list == [
+        (('conn', 'foo', 1, ISSUE_JOB, 'archive', version),
+            {'run_after': published}),
+        (('conn', 'foo', 1, ISSUE_JOB, 'pdf', version),
+            {'run_after': published}),
+        ]
+
+
+def test_queue_published_together(session, enqueue):
+    # Pages published at the same moment queue identical issue jobs, which
+    # enqueue_render_job collapses into one per derivative
+    published = datetime(2017, 1, 2, 3, 4, 5)
+    for page_number, vector in ((1, 'page_a.svg'), (2, 'page_b.svg')):
+        page = make_page(
+            session, page_number=page_number, _vector='/files/' + vector)
+        page._published = published
+        queue_page_jobs(None, 'conn', page)
+    issue_jobs = {
+        c[0] for c in enqueue.call_args_list if c[0][3] == ISSUE_JOB}
+    assert issue_jobs == {
+        ('conn', 'foo', 1, ISSUE_JOB, 'archive', 'published 2017-01-02T03:04:05'),
+        ('conn', 'foo', 1, ISSUE_JOB, 'pdf', 'published 2017-01-02T03:04:05'),
+        }
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import json
+
+import pytest
+from mock import patch
+
+from ratbot.licenses import License, LicensesFactory, LICENSES_FALLBACK
+
+
+NOTSPECIFIED = {
+    'id': 'notspecified',
+    'status': 'active',
+    'title': 'License Not Specified',
+    'is_generic': 'True',
+    }
+
+CC_BY = {
+    'id': 'cc-by',
+    'status': 'active',
+    'title': 'Creative Commons Attribution',
+    'domain_content': True,
+    'is_od_compliant': 'approved',
+    'url': 'http://www.opendefinition.org/licenses/cc-by',
+    }
+
+
+def write_json(path, value):
+    with io.open(path, 'w') as f:
+        json.dump(value, f)
+    return path
+
+
+@pytest.fixture()
+def factory(tmpdir):
+    source = write_json(str(tmpdir.join('source.json')), {
+        'notspecified': NOTSPECIFIED, 'cc-by': CC_BY})
+    return LicensesFactory(
+        str(tmpdir.join('cache')), url='file://' + source)
+
+
+def test_license_attributes():
+    license = License(**CC_BY)
+    assert license.id == 'cc-by'
+    assert license.domains == {'content'}
+    assert license.active
+    assert license.is_open
+
+
+def test_unknown_license():
+    license = License.unknown('cc-by-nc')
+    assert license.id == 'cc-by-nc'
+    assert license.title == 'cc-by-nc'
+    assert not license.url
+
+
+def test_validate_fallback(factory):
+    factory._validate(LICENSES_FALLBACK)
+
+
+@pytest.mark.parametrize('value', [
+    [NOTSPECIFIED],
+    {'cc-by': CC_BY},
+    {'notspecified': NOTSPECIFIED, 'cc-by': dict(CC_BY, id='cc-by-sa')},
+    {'notspecified': NOTSPECIFIED, 'cc-by': {'id': 'cc-by'}},
+    {'notspecified': NOTSPECIFIED, 'cc-by': 'cc-by'},
+    ])
+def test_validate_rejects(factory, tmpdir, value):
+    with pytest.raises(ValueError):
+        factory._validate(write_json(str(tmpdir.join('bad.json')), value))
+
+
+def test_validate_rejects_garbage(factory, tmpdir):
+    path = str(tmpdir.join('bad.json'))
+    with io.open(path, 'w') as f:
+        f.write('<html>Not found</html>')
+    with pytest.raises(ValueError):
+        factory._validate(path)
+
+
+def test_serves_fallback_until_downloaded(factory):
+    with patch.object(factory, 'refresh') as refresh:
+        licenses = factory()
+    assert refresh.called
+    assert 'notspecified' in licenses
+    assert 'cc-by' not in licenses
+
+
+def test_update_cache(factory):
+    factory.update_mandatory()
+    licenses = factory()
+    assert set(licenses) == {'notspecified', 'cc-by'}
+    assert licenses['cc-by'].title == CC_BY['title']
+
+
+def test_update_cache_rejects_invalid(factory, tmpdir):
+    factory.update_mandatory()
+    factory._url = 'file://' + write_json(str(tmpdir.join('bad.json')), {})
+    with pytest.raises(ValueError):
+        factory.update_mandatory()
+    assert not os.path.exists(factory._cache_file + '.new')
+    assert 'cc-by' in factory()
+
+
+def test_update_cache_reports_original_error(factory):
+    # A failure before the temporary file exists mustn't be masked by the
+    # clean up
+    with patch('ratbot.licenses.io.open', side_effect=PermissionError('denied')):
+        with pytest.raises(PermissionError):
+            factory.update_mandatory()
+
+
+def test_parsed_licenses_shared_until_replaced(factory):
+    factory.update_mandatory()
+    first = factory()
+    assert factory() is first
+    factory.update_mandatory()
+    assert factory() is not first
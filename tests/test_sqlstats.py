@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+
+import pytest
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+from sqlalchemy import create_engine
+
+from ratbot.sqlstats import (
+    COUNT_HEADER,
+    TIME_HEADER,
+    query_counter,
+    sqlstats_tween_factory,
+    )
+
+
+@pytest.fixture()
+def engine():
+    return create_engine('sqlite://')
+
+
+def test_counts_statements(engine):
+    with query_counter(record=True) as stats:
+        engine.execute('SELECT 1')
+        engine.execute('SELECT 2')
+    assert stats.count == 2
+    assert stats.seconds > 0
+    assert stats.statements == ['SELECT 1', 'SELECT 2']
+
+
+def test_nested_counters(engine):
+    with query_counter() as outer:
+        engine.execute('SELECT 1')
+        with query_counter() as inner:
+            engine.execute('SELECT 2')
+        engine.execute('SELECT 3')
+    assert outer.count == 3
+    assert inner.count == 1
+    assert outer.statements is None
+
+
+def test_counts_nothing_outside_counter(engine):
+    engine.execute('SELECT 1')
+    with query_counter() as stats:
+        pass
+    engine.execute('SELECT 2')
+    assert stats.count == 0
+
+
+def test_counters_per_thread(engine):
+    with query_counter() as stats:
+        thread = threading.Thread(target=engine.execute, args=('SELECT 1',))
+        thread.start()
+        thread.join()
+    assert stats.count == 0
+
+
+def run_tween(engine, settings, statements):
+    registry = testing.setUp(settings=settings).registry
+    try:
+        def handler(request):
+            for i in range(statements):
+                engine.execute('SELECT %d' % i)
+            return Response()
+        request = Request.blank('/')
+        request.matched_route = None
+        response = sqlstats_tween_factory(handler, registry)(request)
+    finally:
+        testing.tearDown()
+    return request, response
+
+
+def test_tween_within_budget(engine, caplog):
+    with caplog.at_level(logging.DEBUG, logger='ratbot.sqlstats'):
+        request, response = run_tween(engine, {'sqlstats.budget': '2'}, 2)
+    assert request.sql_stats.count == 2
+    assert [r.levelno for r in caplog.records] == [logging.DEBUG]
+    assert COUNT_HEADER not in response.headers
+
+
+def test_tween_over_budget(engine, caplog):
+    with caplog.at_level(logging.DEBUG, logger='ratbot.sqlstats'):
+        request, response = run_tween(engine, {'sqlstats.budget': '2'}, 3)
+    assert [r.levelno for r in caplog.records] == [logging.WARNING]
+    assert caplog.records[0].getMessage().startswith('3 queries')
+
+
+def test_tween_headers(engine):
+    request, response = run_tween(engine, {'sqlstats.headers': 'true'}, 1)
+    assert response.headers[COUNT_HEADER] == '1'
+    assert float(response.headers[TIME_HEADER]) >= 0
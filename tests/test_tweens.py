@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012-2017 Dave Jones <dave@waveform.org.uk>.
+#
+# This file is part of ratbot comics.
+#
+# ratbot comics is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# ratbot comics is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# ratbot comics. If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+import transaction
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+from sqlalchemy import create_engine
+
+from ratbot.db_session import DBSession, RoutingSession
+from ratbot.tweens import PRIMARY_COOKIE, database_tween_factory, route_name
+from ratbot.views.comics import routes as comic_routes
+
+
+@pytest.fixture()
+def engines():
+    return create_engine('sqlite://'), [create_engine('sqlite://')]
+
+
+@pytest.fixture()
+def session(engines):
+    primary, replicas = engines
+    DBSession.configure(bind=primary, info={'replicas': replicas})
+    yield DBSession()
+    DBSession.remove()
+    DBSession.configure(bind=None, info={})
+
+
+@pytest.fixture()
+def registry():
+    config = testing.setUp()
+    for name, pattern in comic_routes():
+        config.add_route(name, pattern)
+    config.commit()
+    yield config.registry
+    testing.tearDown()
+
+
+def request(registry, path, method='GET', cookies=None):
+    request = Request.blank(path, method=method)
+    if cookies:
+        request.cookies.update(cookies)
+    request.registry = registry
+    return request
+
+
+def run(registry, request, write=False):
+    # Runs *request* through the database tween, returning the response and
+    # the state of the session during the request
+    seen = {}
+    def handler(request):
+        session = DBSession()
+        seen.update(session.info)
+        seen['autoflush'] = session.autoflush
+        if write:
+            session.info['wrote'] = True
+        return Response()
+    response = database_tween_factory(handler, registry)(request)
+    return response, seen
+
+
+def test_route_name(registry):
+    assert route_name(request(registry, '/comics.html')) == 'comics'
+    assert route_name(request(registry, '/nowhere')) is None
+
+
+def test_routing_session_reads_replica(engines):
+    primary, (replica,) = engines
+    session = RoutingSession(bind=primary, info={'replica': replica})
+    assert session.get_bind() is replica
+    session._flushing = True
+    assert session.get_bind() is primary
+    session.info['replica'] = None
+    session._flushing = False
+    assert session.get_bind() is primary
+
+
+def test_reader_route_read_only(registry, session, engines):
+    primary, (replica,) = engines
+    response, seen = run(registry, request(registry, '/comics.html'))
+    assert seen['read_only']
+    assert not seen['autoflush']
+    assert seen['replica'] is replica
+    assert PRIMARY_COOKIE not in response.headers.get('Set-Cookie', '')
+
+
+def test_derivative_route_writable(registry, session, engines):
+    primary, (replica,) = engines
+    response, seen = run(registry, request(registry, '/comics/foo-1.pdf'))
+    assert not seen['read_only']
+    assert seen['autoflush']
+    assert seen['replica'] is replica
+
+
+def test_admin_route_uses_primary(registry, session):
+    response, seen = run(registry, request(registry, '/comics.html', method='POST'))
+    assert not seen['read_only']
+    assert seen['replica'] is None
+
+
+def test_primary_cookie_uses_primary(registry, session):
+    response, seen = run(
+        registry, request(registry, '/comics.html', cookies={PRIMARY_COOKIE: '1'}))
+    assert seen['read_only']
+    assert seen['replica'] is None
+
+
+def test_write_sets_primary_cookie(registry, session):
+    with transaction.manager:
+        response, seen = run(
+            registry, request(registry, '/comics/foo-1.pdf'), write=True)
+    assert PRIMARY_COOKIE in response.headers['Set-Cookie']